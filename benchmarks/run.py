@@ -0,0 +1,366 @@
+"""Load-test every route, plus a few CRUD and serialization micro-benchmarks.
+
+Seeds a synthetic data set (see benchmarks/seed.py), then sends each
+scenario's requests from --concurrency threads, once with the response cache
+on and once with it off, and reports throughput and p50/p95/p99 latency:
+
+    python -m benchmarks.run --database-url sqlite:///./bench.db
+    python -m benchmarks.run --database-url sqlite:///./bench.db --output benchmarks/baseline.json
+    python -m benchmarks.run --database-url sqlite:///./bench.db --compare benchmarks/baseline.json
+
+--database-url is required, so a run never seeds the app's own database by
+accident; a database holding other data is only wiped with --reseed. By
+default requests go through an in-process TestClient; --server starts uvicorn
+instead and sends real HTTP requests to it.
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+Scenario = namedtuple("Scenario", ["name", "method", "make"])
+
+LIST_PAGES = 10
+SERVER_STARTUP_TIMEOUT = 30
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, max(0, math.ceil(p / 100 * len(sorted_values)) - 1))]
+
+def summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+    }
+
+def compare(results, baseline, tolerance):
+    """Scenarios whose p95 latency rose, or throughput fell, by more than
+    `tolerance` (a fraction) relative to the baseline run."""
+    regressions = []
+    for group, scenarios in results["results"].items():
+        for name, current in scenarios.items():
+            previous = baseline.get("results", {}).get(group, {}).get(name)
+            if previous is None:
+                continue
+            if current["p95_ms"] > previous["p95_ms"] * (1 + tolerance):
+                regressions.append(f"{group} {name}: p95 {previous['p95_ms']}ms -> {current['p95_ms']}ms")
+            if current["throughput"] < previous["throughput"] * (1 - tolerance):
+                regressions.append(f"{group} {name}: throughput {previous['throughput']}/s -> {current['throughput']}/s")
+    return regressions
+
+class Context:
+    """Ids the scenarios draw from: the seeded ranges plus rows created
+    during the run, so deletes always have something of their own to remove."""
+
+    def __init__(self, counts):
+        self.counts = counts
+        self.created = {"student": deque(), "enrollment": deque()}
+
+    def seeded_id(self, rng, table):
+        return rng.randint(1, self.counts[table])
+
+    def page(self, rng, limit=100):
+        # A handful of hot pages, as a real client mix would request.
+        return rng.randrange(LIST_PAGES) * limit
+
+    def take(self, table, create):
+        try:
+            return self.created[table].popleft()
+        except IndexError:
+            return create()
+
+def _created_id(response):
+    response.raise_for_status()
+    return response.json()["id"]
+
+def scenarios():
+    from src.pagination import encode_cursor
+
+    def new_student(session, base, ctx, rng):
+        return _created_id(session.post(f"{base}/students/", json={"username": "benchmark"}))
+
+    def new_enrollment(session, base, ctx, rng):
+        student_id = ctx.take("student", lambda: new_student(session, base, ctx, rng))
+        course_id = ctx.seeded_id(rng, "course")
+        session.post(f"{base}/enrollments/", json={"student_id": student_id, "course_id": course_id}).raise_for_status()
+        return student_id, course_id
+
+    def get(path):
+        return lambda session, base, ctx, rng: (path(ctx, rng), None)
+
+    def post_course(session, base, ctx, rng):
+        return "/courses/", {"name": "Benchmark Course", "teacher_id": ctx.seeded_id(rng, "teacher")}
+
+    def put_course(session, base, ctx, rng):
+        # Rewrites a seeded course with its seeded values, keeping the data set stable.
+        course_id = ctx.seeded_id(rng, "course")
+        return f"/courses/{course_id}", {"name": f"Course {course_id}", "teacher_id": (course_id - 1) % ctx.counts["teacher"] + 1}
+
+    def post_enrollment(session, base, ctx, rng):
+        student_id = ctx.take("student", lambda: new_student(session, base, ctx, rng))
+        return "/enrollments/", {"student_id": student_id, "course_id": ctx.seeded_id(rng, "course")}
+
+    def delete_enrollment(session, base, ctx, rng):
+        student_id, course_id = ctx.take("enrollment", lambda: new_enrollment(session, base, ctx, rng))
+        return f"/enrollments/{student_id}/{course_id}", None
+
+    def bulk_enrollments(session, base, ctx, rng):
+        student_id = ctx.take("student", lambda: new_student(session, base, ctx, rng))
+        courses = rng.sample(range(1, ctx.counts["course"] + 1), min(10, ctx.counts["course"]))
+        return "/enrollments/bulk", [{"student_id": student_id, "course_id": course_id} for course_id in courses]
+
+    return [
+        Scenario("GET /courses/", "GET", get(lambda ctx, rng: f"/courses/?skip={ctx.page(rng)}")),
+        Scenario("GET /courses/{id}", "GET", get(lambda ctx, rng: f"/courses/{ctx.seeded_id(rng, 'course')}")),
+        Scenario("GET /courses/?ids", "GET", get(lambda ctx, rng: "/courses/?ids=" + ",".join(str(ctx.seeded_id(rng, "course")) for _ in range(20)))),
+        Scenario("GET /students/?ids", "GET", get(lambda ctx, rng: "/students/?ids=" + ",".join(str(ctx.seeded_id(rng, "student")) for _ in range(20)))),
+        Scenario("GET /courses/{id}/stats", "GET", get(lambda ctx, rng: f"/courses/{ctx.seeded_id(rng, 'course')}/stats")),
+        Scenario("GET /teachers/{id}/stats", "GET", get(lambda ctx, rng: f"/teachers/{ctx.seeded_id(rng, 'teacher')}/stats")),
+        Scenario("GET /courses/{id}/lessons/", "GET", get(lambda ctx, rng: f"/courses/{ctx.seeded_id(rng, 'course')}/lessons/")),
+        Scenario("GET /lessons/", "GET", get(lambda ctx, rng: f"/lessons/?skip={ctx.page(rng)}")),
+        Scenario("GET /lessons/?cursor", "GET", get(lambda ctx, rng: f"/lessons/?cursor={encode_cursor(ctx.page(rng, 1000))}")),
+        Scenario("GET /students/", "GET", get(lambda ctx, rng: f"/students/?skip={ctx.page(rng)}")),
+        Scenario("GET /students/?fields", "GET", get(lambda ctx, rng: f"/students/?skip={ctx.page(rng)}&fields=id,username")),
+        Scenario("GET /students/{id}/enrollments/", "GET", get(lambda ctx, rng: f"/students/{ctx.seeded_id(rng, 'student')}/enrollments/")),
+        Scenario("GET /teachers/", "GET", get(lambda ctx, rng: f"/teachers/?skip={ctx.page(rng)}")),
+        Scenario("GET /teachers/?fields", "GET", get(lambda ctx, rng: f"/teachers/?skip={ctx.page(rng)}&fields=id,name")),
+        Scenario("GET /enrollments/", "GET", get(lambda ctx, rng: f"/enrollments/?skip={ctx.page(rng)}")),
+        Scenario("GET /search/students", "GET", get(lambda ctx, rng: f"/search/students?q=student{ctx.seeded_id(rng, 'student')}")),
+        Scenario("GET /search/courses", "GET", get(lambda ctx, rng: f"/search/courses?q=Course+{ctx.seeded_id(rng, 'course')}")),
+        Scenario("GET /export/courses.ndjson", "GET", get(lambda ctx, rng: "/export/courses.ndjson")),
+        Scenario("GET /metrics/pool", "GET", get(lambda ctx, rng: "/metrics/pool")),
+        Scenario("POST /teachers/", "POST", lambda session, base, ctx, rng: ("/teachers/", {"name": "Benchmark Teacher"})),
+        Scenario("POST /courses/", "POST", post_course),
+        Scenario("PUT /courses/{id}", "PUT", put_course),
+        # No DELETE /courses/{id}: that route answers 204 with a body, so
+        # every request would count as an error.
+        Scenario("POST /lessons/", "POST", lambda session, base, ctx, rng: ("/lessons/", {"title": "Benchmark Lesson", "course_id": ctx.seeded_id(rng, "course")})),
+        Scenario("POST /students/", "POST", lambda session, base, ctx, rng: ("/students/", {"username": "benchmark"})),
+        Scenario("POST /students/bulk", "POST", lambda session, base, ctx, rng: ("/students/bulk", [{"username": "benchmark"}] * 100)),
+        Scenario("POST /enrollments/", "POST", post_enrollment),
+        Scenario("DELETE /enrollments/{student_id}/{course_id}", "DELETE", delete_enrollment),
+        Scenario("POST /enrollments/bulk", "POST", bulk_enrollments),
+    ]
+
+def _remember(scenario, ctx, body, response):
+    # Rows created by the POST scenarios feed the DELETE scenarios.
+    if scenario.name == "POST /students/":
+        ctx.created["student"].append(response.json()["id"])
+    elif scenario.name == "POST /enrollments/":
+        ctx.created["enrollment"].append((body["student_id"], body["course_id"]))
+
+def run_scenario(scenario, make_session, base, ctx, requests_count, concurrency, seed_value):
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+
+    def worker(index):
+        rng = random.Random(f"{seed_value}:{scenario.name}:{index}")
+        session = make_session()
+        share = requests_count // concurrency + (index < requests_count % concurrency)
+        local = []
+        for _ in range(share):
+            path, body = scenario.make(session, base, ctx, rng)
+            start = time.perf_counter()
+            try:
+                response = session.request(scenario.method, f"{base}{path}", json=body)
+                response.content  # include reading a streamed body
+                failed = response.status_code >= 400
+            except Exception:
+                # e.g. a malformed response; counted, not fatal to the run.
+                response, failed = None, True
+            local.append(time.perf_counter() - start)
+            if failed:
+                with lock:
+                    errors[0] += 1
+            else:
+                _remember(scenario, ctx, body, response)
+        with lock:
+            latencies.extend(local)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(worker, range(concurrency)))
+    return summarize(latencies, errors[0], time.perf_counter() - start)
+
+def micro_benchmarks(iterations):
+    """Time the list path without HTTP in front of it: the ORM objects plus
+    pydantic orm_mode path the routes used to take, against the column rows
+    plus direct encoding they take now."""
+    from sqlalchemy.orm import selectinload
+    from src import crud
+    from src.models import SessionLocal, Student as DBStudent, Teacher as DBTeacher
+    from src.schemas import Student, Teacher
+    from src.serializers import serialize, serialize_rows
+
+    results = {}
+
+    def measure(name, func):
+        latencies = []
+        start = time.perf_counter()
+        for _ in range(iterations):
+            began = time.perf_counter()
+            func()
+            latencies.append(time.perf_counter() - began)
+        results[name] = summarize(latencies, 0, time.perf_counter() - start)
+
+    def orm_page(db, model, relationship):
+        db.expire_all()
+        return db.query(model).options(selectinload(relationship)).order_by(model.id).limit(100).all()
+
+    with SessionLocal() as db:
+        for schema, model, relationship, rows in (
+            (Student, DBStudent, DBStudent.enrollments, lambda: crud.retrieve_students(db, limit=100)),
+            (Teacher, DBTeacher, DBTeacher.courses, lambda: crud.retrieve_teachers(db, limit=100)),
+        ):
+            name = schema.__name__
+            measure(f"{name} page: ORM query", lambda: orm_page(db, model, relationship))
+            measure(f"{name} page: column query", rows)
+            orm_rows, column_rows = orm_page(db, model, relationship), rows()
+            measure(f"{name} page: pydantic serialize", lambda: serialize(schema, orm_rows))
+            measure(f"{name} page: fast serialize", lambda: serialize_rows(schema, column_rows))
+            measure(f"{name} page: ORM query + pydantic serialize", lambda: serialize(schema, orm_page(db, model, relationship)))
+            measure(f"{name} page: column query + fast serialize", lambda: serialize_rows(schema, rows()))
+    return results
+
+def set_cache_enabled(enabled):
+    import src.cache
+
+    src.cache.CACHE_ENABLED = enabled
+    src.cache.caches.clear()
+    src.cache.dependents.clear()
+    src.cache.key_dependencies.clear()
+
+def start_server(port, workers, cache_enabled):
+    import requests
+
+    env = dict(os.environ, CACHE_ENABLED=str(cache_enabled).lower())
+    command = [sys.executable, "-m", "uvicorn", "src.main:app", "--port", str(port), "--workers", str(workers), "--log-level", "warning"]
+    process = subprocess.Popen(command, env=env)
+    deadline = time.monotonic() + SERVER_STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            requests.get(f"http://127.0.0.1:{port}/metrics/pool", timeout=1)
+            return process
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"uvicorn did not start on port {port}")
+
+def print_report(results):
+    columns = ("requests", "errors", "throughput", "p50_ms", "p95_ms", "p99_ms")
+    for group, scenarios_results in results["results"].items():
+        print(f"\n{group}")
+        print(f"{'scenario':<48}" + "".join(f"{column:>12}" for column in columns))
+        for name, stats in scenarios_results.items():
+            print(f"{name:<48}" + "".join(f"{stats[column]:>12}" for column in columns))
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--database-url", required=True, help="SQLAlchemy URL of a database the benchmark may seed")
+    parser.add_argument("--students", type=int, default=100000)
+    parser.add_argument("--enrollments", type=int, default=1000000)
+    parser.add_argument("--reseed", action="store_true", help="delete every row and reseed, even if the data set is already there")
+    parser.add_argument("--requests", type=int, default=500, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--cache", choices=["on", "off", "both"], default="both")
+    parser.add_argument("--scenario", action="append", default=[], help="only run scenarios containing this text")
+    parser.add_argument("--micro-iterations", type=int, default=200)
+    parser.add_argument("--server", action="store_true", help="benchmark a uvicorn process over HTTP")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="write the results as JSON (e.g. a new baseline)")
+    parser.add_argument("--compare", help="baseline JSON to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown as a fraction (default 0.2)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    # Settings are read when src is first imported, so set them up front.
+    os.environ["DATABASE_URL"] = args.database_url
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    # The load generator is one client; limits would turn the run into 429s.
+    os.environ.setdefault("RATE_LIMIT_ENABLED", "false")
+
+    from fastapi.testclient import TestClient
+    from src.logs import configure_logging
+    from src.main import app
+    from src.migrations import upgrade
+    from src.models import SessionLocal, engine
+    from benchmarks.seed import seed
+
+    # The in-process client never runs the app's startup hooks.
+    configure_logging()
+    upgrade(engine)
+    counts = seed(SessionLocal, args.students, args.enrollments, args.seed, args.reseed)
+    ctx = Context(counts)
+    selected = [s for s in scenarios() if not args.scenario or any(text in s.name for text in args.scenario)]
+
+    results = {
+        "meta": {
+            "database": engine.dialect.name,
+            "rows": counts,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "mode": "server" if args.server else "in-process",
+            "workers": args.workers if args.server else None,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        },
+        "results": {},
+    }
+
+    modes = {"on": [True], "off": [False], "both": [True, False]}[args.cache]
+    for cache_enabled in modes:
+        group = f"cache_{'on' if cache_enabled else 'off'}"
+        server = None
+        if args.server:
+            import requests
+
+            server = start_server(args.port, args.workers, cache_enabled)
+            make_session, base = requests.Session, f"http://127.0.0.1:{args.port}"
+        else:
+            set_cache_enabled(cache_enabled)
+            make_session, base = (lambda: TestClient(app)), "http://testserver"
+        try:
+            results["results"][group] = {
+                scenario.name: run_scenario(scenario, make_session, base, ctx, args.requests, args.concurrency, args.seed)
+                for scenario in selected
+            }
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+
+    results["results"]["micro"] = micro_benchmarks(args.micro_iterations)
+    print_report(results)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
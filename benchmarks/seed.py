@@ -0,0 +1,97 @@
+"""Deterministic synthetic data for the benchmarks.
+
+Rows get explicit ids (1..n per table) so every run against the same sizes
+sees the same data set and the load generator can pick valid ids without
+asking the database.
+"""
+import random
+import time
+from sqlalchemy import func, text
+from loguru import logger
+from src.stats import REBUILD
+
+SEED_BATCH_SIZE = 10000
+
+def sizes(students, enrollments):
+    """Row counts per table, derived from the two headline sizes."""
+    teachers = max(1, students // 100)
+    courses = teachers * 5
+    return {
+        "teacher": teachers,
+        "course": courses,
+        "lesson": courses * 10,
+        "student": students,
+        # Each (student, course) pair is unique, so cap at the number of pairs.
+        "enrollment": min(enrollments, students * courses),
+    }
+
+def _insert(session, model, rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= SEED_BATCH_SIZE:
+            session.bulk_insert_mappings(model, batch)
+            batch = []
+    if batch:
+        session.bulk_insert_mappings(model, batch)
+
+def _enrollments(rng, counts):
+    students, courses = counts["student"], counts["course"]
+    per_student, extra = divmod(counts["enrollment"], students)
+    enrollment_id = 0
+    for student_id in range(1, students + 1):
+        taken = per_student + (student_id <= extra)
+        for course_id in rng.sample(range(1, courses + 1), taken):
+            enrollment_id += 1
+            yield {"id": enrollment_id, "student_id": student_id, "course_id": course_id}
+
+def is_seeded(session, models, counts):
+    return all(session.query(func.count(model.id)).scalar() == counts[model.__tablename__] for model in models)
+
+def seed(session_factory, students=100000, enrollments=1000000, seed_value=42, reseed=False):
+    """Fill an up-to-date schema with the synthetic data set. Returns the row
+    counts; an already seeded database of the same size is reused.
+
+    Seeding deletes every row first, so a database holding other data is
+    only touched with `reseed`.
+    """
+    from src.models import Course, Enrollment, Lesson, Student, Teacher
+
+    models = [Teacher, Course, Lesson, Student, Enrollment]
+    counts = sizes(students, enrollments)
+    rng = random.Random(seed_value)
+
+    with session_factory() as session:
+        if not reseed and is_seeded(session, models, counts):
+            logger.info("Reusing seeded database: {}", counts)
+            return counts
+        if not reseed and any(session.query(model.id).first() is not None for model in models):
+            raise RuntimeError("The database holds data that is not this benchmark data set; pass --reseed to delete it")
+
+        start = time.perf_counter()
+        for model in reversed(models):
+            session.query(model).delete()
+        _insert(session, Teacher, ({"id": i, "name": f"Teacher {i}"} for i in range(1, counts["teacher"] + 1)))
+        _insert(session, Course, (
+            {"id": i, "name": f"Course {i}", "teacher_id": (i - 1) % counts["teacher"] + 1}
+            for i in range(1, counts["course"] + 1)
+        ))
+        _insert(session, Lesson, (
+            {"id": i, "title": f"Lesson {i}", "course_id": (i - 1) % counts["course"] + 1}
+            for i in range(1, counts["lesson"] + 1)
+        ))
+        _insert(session, Student, ({"id": i, "username": f"student{i}"} for i in range(1, counts["student"] + 1)))
+        _insert(session, Enrollment, _enrollments(rng, counts))
+        # Bulk inserts bypass the CRUD layer, so count the totals afresh.
+        for statement in REBUILD:
+            session.execute(text(statement))
+
+        if session.get_bind().dialect.name == "postgresql":
+            # Explicit ids leave the serial sequences behind; move them past
+            # the seeded rows so the benchmark's inserts don't collide.
+            for model in models:
+                table = model.__tablename__
+                session.execute(text(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), {counts[table]})"))
+        session.commit()
+        logger.info("Seeded {} in {:.1f}s", counts, time.perf_counter() - start)
+    return counts
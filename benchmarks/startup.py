@@ -0,0 +1,86 @@
+"""Cold start: time from a fresh interpreter importing the app to its first
+response, in separate processes so nothing is cached between runs.
+
+    python -m benchmarks.startup --database-url sqlite:///./bench.db --runs 10
+
+Each run reports the import of src.main, the startup hooks and the first
+request (which opens the first database connection). The schema must exist;
+it is brought up to date once before the runs.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+from benchmarks.run import percentile
+
+CHILD = """
+import json, sys, time
+from fastapi.testclient import TestClient
+
+start = time.perf_counter()
+from src.main import app
+imported = time.perf_counter()
+with TestClient(app) as client:
+    started = time.perf_counter()
+    response = client.get(sys.argv[1])
+    done = time.perf_counter()
+print(json.dumps({
+    "status": response.status_code,
+    "import": imported - start,
+    "startup": started - imported,
+    "first_request": done - started,
+    "total": done - start,
+}))
+"""
+
+PHASES = ["import", "startup", "first_request", "total"]
+
+def measure(path, env):
+    output = subprocess.run([sys.executable, "-c", CHILD, path], env=env, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def summarize(runs):
+    summary = {}
+    for phase in PHASES:
+        values = sorted(run[phase] for run in runs)
+        summary[phase] = {
+            "p50_ms": round(percentile(values, 50) * 1000, 3),
+            "max_ms": round(values[-1] * 1000, 3),
+        }
+    return summary
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--database-url", help="SQLAlchemy URL; defaults to the POSTGRES_* settings")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--path", default="/courses/?limit=1", help="route requested first")
+    parser.add_argument("--output", help="write the results as JSON")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    env = dict(os.environ)
+    if args.database_url:
+        env["DATABASE_URL"] = args.database_url
+    env.setdefault("LOG_LEVEL", "WARNING")
+    env.setdefault("RATE_LIMIT_ENABLED", "false")
+
+    subprocess.run([sys.executable, "-m", "src.migrations"], env=env, check=True, capture_output=True)
+    runs = [measure(args.path, env) for _ in range(args.runs)]
+    failed = [run["status"] for run in runs if run["status"] >= 400]
+    if failed:
+        print(f"first request failed with {failed[0]}", file=sys.stderr)
+        return 1
+
+    summary = summarize(runs)
+    print(f"{'phase':<16}{'p50_ms':>12}{'max_ms':>12}")
+    for phase, stats in summary.items():
+        print(f"{phase:<16}{stats['p50_ms']:>12}{stats['max_ms']:>12}")
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({"runs": len(runs), "path": args.path, "results": summary}, file, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
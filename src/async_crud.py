@@ -0,0 +1,260 @@
+from functools import wraps
+from typing import List, Optional
+from databases import Database
+from sqlalchemy import delete, insert, select, update
+from src import stats
+from src.models import (
+    Course as DBCourse,
+    Teacher as DBTeacher,
+    Lesson as DBLesson,
+    Student as DBStudent,
+    Enrollment as DBEnrollment,
+)
+
+from src.schemas import *
+from loguru import logger
+from src.errors import *
+from src.crud import DELETE_ENROLLMENT, INSERT_ENROLLMENT
+
+course_table = DBCourse.__table__
+teacher_table = DBTeacher.__table__
+lesson_table = DBLesson.__table__
+student_table = DBStudent.__table__
+enrollment_table = DBEnrollment.__table__
+
+def handle_async_exceptions(message):
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:
+                logger.error("{}: {}", message, e)
+                raise
+
+        return wrapper
+
+    return decorator
+
+def _to_dicts(rows):
+    return [dict(row._mapping) for row in rows]
+
+async def _by_ids(database: Database, table, ids):
+    return _to_dicts(await database.fetch_all(select(table).where(table.c.id.in_(list(ids)))))
+
+async def _fetch_children(database: Database, table, foreign_key: str, parents: list, attribute: str):
+    # One IN query for the whole page instead of a lazy load per parent row.
+    for parent in parents:
+        parent[attribute] = []
+    if not parents:
+        return parents
+
+    by_id = {parent["id"]: parent for parent in parents}
+    column = table.c[foreign_key]
+    query = select(table).where(column.in_(list(by_id))).order_by(table.c.id)
+    for child in _to_dicts(await database.fetch_all(query)):
+        by_id[child[foreign_key]][attribute].append(child)
+    return parents
+
+async def _apply_stats(database: Database, changes):
+    # Counter updates ride in the caller's transaction; see src/stats.py.
+    for statement, params in changes:
+        await database.execute_many(statement, params)
+
+async def _course_teachers(database: Database, course_ids):
+    query = select(course_table.c.id, course_table.c.teacher_id).where(course_table.c.id.in_(set(course_ids)))
+    return {row["id"]: row["teacher_id"] for row in _to_dicts(await database.fetch_all(query))}
+
+async def _enrolled_students(database: Database, course_id: int):
+    query = select(enrollment_table.c.student_id).where(enrollment_table.c.course_id == course_id)
+    return [row["student_id"] for row in _to_dicts(await database.fetch_all(query))]
+
+def paginate(query, id_column, skip: int, limit: int, after_id=None):
+    query = query.order_by(id_column)
+    if after_id is not None:
+        query = query.where(id_column > after_id)
+    else:
+        query = query.offset(skip)
+    return query.limit(limit)
+
+@handle_async_exceptions(ERROR_ADD_COURSE)
+async def add_course(database: Database, course: CourseCreate):
+    values = course.dict()
+    async with database.transaction():
+        course_id = await database.execute(insert(course_table).values(**values))
+        await _apply_stats(database, stats.course_added(course_id, course.teacher_id))
+    logger.info("Added course: {} with ID: {}", course.name, course_id)
+    return {"id": course_id, **values}
+
+@handle_async_exceptions(ERROR_RETRIEVE_COURSES)
+async def retrieve_courses(database: Database, skip: int = 0, limit: int = 100, after_id: Optional[int] = None):
+    query = paginate(select(course_table), course_table.c.id, skip, limit, after_id)
+    return _to_dicts(await database.fetch_all(query))
+
+@handle_async_exceptions(ERROR_RETRIEVE_COURSES)
+async def retrieve_courses_by_ids(database: Database, ids: List[int]):
+    return await _by_ids(database, course_table, ids)
+
+@handle_async_exceptions(ERROR_RETRIEVE_COURSE_BY_ID)
+async def retrieve_course_by_id(database: Database, course_id: int):
+    row = await database.fetch_one(select(course_table).where(course_table.c.id == course_id))
+    return dict(row._mapping) if row else None
+
+@handle_async_exceptions(ERROR_MODIFY_COURSE)
+async def modify_course(database: Database, course_id: int, course_data: CourseCreate):
+    """Returns None when there is no such course."""
+    query = update(course_table).where(course_table.c.id == course_id).values(**course_data.dict())
+    async with database.transaction():
+        old_course = await database.fetch_one(select(course_table.c.teacher_id).where(course_table.c.id == course_id))
+        if old_course is None:
+            return None
+        old_teacher_id = old_course.teacher_id
+        await database.execute(query)
+        if course_data.teacher_id != old_teacher_id:
+            student_ids = await _enrolled_students(database, course_id)
+            await _apply_stats(database, stats.course_moved(student_ids, old_teacher_id, course_data.teacher_id))
+
+    logger.info("Updated course with ID: {}", course_id)
+
+    return await retrieve_course_by_id(database, course_id)
+
+@handle_async_exceptions(ERROR_REMOVE_COURSE)
+async def remove_course(database: Database, course_id: int):
+    async with database.transaction():
+        teacher_id = await database.fetch_val(select(course_table.c.teacher_id).where(course_table.c.id == course_id))
+        orphans = {
+            "lesson": _to_dicts(await database.fetch_all(select(lesson_table).where(lesson_table.c.course_id == course_id))),
+            "enrollment": _to_dicts(await database.fetch_all(select(enrollment_table).where(enrollment_table.c.course_id == course_id))),
+        }
+        student_ids = [enrollment["student_id"] for enrollment in orphans["enrollment"]]
+        # What the ORM does for the sync routes: the foreign keys have no
+        # ON DELETE rule, so detach the children before the course goes.
+        await database.execute(update(lesson_table).where(lesson_table.c.course_id == course_id).values(course_id=None))
+        await database.execute(update(enrollment_table).where(enrollment_table.c.course_id == course_id).values(course_id=None))
+        await database.execute(delete(course_table).where(course_table.c.id == course_id))
+        await _apply_stats(database, stats.course_removed(course_id, student_ids, teacher_id))
+    logger.info("Deleted course with ID: {}", course_id)
+    return f"Course with ID {course_id} has been deleted", orphans
+
+@handle_async_exceptions(ERROR_ADD_STUDENT)
+async def add_student(database: Database, student: StudentCreate):
+    values = student.dict()
+    student_id = await database.execute(insert(student_table).values(**values))
+
+    logger.info("Added student: {} with ID: {}", student.username, student_id)
+
+    return {"id": student_id, "enrollments": [], **values}
+
+@handle_async_exceptions(ERROR_RETRIEVE_STUDENTS)
+async def retrieve_students(database: Database, skip: int = 0, limit: int = 100, include_enrollments: bool = True, after_id: Optional[int] = None):
+    query = paginate(select(student_table), student_table.c.id, skip, limit, after_id)
+    students = _to_dicts(await database.fetch_all(query))
+    if not include_enrollments:
+        return students
+    return await _fetch_children(database, enrollment_table, "student_id", students, "enrollments")
+
+@handle_async_exceptions(ERROR_RETRIEVE_STUDENTS)
+async def retrieve_students_by_ids(database: Database, ids: List[int], include_enrollments: bool = True):
+    students = await _by_ids(database, student_table, ids)
+    if not include_enrollments:
+        return students
+    return await _fetch_children(database, enrollment_table, "student_id", students, "enrollments")
+
+@handle_async_exceptions(ERROR_ADD_TEACHER)
+async def add_teacher(database: Database, teacher: TeacherCreate):
+    values = teacher.dict()
+    async with database.transaction():
+        teacher_id = await database.execute(insert(teacher_table).values(**values))
+        await _apply_stats(database, stats.teacher_added(teacher_id))
+
+    logger.info("Added teacher: {} with ID: {}", teacher.name, teacher_id)
+
+    return {"id": teacher_id, "courses": [], **values}
+
+@handle_async_exceptions(ERROR_RETRIEVE_TEACHERS)
+async def retrieve_teachers(database: Database, skip: int = 0, limit: int = 100, include_courses: bool = True, after_id: Optional[int] = None):
+    query = paginate(select(teacher_table), teacher_table.c.id, skip, limit, after_id)
+    teachers = _to_dicts(await database.fetch_all(query))
+    if not include_courses:
+        return teachers
+    return await _fetch_children(database, course_table, "teacher_id", teachers, "courses")
+
+@handle_async_exceptions(ERROR_RETRIEVE_TEACHERS)
+async def retrieve_teachers_by_ids(database: Database, ids: List[int], include_courses: bool = True):
+    teachers = await _by_ids(database, teacher_table, ids)
+    if not include_courses:
+        return teachers
+    return await _fetch_children(database, course_table, "teacher_id", teachers, "courses")
+
+@handle_async_exceptions(ERROR_ADD_LESSON)
+async def add_lesson(database: Database, lesson: LessonCreate):
+    values = lesson.dict()
+    async with database.transaction():
+        lesson_id = await database.execute(insert(lesson_table).values(**values))
+        await _apply_stats(database, stats.lesson_added(lesson.course_id))
+
+    logger.info("Added lesson: {} with ID: {}", lesson.title, lesson_id)
+
+    return {"id": lesson_id, **values}
+
+@handle_async_exceptions(ERROR_RETRIEVE_LESSONS)
+async def retrieve_lessons(database: Database, skip: int = 0, limit: int = 100, after_id: Optional[int] = None):
+    query = paginate(select(lesson_table), lesson_table.c.id, skip, limit, after_id)
+    return _to_dicts(await database.fetch_all(query))
+
+@handle_async_exceptions(ERROR_RETRIEVE_LESSONS)
+async def retrieve_lessons_by_ids(database: Database, ids: List[int]):
+    return await _by_ids(database, lesson_table, ids)
+
+@handle_async_exceptions(ERROR_LESSONS_FOR_COURSE)
+async def retrieve_lessons_for_course(database: Database, course_id: int, skip: int = 0, limit: int = 100, after_id: Optional[int] = None):
+    query = paginate(select(lesson_table).where(lesson_table.c.course_id == course_id), lesson_table.c.id, skip, limit, after_id)
+    return _to_dicts(await database.fetch_all(query))
+
+@handle_async_exceptions(ERROR_ADD_ENROLLMENT)
+async def add_enrollment(database: Database, enrollment: EnrollmentCreate):
+    """Enroll the student unless already enrolled; returns the enrollment
+    and whether this call created it."""
+    values = enrollment.dict()
+    async with database.transaction():
+        enrollment_id = await database.fetch_val(INSERT_ENROLLMENT, values)
+        if enrollment_id is not None:
+            course_teachers = await _course_teachers(database, [enrollment.course_id])
+            await _apply_stats(database, stats.enrollments_changed([values], course_teachers, 1))
+
+    if enrollment_id is None:
+        query = select(enrollment_table.c.id).where(
+            enrollment_table.c.student_id == enrollment.student_id,
+            enrollment_table.c.course_id == enrollment.course_id,
+        )
+        return {"id": await database.fetch_val(query), **values}, False
+
+    logger.info("Added enrollment for student {} in course {}", enrollment.student_id, enrollment.course_id)
+
+    return {"id": enrollment_id, **values}, True
+
+@handle_async_exceptions(ERROR_REMOVE_ENROLLMENT)
+async def remove_enrollment(database: Database, student_id: int, course_id: int):
+    """Returns (message, removed row), or None when there was no such
+    enrollment to remove."""
+    values = {"student_id": student_id, "course_id": course_id}
+    async with database.transaction():
+        removed = await database.fetch_one(DELETE_ENROLLMENT, values)
+        if removed is None:
+            return None
+        course_teachers = await _course_teachers(database, [course_id])
+        await _apply_stats(database, stats.enrollments_changed([values], course_teachers, -1))
+
+    logger.info("Removed enrollment for student ID: {} in course ID: {}", student_id, course_id)
+
+    return {"message": "Enrollment removed successfully"}, dict(removed._mapping)
+
+@handle_async_exceptions(ERROR_RETRIEVE_ENROLLMENTS)
+async def retrieve_enrollments(database: Database, skip: int = 0, limit: int = 100, after_id: Optional[int] = None):
+    query = paginate(select(enrollment_table), enrollment_table.c.id, skip, limit, after_id)
+    return _to_dicts(await database.fetch_all(query))
+
+@handle_async_exceptions(ERROR_RETRIEVE_STUDENT_ENROLLMENTS)
+async def retrieve_student_enrollments(database: Database, student_id: int, skip: int = 0, limit: int = 100, after_id: Optional[int] = None):
+    query = paginate(select(enrollment_table).where(enrollment_table.c.student_id == student_id), enrollment_table.c.id, skip, limit, after_id)
+    return _to_dicts(await database.fetch_all(query))
@@ -0,0 +1,178 @@
+from typing import Optional
+from databases import Database
+from fastapi import APIRouter, Depends, HTTPException, Request
+from starlette.concurrency import run_in_threadpool
+from src.async_crud import *
+from src.schemas import *
+from src.database import setup_database
+from src.cache import *
+from src.serializers import join_rows, parse_fields, parse_ids, serialize_row, serialize_rows, json_response
+from src.pagination import decode_cursor, page_headers
+from src.idempotency import idempotency_key, store as idempotency_store
+
+router = APIRouter()
+
+async def get_database():
+    return setup_database()[1]
+
+async def batch_rows(table, schema, ids, fetch, fields=None):
+    ids = parse_ids(ids)
+    bodies = await async_cached_rows(table, ids, fetch, lambda row: serialize_row(schema, row, fields), fields)
+    return json_response(join_rows(bodies, ids))
+
+@router.post("/courses/", response_model=Course)
+async def create_course(course: CourseCreate, database: Database = Depends(get_database)):
+    new_course = await add_course(database=database, course=course)
+    await async_invalidate_write("course", "insert", new_course)
+    return new_course
+
+@router.put("/courses/{course_id}", response_model=Course)
+async def update_course(course_id: int, course_data: CourseCreate, database: Database = Depends(get_database)):
+    updated_course = await modify_course(database=database, course_id=course_id, course_data=course_data)
+    if updated_course is None:
+        raise HTTPException(status_code=404, detail="Course not found")
+    await async_invalidate_write("course", "update", updated_course)
+    return updated_course
+
+@router.get("/courses/", response_model=list[Course])
+async def get_courses(skip: int = 0, limit: int = 100, cursor: Optional[str] = None, ids: Optional[str] = None, database: Database = Depends(get_database)):
+    if ids is not None:
+        return await batch_rows("course", Course, ids, lambda missing: retrieve_courses_by_ids(database=database, ids=missing))
+    after_id = decode_cursor(cursor)
+
+    async def fetch():
+        courses = await retrieve_courses(database=database, skip=skip, limit=limit, after_id=after_id)
+        page = CachedResponse(serialize_rows(Course, courses), page_headers(courses, limit))
+        return page, page_dependencies("course", courses, limit, keyset=after_id is not None)
+
+    cache_key = make_cache_key("courses", skip=skip, limit=limit, after=after_id)
+    return json_response(*await async_cached(cache_key, fetch))
+
+@router.get("/courses/{course_id}", response_model=Course)
+async def get_course(course_id: int, database: Database = Depends(get_database)):
+    return await retrieve_course_by_id(database=database, course_id=course_id)
+
+@router.delete("/courses/{course_id}", status_code=204)
+async def delete_course(course_id: int, database: Database = Depends(get_database)):
+    deleted_course, orphans = await remove_course(database=database, course_id=course_id)
+    await async_invalidate_write("course", "delete", {"id": course_id})
+    # Its lessons and enrollments lost their course_id.
+    for table, rows in orphans.items():
+        await async_invalidate_writes(table, "update", rows)
+    return deleted_course
+
+@router.post("/lessons/", response_model=Lesson)
+async def create_lesson(lesson: LessonCreate, database: Database = Depends(get_database)):
+    new_lesson = await add_lesson(database=database, lesson=lesson)
+    await async_invalidate_write("lesson", "insert", new_lesson)
+    return new_lesson
+
+@router.get("/lessons/", response_model=list[Lesson])
+async def get_lessons(skip: int = 0, limit: int = 100, cursor: Optional[str] = None, ids: Optional[str] = None, database: Database = Depends(get_database)):
+    if ids is not None:
+        return await batch_rows("lesson", Lesson, ids, lambda missing: retrieve_lessons_by_ids(database=database, ids=missing))
+    after_id = decode_cursor(cursor)
+
+    async def fetch():
+        lessons = await retrieve_lessons(database=database, skip=skip, limit=limit, after_id=after_id)
+        page = CachedResponse(serialize_rows(Lesson, lessons), page_headers(lessons, limit))
+        return page, page_dependencies("lesson", lessons, limit, keyset=after_id is not None)
+
+    cache_key = make_cache_key("lessons", skip=skip, limit=limit, after=after_id)
+    return json_response(*await async_cached(cache_key, fetch))
+
+@router.get("/courses/{course_id}/lessons/", response_model=list[Lesson])
+async def get_lessons_for_course(course_id: int, skip: int = 0, limit: int = 100, cursor: Optional[str] = None, database: Database = Depends(get_database)):
+    after_id = decode_cursor(cursor)
+    lessons = await retrieve_lessons_for_course(database=database, course_id=course_id, skip=skip, limit=limit, after_id=after_id)
+    return json_response(serialize_rows(Lesson, lessons), page_headers(lessons, limit))
+
+@router.post("/students/", response_model=Student)
+async def create_student(student: StudentCreate, database: Database = Depends(get_database)):
+    new_student = await add_student(database=database, student=student)
+    await async_invalidate_write("student", "insert", new_student)
+    return new_student
+
+@router.get("/students/", response_model=list[Student])
+async def get_students(skip: int = 0, limit: int = 100, cursor: Optional[str] = None, fields: Optional[str] = None, ids: Optional[str] = None, database: Database = Depends(get_database)):
+    selected = parse_fields(Student, fields)
+    if ids is not None:
+        include_enrollments = selected is None or "enrollments" in selected
+        fetch = lambda missing: retrieve_students_by_ids(database=database, ids=missing, include_enrollments=include_enrollments)
+        return await batch_rows("student", Student, ids, fetch, selected)
+    after_id = decode_cursor(cursor)
+
+    async def fetch():
+        include_enrollments = selected is None or "enrollments" in selected
+        students = await retrieve_students(database=database, skip=skip, limit=limit, include_enrollments=include_enrollments, after_id=after_id)
+        page = CachedResponse(serialize_rows(Student, students, selected), page_headers(students, limit))
+        return page, page_dependencies("student", students, limit, keyset=after_id is not None)
+
+    cache_key = make_cache_key("students", skip=skip, limit=limit, after=after_id, fields=selected)
+    return json_response(*await async_cached(cache_key, fetch))
+
+@router.post("/teachers/", response_model=Teacher)
+async def create_teacher(teacher: TeacherCreate, database: Database = Depends(get_database)):
+    new_teacher = await add_teacher(database=database, teacher=teacher)
+    await async_invalidate_write("teacher", "insert", new_teacher)
+    return new_teacher
+
+@router.get("/teachers/", response_model=list[Teacher])
+async def get_teachers(skip: int = 0, limit: int = 100, cursor: Optional[str] = None, fields: Optional[str] = None, ids: Optional[str] = None, database: Database = Depends(get_database)):
+    selected = parse_fields(Teacher, fields)
+    if ids is not None:
+        include_courses = selected is None or "courses" in selected
+        fetch = lambda missing: retrieve_teachers_by_ids(database=database, ids=missing, include_courses=include_courses)
+        return await batch_rows("teacher", Teacher, ids, fetch, selected)
+    after_id = decode_cursor(cursor)
+
+    async def fetch():
+        include_courses = selected is None or "courses" in selected
+        teachers = await retrieve_teachers(database=database, skip=skip, limit=limit, include_courses=include_courses, after_id=after_id)
+        page = CachedResponse(serialize_rows(Teacher, teachers, selected), page_headers(teachers, limit))
+        return page, page_dependencies("teacher", teachers, limit, keyset=after_id is not None)
+
+    cache_key = make_cache_key("teachers", skip=skip, limit=limit, after=after_id, fields=selected)
+    return json_response(*await async_cached(cache_key, fetch))
+
+@router.post("/enrollments/", response_model=Enrollment)
+async def enroll_student(enrollment: EnrollmentCreate, database: Database = Depends(get_database), request: Request = None):
+    key = idempotency_key(request)
+    if key is not None:
+        replayed = await run_in_threadpool(idempotency_store.replay, "POST /enrollments/", key, enrollment.dict())
+        if replayed is not None:
+            return replayed
+
+    new_enrollment, created = await add_enrollment(database=database, enrollment=enrollment)
+    if created:
+        await async_invalidate_write("enrollment", "insert", new_enrollment)
+    if key is not None:
+        await run_in_threadpool(idempotency_store.remember, "POST /enrollments/", key, enrollment.dict(), new_enrollment)
+    return new_enrollment
+
+@router.delete("/enrollments/{student_id}/{course_id}")
+async def disenroll_student(student_id: int, course_id: int, database: Database = Depends(get_database)):
+    removed_enrollment = await remove_enrollment(database=database, student_id=student_id, course_id=course_id)
+    if removed_enrollment is None:
+        raise HTTPException(status_code=404, detail="Enrollment not found")
+    message, enrollment = removed_enrollment
+    await async_invalidate_write("enrollment", "delete", enrollment)
+    return message
+
+@router.get("/enrollments/", response_model=list[Enrollment])
+async def get_enrollments(skip: int = 0, limit: int = 100, cursor: Optional[str] = None, database: Database = Depends(get_database)):
+    after_id = decode_cursor(cursor)
+
+    async def fetch():
+        enrollments = await retrieve_enrollments(database=database, skip=skip, limit=limit, after_id=after_id)
+        page = CachedResponse(serialize_rows(Enrollment, enrollments), page_headers(enrollments, limit))
+        return page, page_dependencies("enrollment", enrollments, limit, keyset=after_id is not None)
+
+    cache_key = make_cache_key("enrollments", skip=skip, limit=limit, after=after_id)
+    return json_response(*await async_cached(cache_key, fetch))
+
+@router.get("/students/{student_id}/enrollments/", response_model=list[Enrollment])
+async def get_student_enrollments(student_id: int, skip: int = 0, limit: int = 100, cursor: Optional[str] = None, database: Database = Depends(get_database)):
+    after_id = decode_cursor(cursor)
+    enrollments = await retrieve_student_enrollments(database=database, student_id=student_id, skip=skip, limit=limit, after_id=after_id)
+    return json_response(serialize_rows(Enrollment, enrollments), page_headers(enrollments, limit))
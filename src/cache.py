@@ -1,13 +1,626 @@
-from cachetools import TTLCache
+import asyncio
+import json
+import os
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from collections.abc import Mapping
+from cachetools import Cache, TTLCache
+from cachetools.keys import hashkey
+from dotenv import load_dotenv
+from starlette.concurrency import run_in_threadpool
+from src.compression import precompress
 
-cache = TTLCache(maxsize=1000, ttl=60)
+load_dotenv()
+
+CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL", "")
+# Turning the response cache off makes every lookup a miss (used to measure
+# the uncached paths).
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "true").lower() == "true"
+# Seconds an expired entry may still be served while one background refresh
+# replaces it (0 disables stale-while-revalidate). An endpoint can override
+# it with a "stale" key in CACHE_SETTINGS.
+CACHE_STALE_SECONDS = float(os.getenv("CACHE_STALE_SECONDS", "0"))
+# Longest a request waits on another request's fetch of the same key before
+# fetching for itself.
+CACHE_FILL_TIMEOUT = float(os.getenv("CACHE_FILL_TIMEOUT", "30"))
+
+DEFAULT_CACHE_SETTINGS = {"ttl": 60, "maxsize": 1000}
+
+# Per-endpoint TTL (seconds) and entry bound; endpoints not listed fall back
+# to DEFAULT_CACHE_SETTINGS.
+CACHE_SETTINGS = {
+    "courses": {"ttl": 60, "maxsize": 256},
+    "lessons": {"ttl": 60, "maxsize": 256},
+    "students": {"ttl": 30, "maxsize": 512},
+    "teachers": {"ttl": 60, "maxsize": 256},
+    "enrollments": {"ttl": 30, "maxsize": 512},
+    # Per-entity entries behind the batch reads (`?ids=`), one row each.
+    "course": {"ttl": 60, "maxsize": 4096},
+    "lesson": {"ttl": 60, "maxsize": 4096},
+    "student": {"ttl": 30, "maxsize": 4096},
+    "teacher": {"ttl": 60, "maxsize": 4096},
+}
+ENTITY_TABLES = ("course", "lesson", "student", "teacher")
+
+# With a shared backend configured the in-process caches become a small L1
+# tier; its short TTL bounds staleness should an invalidation message be lost.
+L1_CACHE_SETTINGS = {"ttl": 5, "maxsize": 128}
+
+# Collections that src/schemas.py nests into a parent's serialized form:
+# (parent table, attribute, child table, foreign key on the child).
+NESTED_COLLECTIONS = [
+    ("teacher", "courses", "course", "teacher_id"),
+    ("student", "enrollments", "enrollment", "student_id"),
+]
+
+# Table-level dependency tags. Every offset page depends on ALL_ROWS, since a
+# delete shifts the pages after it; only pages shorter than their limit can
+# receive a newly inserted row, so only those depend on NEW_ROWS.
+ALL_ROWS = "*"
+NEW_ROWS = "+"
+
+# Cached list responses: the serialized JSON body plus the headers sent with
+# it, and the body's compressed encodings once stored (None while not yet
+# compressed, or when too small to be). Only the plain body goes to the shared
+# backend; each worker compresses its L1 copy once.
+CachedResponse = namedtuple("CachedResponse", ["body", "headers", "encodings"], defaults=(None,))
+
+# What the in-process caches hold: the value and when it stops being fresh
+# (time.monotonic()); between then and the TTL it is only served stale.
+Entry = namedtuple("Entry", ["value", "fresh_until"])
+
+caches = {}
+dependents = defaultdict(set)
+key_dependencies = {}
+backend = None
+# Guards caches, dependents, key_dependencies and generation: request
+# threads, the refresh executor and the Redis invalidation listener all
+# change them. Reentrant, as storing an entry may evict another.
+local_lock = threading.RLock()
+
+# Per-endpoint lookup and eviction counts, exported by src/metrics.py.
+cache_stats = defaultdict(Counter)
+
+# Fetches in progress, so concurrent misses on one key share a single query.
+flights = {}
+flights_lock = threading.Lock()
+async_flights = {}
+refresh_tasks = set()
+refresh_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="cache-refresh")
+# Bumped by every invalidation; a fetch that started before one must not
+# store its possibly outdated result.
+generation = 0
+# time.monotonic() of the latest invalidation, this worker's own or one
+# broadcast by another.
+last_invalidation = float("-inf")
+
+# Per-table write counters behind the ETags in src/http_cache.py. The epoch
+# sets apart counters kept by different processes (or a reset Redis), so the
+# same number never vouches for two different states of a table.
+table_versions = Counter()
+version_epoch = uuid.uuid4().hex[:12]
+
+class CountingTTLCache(TTLCache):
+    """TTLCache that counts entries dropped by expiry and by the size bound."""
+
+    def __init__(self, endpoint, maxsize, ttl):
+        super().__init__(maxsize=maxsize, ttl=ttl)
+        self.endpoint = endpoint
+
+    def expire(self, time=None):
+        # Cache.__len__ reads the raw size; TTLCache's own size accessors call expire().
+        size = Cache.__len__(self)
+        super().expire(time)
+        expired = size - Cache.__len__(self)
+        if expired:
+            cache_stats[self.endpoint]["expired"] += expired
+
+    def popitem(self):
+        item = super().popitem()
+        cache_stats[self.endpoint]["evicted"] += 1
+        _forget(item[0])
+        return item
+
+class RedisBackend:
+    """Cache entries shared by every worker and container through Redis.
+
+    Entries are stored together with their dependency tags, so a worker that
+    copies one into its L1 can still evict it when another worker publishes
+    an invalidation for one of those tags.
+    """
+
+    prefix = "focusedai:cache:"
+    channel = "focusedai:cache:invalidate"
+
+    def __init__(self, client):
+        self.client = client
+        # Dependency sets must outlive every entry they point at.
+        self.dependency_ttl = max(
+            settings["ttl"] for settings in [DEFAULT_CACHE_SETTINGS, *CACHE_SETTINGS.values()]
+        )
+
+    @classmethod
+    def from_url(cls, url):
+        import redis
+
+        return cls(redis.Redis.from_url(url))
+
+    def _key(self, key):
+        return f"{self.prefix}entry:{tuple(key)!r}"
+
+    def _tag(self, tag):
+        return f"{self.prefix}dependency:{tag[0]}:{tag[1]}"
+
+    def _version(self, table):
+        return f"{self.prefix}version:{table}"
+
+    def versions(self, tables):
+        epoch_key = f"{self.prefix}version:epoch"
+        epoch, *values = self.client.mget([epoch_key, *[self._version(table) for table in tables]])
+        if epoch is None:
+            self.client.set(epoch_key, uuid.uuid4().hex[:12], nx=True)
+            epoch = self.client.get(epoch_key)
+        return epoch.decode(), [int(value or 0) for value in values]
+
+    def _decode(self, blob):
+        if blob is None:
+            return None
+        meta, _, body = blob.partition(b"\n")
+        meta = json.loads(meta)
+        dependencies = {tuple(tag) for tag in meta["dependencies"]}
+        return CachedResponse(body, meta["headers"]), dependencies
+
+    def _queue_set(self, pipeline, key, value, ttl, dependencies):
+        name = self._key(key)
+        meta = json.dumps({"dependencies": list(dependencies), "headers": value.headers})
+        pipeline.set(name, meta.encode() + b"\n" + value.body, ex=ttl)
+        for tag in dependencies:
+            pipeline.sadd(self._tag(tag), name)
+            pipeline.expire(self._tag(tag), self.dependency_ttl)
+
+    def get(self, key):
+        return self._decode(self.client.get(self._key(key)))
+
+    def get_many(self, keys):
+        # One MGET; None in place of each missing entry.
+        return [self._decode(blob) for blob in self.client.mget([self._key(key) for key in keys])]
+
+    def set(self, key, value, ttl, dependencies):
+        self.set_many([(key, value, ttl, dependencies)])
+
+    def set_many(self, entries):
+        # (key, value, ttl, dependencies) entries, written in one pipeline.
+        pipeline = self.client.pipeline(transaction=False)
+        for entry in entries:
+            self._queue_set(pipeline, *entry)
+        pipeline.execute()
+
+    def delete(self, key):
+        self.client.delete(self._key(key))
+
+    def invalidate(self, tags):
+        tag_names = [self._tag(tag) for tag in tags]
+        pipeline = self.client.pipeline(transaction=False)
+        for name in tag_names:
+            pipeline.smembers(name)
+        names = set().union(*pipeline.execute())
+
+        pipeline = self.client.pipeline(transaction=False)
+        pipeline.delete(*names, *tag_names)
+        for table in {tag[0] for tag in tags}:
+            pipeline.incr(self._version(table))
+        pipeline.publish(self.channel, json.dumps(list(tags)))
+        pipeline.execute()
+
+    def subscribe(self, callback):
+        def handle(message):
+            callback({tuple(tag) for tag in json.loads(message["data"])})
+
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{self.channel: handle})
+        return pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+def _settings(endpoint):
+    return CACHE_SETTINGS.get(endpoint, DEFAULT_CACHE_SETTINGS)
+
+def _local_ttl(endpoint):
+    ttl = _settings(endpoint)["ttl"]
+    return min(ttl, L1_CACHE_SETTINGS["ttl"]) if backend is not None else ttl
+
+def _stale_seconds(endpoint):
+    return _settings(endpoint).get("stale", CACHE_STALE_SECONDS)
+
+def _cache_for(endpoint):
+    if endpoint not in caches:
+        maxsize = _settings(endpoint)["maxsize"]
+        if backend is not None:
+            maxsize = min(maxsize, L1_CACHE_SETTINGS["maxsize"])
+        ttl = _local_ttl(endpoint) + _stale_seconds(endpoint)
+        caches[endpoint] = CountingTTLCache(endpoint, maxsize=maxsize, ttl=ttl)
+    return caches[endpoint]
+
+def _field(row, name):
+    if isinstance(row, Mapping):
+        return row.get(name)
+    return getattr(row, name, None)
+
+def _forget(key):
+    for tag in key_dependencies.pop(key, ()):
+        keys = dependents.get(tag)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del dependents[tag]
+
+def _prune():
+    # Evicted entries forget their dependencies in popitem; expired ones never
+    # pass through here, so their records are swept once they make up half
+    # of all records, which keeps the scan's cost per store constant.
+    for key in [key for key in key_dependencies if key not in _cache_for(key[0])]:
+        _forget(key)
+
+def make_cache_key(endpoint, **params):
+    # Omitted optional parameters and their None default share one entry.
+    return hashkey(endpoint, *sorted((name, value) for name, value in params.items() if value is not None))
+
+def row_dependencies(table, row):
+    # The row itself and the rows nested into it; a child inserted into the
+    # collection evicts through the parent's own tag (see _write_tags).
+    tags = {(table, _field(row, "id"))}
+    for parent, attribute, child, _ in NESTED_COLLECTIONS:
+        if parent == table:
+            for child_row in _field(row, attribute) or ():
+                tags.add((child, _field(child_row, "id")))
+    return tags
+
+def page_dependencies(table, rows, limit, keyset=False):
+    # A keyset page starts after a fixed id, so deletes elsewhere in the
+    # table cannot shift it; it only depends on its own rows.
+    tags = set() if keyset else {(table, ALL_ROWS)}
+    if len(rows) < limit:
+        tags.add((table, NEW_ROWS))
+    for row in rows:
+        tags |= row_dependencies(table, row)
+    return tags
+
+def _encoded(value):
+    if isinstance(value, CachedResponse) and value.encodings is None:
+        encodings = precompress(value.body)
+        if encodings is not None:
+            return value._replace(encodings=encodings)
+    return value
+
+def _store_local(key, value, dependencies, started=None):
+    """Store `value` unless an invalidation happened since generation
+    `started` (when given); returns whether it was stored."""
+    # Entity entries are spliced into batch responses, never sent alone.
+    if key[0] not in ENTITY_TABLES:
+        value = _encoded(value)
+    with local_lock:
+        if started is not None and generation != started:
+            return False
+        _forget(key)
+        _cache_for(key[0])[key] = Entry(value, time.monotonic() + _local_ttl(key[0]))
+        if dependencies:
+            if len(key_dependencies) >= 2 * sum(cache.maxsize for cache in caches.values()):
+                _prune()
+            key_dependencies[key] = set(dependencies)
+            for tag in dependencies:
+                dependents[tag].add(key)
+    return True
+
+def _delete_local(key):
+    with local_lock:
+        _forget(key)
+        cache = _cache_for(key[0])
+        if key in cache:
+            del cache[key]
+            cache_stats[key[0]]["invalidated"] += 1
+
+def _invalidate_local(tags):
+    global generation, last_invalidation
+    with local_lock:
+        generation += 1
+        last_invalidation = time.monotonic()
+        for tag in tags:
+            for key in list(dependents.get(tag, ())):
+                _delete_local(key)
+
+def configure_cache(shared_backend):
+    """Put `shared_backend` (or None for process-local caching only) behind
+    the in-process caches and start listening for other workers' evictions."""
+    global backend
+    backend = shared_backend
+    with local_lock:
+        caches.clear()
+        cache_stats.clear()
+        dependents.clear()
+        key_dependencies.clear()
+    if backend is not None:
+        return backend.subscribe(_invalidate_local)
+
+def _lookup_local(key):
+    with local_lock:
+        entry = _cache_for(key[0]).get(key)
+    if entry is None:
+        return None, False
+    return entry.value, time.monotonic() < entry.fresh_until
+
+def _lookup_shared(key):
+    shared = backend.get(key)
+    if shared is None:
+        return None, False
+    value, dependencies = shared
+    _store_local(key, value, dependencies)
+    cache_stats[key[0]]["shared_hit"] += 1
+    return value, True
+
+def _lookup(key):
+    # (value, fresh) from the local cache, then the shared backend.
+    value, fresh = _lookup_local(key)
+    if value is None and backend is not None:
+        return _lookup_shared(key)
+    return value, fresh
+
+async def _async_lookup(key):
+    value, fresh = _lookup_local(key)
+    if value is None and backend is not None:
+        return await run_in_threadpool(_lookup_shared, key)
+    return value, fresh
+
+async def _offload(func, *args):
+    # The redis client blocks; with a shared backend configured, calls that
+    # reach it run in the threadpool instead of stalling the event loop.
+    if backend is not None:
+        return await run_in_threadpool(func, *args)
+    return func(*args)
 
 def get_cache(key):
-    return cache.get(key)
+    """The fresh cached value for `key`, or None."""
+    stats = cache_stats[key[0]]
+    value, fresh = _lookup(key) if CACHE_ENABLED else (None, False)
+    if not fresh:
+        value = None
+    stats["hit" if value is not None else "miss"] += 1
+    return value
+
+def set_cache(key, value, dependencies=(), started=None):
+    # See _store_local for `started`.
+    if not CACHE_ENABLED or not _store_local(key, value, dependencies, started):
+        return
+    if backend is not None:
+        backend.set(key, value, _settings(key[0])["ttl"], dependencies)
 
-def set_cache(key, value):
-    cache[key] = value
+def set_caches(entries, started=None):
+    """set_cache for several (key, value, dependencies) entries, sent to the
+    shared backend in one round trip."""
+    if not CACHE_ENABLED:
+        return
+    stored = [entry for entry in entries if _store_local(*entry, started)]
+    if backend is not None and stored:
+        backend.set_many([(key, value, _settings(key[0])["ttl"], dependencies) for key, value, dependencies in stored])
 
 def delete_cache(key):
-    if key in cache:
-        del cache[key]
\ No newline at end of file
+    _delete_local(key)
+    if backend is not None:
+        backend.delete(key)
+
+def _fill(key, fill):
+    started = generation
+    value, dependencies = fill()
+    value = _encoded(value)
+    set_cache(key, value, dependencies, started)
+    return value
+
+def _single_flight(key, fill):
+    with flights_lock:
+        flight = flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = flights[key] = {"done": threading.Event()}
+    if not leader:
+        cache_stats[key[0]]["coalesced"] += 1
+        if not flight["done"].wait(CACHE_FILL_TIMEOUT):
+            return _fill(key, fill)
+        if "error" in flight:
+            raise flight["error"]
+        return flight["value"]
+
+    try:
+        flight["value"] = _fill(key, fill)
+        return flight["value"]
+    except Exception as e:
+        flight["error"] = e
+        raise
+    finally:
+        with flights_lock:
+            del flights[key]
+        flight["done"].set()
+
+def _refresh(key, refresh):
+    with flights_lock:
+        if key in flights:
+            return
+    cache_stats[key[0]]["stale"] += 1
+    refresh_executor.submit(_single_flight, key, refresh)
+
+def cached(key, fill, refresh=None):
+    """The cached value for `key`, filled on a miss by `fill()`, which
+    returns (value, dependencies).
+
+    Concurrent misses on the same key wait for one caller's fill instead of
+    each querying the database. With stale-while-revalidate on, an expired
+    entry is returned as is while `refresh` (same contract as `fill`, but
+    it must not rely on anything scoped to the current request) replaces it
+    in the background.
+    """
+    if not CACHE_ENABLED:
+        cache_stats[key[0]]["miss"] += 1
+        return fill()[0]
+
+    value, fresh = _lookup(key)
+    if value is not None and (fresh or refresh is not None):
+        cache_stats[key[0]]["hit"] += 1
+        if not fresh:
+            _refresh(key, refresh)
+        return value
+    cache_stats[key[0]]["miss"] += 1
+    return _single_flight(key, fill)
+
+async def _async_fill(key, fill):
+    started = generation
+    value, dependencies = await fill()
+    value = _encoded(value)
+    await _offload(set_cache, key, value, dependencies, started)
+    return value
+
+async def _async_single_flight(key, fill):
+    # Async routes all run on one event loop, so a future is enough.
+    flight = async_flights.get(key)
+    if flight is not None:
+        cache_stats[key[0]]["coalesced"] += 1
+        return await asyncio.shield(flight)
+
+    flight = async_flights[key] = asyncio.get_running_loop().create_future()
+    try:
+        value = await _async_fill(key, fill)
+        flight.set_result(value)
+        return value
+    except Exception as e:
+        flight.set_exception(e)
+        # Waiters get the error; don't leave it unretrieved when there are none.
+        flight.exception()
+        raise
+    finally:
+        del async_flights[key]
+
+async def async_cached(key, fill):
+    """`cached` for async routes: `fill` is a coroutine function, and the
+    stale refresh runs as a task on the event loop."""
+    if not CACHE_ENABLED:
+        cache_stats[key[0]]["miss"] += 1
+        return (await fill())[0]
+
+    value, fresh = await _async_lookup(key)
+    if value is not None:
+        cache_stats[key[0]]["hit"] += 1
+        if not fresh and key not in async_flights:
+            cache_stats[key[0]]["stale"] += 1
+            task = asyncio.get_running_loop().create_task(_async_single_flight(key, fill))
+            refresh_tasks.add(task)
+            # A failed refresh leaves the stale entry to expire; its error was
+            # already logged by the CRUD layer.
+            task.add_done_callback(lambda done: refresh_tasks.discard(done) or done.cancelled() or done.exception())
+        return value
+    cache_stats[key[0]]["miss"] += 1
+    return await _async_single_flight(key, fill)
+
+def _cached_rows(table, ids, fields):
+    # Hits from L1, then a single backend round trip for the L1 misses.
+    keys = {row_id: make_cache_key(table, id=row_id, fields=fields) for row_id in dict.fromkeys(ids)}
+    bodies, missing, shared = {}, [], []
+    for row_id, key in keys.items():
+        value, fresh = _lookup_local(key) if CACHE_ENABLED else (None, False)
+        if fresh:
+            bodies[row_id] = value.body
+        elif value is None and backend is not None and CACHE_ENABLED:
+            shared.append(row_id)
+        else:
+            missing.append(row_id)
+    if shared:
+        for row_id, found in zip(shared, backend.get_many([keys[row_id] for row_id in shared])):
+            if found is None:
+                missing.append(row_id)
+                continue
+            value, dependencies = found
+            _store_local(keys[row_id], value, dependencies)
+            cache_stats[table]["shared_hit"] += 1
+            bodies[row_id] = value.body
+    cache_stats[table]["hit"] += len(bodies)
+    cache_stats[table]["miss"] += len(missing)
+    return bodies, missing
+
+def _store_rows(table, rows, serialize, fields, started, bodies):
+    entries = []
+    for row in rows:
+        body = serialize(row)
+        bodies[row["id"]] = body
+        entries.append((make_cache_key(table, id=row["id"], fields=fields), CachedResponse(body, {}), row_dependencies(table, row)))
+    set_caches(entries, started)
+    return bodies
+
+def cached_rows(table, ids, fetch, serialize, fields=None):
+    """{id: serialized row} for the `ids` of `table`: hits from the
+    per-entity cache, the rest from a single `fetch(missing_ids)` returning
+    row mappings. Ids without a row are left out."""
+    started = generation
+    bodies, missing = _cached_rows(table, ids, fields)
+    if not missing:
+        return bodies
+    return _store_rows(table, fetch(missing), serialize, fields, started, bodies)
+
+async def async_cached_rows(table, ids, fetch, serialize, fields=None):
+    started = generation
+    bodies, missing = await _offload(_cached_rows, table, ids, fields)
+    if not missing:
+        return bodies
+    return await _offload(_store_rows, table, await fetch(missing), serialize, fields, started, bodies)
+
+def seconds_since_invalidation():
+    return time.monotonic() - last_invalidation
+
+def versions(tables):
+    """(epoch, [write counter per table]) for building an ETag."""
+    if backend is not None:
+        return backend.versions(tables)
+    return version_epoch, [table_versions[table] for table in tables]
+
+def invalidate(*tags):
+    table_versions.update({tag[0] for tag in tags})
+    _invalidate_local(tags)
+    if backend is not None:
+        backend.invalidate(tags)
+
+def _write_tags(table, action, row):
+    row_id = _field(row, "id")
+    tags = set()
+    if row_id is not None:
+        tags.add((table, row_id))
+    if action == "insert":
+        tags.add((table, NEW_ROWS))
+    elif action == "delete":
+        tags.add((table, ALL_ROWS))
+    for parent, _, child, foreign_key in NESTED_COLLECTIONS:
+        parent_id = _field(row, foreign_key)
+        if child == table and parent_id is not None:
+            tags.add((parent, parent_id))
+    return tags
+
+def invalidate_write(table, action, row):
+    """Evict the cached entries affected by an "insert", "update" or "delete"
+    of `row` in `table`, including parents that nest it as a collection."""
+    invalidate(*_write_tags(table, action, row))
+
+def invalidate_writes(table, action, rows):
+    # One eviction pass (and one broadcast) for a whole batch.
+    tags = set()
+    for row in rows:
+        tags |= _write_tags(table, action, row)
+    if tags:
+        invalidate(*tags)
+
+async def async_invalidate_write(table, action, row):
+    """invalidate_write for async routes."""
+    await _offload(invalidate_write, table, action, row)
+
+async def async_invalidate_writes(table, action, rows):
+    await _offload(invalidate_writes, table, action, rows)
+
+def configure_shared_cache():
+    """Connect the shared backend named by CACHE_REDIS_URL, if any; called
+    once the server starts rather than on import."""
+    if CACHE_REDIS_URL and backend is None:
+        configure_cache(RedisBackend.from_url(CACHE_REDIS_URL))
@@ -0,0 +1,152 @@
+import os
+import zlib
+from dotenv import load_dotenv
+from fastapi import Response
+from src.routing import request_header
+
+try:
+    import brotli
+except ImportError:  # optional: without it only gzip is offered
+    brotli = None
+
+load_dotenv()
+
+# Bodies smaller than this go out uncompressed: the saving would not pay for
+# the CPU and the encoding headers.
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSION_GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", "6"))
+COMPRESSION_BROTLI_QUALITY = int(os.getenv("COMPRESSION_BROTLI_QUALITY", "5"))
+
+# Offered encodings, most preferred first when the client rates them equally.
+ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+
+# Only text-like bodies shrink enough to be worth it.
+COMPRESSIBLE_TYPES = ("application/json", "text/")
+
+def negotiate(accept_encoding, available=ENCODINGS):
+    """The encoding to answer an Accept-Encoding header with, or None for
+    the identity encoding."""
+    if not accept_encoding:
+        return None
+    weights = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        weight = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[name.strip().lower()] = weight
+    best, best_weight = None, 0.0
+    for encoding in available:
+        weight = weights.get(encoding, weights.get("*", 0.0))
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
+
+def compressor(encoding):
+    if encoding == "br":
+        return brotli.Compressor(quality=COMPRESSION_BROTLI_QUALITY)
+    # wbits 16 + MAX_WBITS writes the gzip container rather than raw zlib.
+    return zlib.compressobj(COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+def compress(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=COMPRESSION_BROTLI_QUALITY)
+    stream = compressor(encoding)
+    return stream.compress(body) + stream.flush()
+
+def precompress(body, minimum_size=COMPRESSION_MIN_SIZE):
+    """Every offered encoding of `body`, or None if it is too small to be
+    compressed."""
+    if len(body) < minimum_size:
+        return None
+    return {encoding: compress(body, encoding) for encoding in ENCODINGS}
+
+def _compressible(headers):
+    content_type = ""
+    for name, value in headers:
+        if name == b"content-encoding":
+            return False
+        if name == b"content-type":
+            content_type = value.decode("latin-1")
+    return content_type.startswith(COMPRESSIBLE_TYPES)
+
+def _encoded_headers(headers, encoding, length=None):
+    headers = [(name, value) for name, value in headers if name != b"content-length"]
+    headers.append((b"content-encoding", encoding.encode()))
+    headers.append((b"vary", b"Accept-Encoding"))
+    if length is not None:
+        headers.append((b"content-length", str(length).encode()))
+    return headers
+
+class PrecompressedResponse(Response):
+    """A response carrying ready-made encodings of its body (see
+    `precompress`); the one the client accepts is sent as is, so a cached
+    page is compressed once rather than on every hit."""
+
+    def __init__(self, content, encodings, **kwargs):
+        self.encodings = encodings
+        super().__init__(content=content, **kwargs)
+
+    async def __call__(self, scope, receive, send):
+        encoding = negotiate(request_header(scope, b"accept-encoding"), tuple(self.encodings))
+        if encoding is not None:
+            self.body = self.encodings[encoding]
+            self.raw_headers = _encoded_headers(self.raw_headers, encoding, len(self.body))
+        else:
+            self.raw_headers.append((b"vary", b"Accept-Encoding"))
+        await super().__call__(scope, receive, send)
+
+class CompressionMiddleware:
+    """ASGI middleware compressing JSON and text responses of at least
+    `minimum_size` bytes (or streamed ones) with the best encoding the client
+    accepts. Responses that already carry a Content-Encoding pass through."""
+
+    def __init__(self, app, minimum_size=COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        encoding = negotiate(request_header(scope, b"accept-encoding")) if scope["type"] == "http" else None
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+        stream = None
+
+        async def send_compressed(message):
+            nonlocal start, stream
+            if message["type"] == "http.response.start":
+                if _compressible(message.get("headers", [])):
+                    # Held back until the first body chunk shows whether
+                    # the response is big enough, or streamed.
+                    start = message
+                    return
+            elif message["type"] == "http.response.body" and start is not None:
+                body = message.get("body", b"")
+                more_body = message.get("more_body", False)
+                if stream is None:
+                    headers = start.get("headers", [])
+                    if not more_body and len(body) < self.minimum_size:
+                        await send(start)
+                        start = None
+                    elif not more_body:
+                        body = compress(body, encoding)
+                        await send({**start, "headers": _encoded_headers(headers, encoding, len(body))})
+                        start = None
+                    else:
+                        stream = compressor(encoding)
+                        await send({**start, "headers": _encoded_headers(headers, encoding)})
+                if stream is not None:
+                    if encoding == "br":
+                        body = stream.process(body) + (b"" if more_body else stream.finish())
+                    else:
+                        body = stream.compress(body) + (b"" if more_body else stream.flush())
+                message = {**message, "body": body}
+            await send(message)
+
+        await self.app(scope, receive, send_compressed)
@@ -1,18 +1,36 @@
 from functools import wraps
+from typing import List, Optional
+from sqlalchemy import text
 from sqlalchemy.orm import Session
+from src import search, stats
 from src.models import (
     Course as DBCourse,
     Teacher as DBTeacher,
     Lesson as DBLesson,
     Student as DBStudent,
     Enrollment as DBEnrollment,
+    CourseStats as DBCourseStats,
+    TeacherStats as DBTeacherStats,
 )
 
 from src.schemas import *
 from loguru import logger
 from src.errors import *
 
-logger.add("monitoring/app.log", rotation="500 MB", backtrace=True, diagnose=True)
+# Single statements, so concurrent requests for the same (student, course)
+# cannot both insert it or both delete it; the unique index arbitrates.
+INSERT_ENROLLMENT = (
+    "INSERT INTO enrollment (student_id, course_id) VALUES (:student_id, :course_id) "
+    "ON CONFLICT (student_id, course_id) DO NOTHING RETURNING id, student_id, course_id"
+)
+# Rows per multi-row INSERT in add_enrollments_bulk, well below SQLite's
+# bound parameter limit.
+BULK_INSERT_CHUNK = 1000
+
+DELETE_ENROLLMENT = (
+    "DELETE FROM enrollment WHERE student_id = :student_id AND course_id = :course_id "
+    "RETURNING id, student_id, course_id"
+)
 
 def handle_exceptions(message):
     def decorator(func):
@@ -21,25 +39,112 @@ def handle_exceptions(message):
             try:
                 return func(*args, **kwargs)
             except Exception as e:
-                logger.error(f"{message}: {str(e)}")
+                logger.error("{}: {}", message, e)
                 raise
 
         return wrapper
 
     return decorator
 
+def paginate(query, id_column, skip: int, limit: int, after_id=None):
+    # Keyset mode seeks past after_id through the primary key index instead
+    # of scanning and discarding `skip` rows.
+    query = query.order_by(id_column)
+    if after_id is not None:
+        query = query.filter(id_column > after_id)
+    else:
+        query = query.offset(skip)
+    return query.limit(limit).all()
+
+def _to_dicts(rows):
+    return [dict(row._mapping) for row in rows]
+
+def _columns(model):
+    # Selecting plain columns skips building and tracking ORM instances,
+    # which list pages only serialize anyway.
+    return list(model.__table__.columns)
+
+def _by_ids(db: Session, model, ids):
+    return _to_dicts(db.query(*_columns(model)).filter(model.id.in_(list(ids))))
+
+def _fetch_children(db: Session, model, foreign_key: str, parents: list, attribute: str):
+    # One IN query for the whole page instead of a lazy load per parent row.
+    for parent in parents:
+        parent[attribute] = []
+    if not parents:
+        return parents
+
+    by_id = {parent["id"]: parent for parent in parents}
+    column = getattr(model, foreign_key)
+    query = db.query(*_columns(model)).filter(column.in_(list(by_id))).order_by(model.id)
+    for child in _to_dicts(query):
+        by_id[child[foreign_key]][attribute].append(child)
+    return parents
+
+def _missing_references(db: Session, model, rows: list):
+    """Map the index of each row whose foreign keys point at no existing row
+    to errors shaped like pydantic's, with one IN query per foreign key."""
+    errors = {}
+    for column in model.__table__.columns:
+        for foreign_key in column.foreign_keys:
+            target = foreign_key.column
+            wanted = {row[column.name] for row in rows if row.get(column.name) is not None}
+            if not wanted:
+                continue
+            existing = {value for (value,) in db.query(target).filter(target.in_(wanted))}
+            for index, row in enumerate(rows):
+                value = row.get(column.name)
+                if value is not None and value not in existing:
+                    errors.setdefault(index, []).append({
+                        "loc": [column.name],
+                        "msg": f"{target.table.name} {value} does not exist",
+                        "type": "value_error.missing_reference",
+                    })
+    return errors
+
+def _apply_stats(db: Session, changes):
+    # Counter updates ride in the caller's transaction; see src/stats.py.
+    for statement, params in changes:
+        db.execute(text(statement), params)
+
+def _course_teachers(db: Session, course_ids):
+    return dict(db.query(DBCourse.id, DBCourse.teacher_id).filter(DBCourse.id.in_(set(course_ids))).all())
+
+def _enrolled_students(db: Session, course_id: int):
+    return [student_id for (student_id,) in db.query(DBEnrollment.student_id).filter(DBEnrollment.course_id == course_id)]
+
+def _add_bulk(db: Session, model, items: list, stats_changes=None):
+    rows = [item.dict() for item in items]
+    errors = _missing_references(db, model, rows)
+    pending = [(row, model(**row)) for index, row in enumerate(rows) if index not in errors]
+    db.add_all([db_row for _, db_row in pending])
+    # The psycopg2 dialect sends the whole flush as batched multi-row
+    # INSERT ... RETURNING id statements inside this one transaction.
+    db.flush()
+    created = [{**row, "id": db_row.id} for row, db_row in pending]
+    if stats_changes is not None and created:
+        _apply_stats(db, stats_changes(created))
+    db.commit()
+    return created, errors
+
 @handle_exceptions(ERROR_ADD_COURSE)
 def add_course(db: Session, course: CourseCreate):
     db_course = DBCourse(**course.dict())
     db.add(db_course)
+    db.flush()
+    _apply_stats(db, stats.course_added(db_course.id, db_course.teacher_id))
     db.commit()
     db.refresh(db_course)
-    logger.info(f"Added course: {course.name} with ID: {db_course.id}")
+    logger.info("Added course: {} with ID: {}", course.name, db_course.id)
     return db_course
 
 @handle_exceptions(ERROR_RETRIEVE_COURSES)
-def retrieve_courses(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(DBCourse).offset(skip).limit(limit).all()
+def retrieve_courses(db: Session, skip: int = 0, limit: int = 100, after_id: Optional[int] = None):
+    return _to_dicts(paginate(db.query(*_columns(DBCourse)), DBCourse.id, skip, limit, after_id))
+
+@handle_exceptions(ERROR_RETRIEVE_COURSES)
+def retrieve_courses_by_ids(db: Session, ids: List[int]):
+    return _by_ids(db, DBCourse, ids)
 
 @handle_exceptions(ERROR_RETRIEVE_COURSE_BY_ID)
 def retrieve_course_by_id(db: Session, course_id: int):
@@ -47,23 +152,37 @@ def retrieve_course_by_id(db: Session, course_id: int):
 
 @handle_exceptions(ERROR_MODIFY_COURSE)
 def modify_course(db: Session, course_id: int, course_data: CourseCreate):
+    """Returns None when there is no such course."""
     db_course = db.query(DBCourse).filter(DBCourse.id == course_id).first()
+    if db_course is None:
+        return None
+    old_teacher_id = db_course.teacher_id
     for key, value in course_data.dict().items():
         setattr(db_course, key, value)
+    if db_course.teacher_id != old_teacher_id:
+        _apply_stats(db, stats.course_moved(_enrolled_students(db, course_id), old_teacher_id, db_course.teacher_id))
     db.commit()
     db.refresh(db_course)
 
-    logger.info(f"Updated course with ID: {course_id}")
+    logger.info("Updated course with ID: {}", course_id)
     
     return db_course
 
 @handle_exceptions(ERROR_REMOVE_COURSE)
 def remove_course(db: Session, course_id: int):
+    """Delete the course; its lessons and enrollments stay, with course_id
+    set to NULL. Returns the message and those rows, as they were, by table."""
     db_course = db.query(DBCourse).filter(DBCourse.id == course_id).first()
+    orphans = {
+        "lesson": _to_dicts(db.query(*_columns(DBLesson)).filter(DBLesson.course_id == course_id)),
+        "enrollment": _to_dicts(db.query(*_columns(DBEnrollment)).filter(DBEnrollment.course_id == course_id)),
+    }
+    student_ids = [enrollment["student_id"] for enrollment in orphans["enrollment"]]
     db.delete(db_course)
+    _apply_stats(db, stats.course_removed(course_id, student_ids, db_course.teacher_id))
     db.commit()
-    logger.info(f"Deleted course with ID: {course_id}")
-    return f"Course with ID {course_id} has been deleted"
+    logger.info("Deleted course with ID: {}", course_id)
+    return f"Course with ID {course_id} has been deleted", orphans
 
 @handle_exceptions(ERROR_ADD_STUDENT)
 def add_student(db: Session, student: StudentCreate):
@@ -72,73 +191,200 @@ def add_student(db: Session, student: StudentCreate):
     db.commit()
     db.refresh(db_student)
     
-    logger.info(f"Added student: {student.username} with ID: {db_student.id}")
+    logger.info("Added student: {} with ID: {}", student.username, db_student.id)
     
     return db_student
 
+@handle_exceptions(ERROR_ADD_STUDENTS_BULK)
+def add_students_bulk(db: Session, students: List[StudentCreate]):
+    created, errors = _add_bulk(db, DBStudent, students)
+    logger.info("Added {} students in bulk, rejected {}", len(created), len(errors))
+    return created, errors
+
+@handle_exceptions(ERROR_RETRIEVE_STUDENTS)
+def retrieve_students(db: Session, skip: int = 0, limit: int = 100, include_enrollments: bool = True, after_id: Optional[int] = None):
+    students = _to_dicts(paginate(db.query(*_columns(DBStudent)), DBStudent.id, skip, limit, after_id))
+    if not include_enrollments:
+        return students
+    return _fetch_children(db, DBEnrollment, "student_id", students, "enrollments")
+
 @handle_exceptions(ERROR_RETRIEVE_STUDENTS)
-def retrieve_students(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(DBStudent).offset(skip).limit(limit).all()
+def retrieve_students_by_ids(db: Session, ids: List[int], include_enrollments: bool = True):
+    students = _by_ids(db, DBStudent, ids)
+    if not include_enrollments:
+        return students
+    return _fetch_children(db, DBEnrollment, "student_id", students, "enrollments")
 
 @handle_exceptions(ERROR_ADD_TEACHER)
 def add_teacher(db: Session, teacher: TeacherCreate):
     db_teacher = DBTeacher(**teacher.dict())
     db.add(db_teacher)
+    db.flush()
+    _apply_stats(db, stats.teacher_added(db_teacher.id))
     db.commit()
     db.refresh(db_teacher)
     
-    logger.info(f"Added teacher: {teacher.name} with ID: {db_teacher.id}")
+    logger.info("Added teacher: {} with ID: {}", teacher.name, db_teacher.id)
     
     return db_teacher
 
 @handle_exceptions(ERROR_RETRIEVE_TEACHERS)
-def retrieve_teachers(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(DBTeacher).offset(skip).limit(limit).all()
+def retrieve_teachers(db: Session, skip: int = 0, limit: int = 100, include_courses: bool = True, after_id: Optional[int] = None):
+    teachers = _to_dicts(paginate(db.query(*_columns(DBTeacher)), DBTeacher.id, skip, limit, after_id))
+    if not include_courses:
+        return teachers
+    return _fetch_children(db, DBCourse, "teacher_id", teachers, "courses")
+
+@handle_exceptions(ERROR_RETRIEVE_TEACHERS)
+def retrieve_teachers_by_ids(db: Session, ids: List[int], include_courses: bool = True):
+    teachers = _by_ids(db, DBTeacher, ids)
+    if not include_courses:
+        return teachers
+    return _fetch_children(db, DBCourse, "teacher_id", teachers, "courses")
 
 @handle_exceptions(ERROR_ADD_LESSON)
 def add_lesson(db: Session, lesson: LessonCreate):
     db_lesson = DBLesson(**lesson.dict())
     db.add(db_lesson)
+    db.flush()
+    _apply_stats(db, stats.lesson_added(db_lesson.course_id))
     db.commit()
     db.refresh(db_lesson)
     
-    logger.info(f"Added lesson: {lesson.title} with ID: {db_lesson.id}")
+    logger.info("Added lesson: {} with ID: {}", lesson.title, db_lesson.id)
     
     return db_lesson
 
 @handle_exceptions(ERROR_RETRIEVE_LESSONS)
-def retrieve_lessons(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(DBLesson).offset(skip).limit(limit).all()
+def retrieve_lessons(db: Session, skip: int = 0, limit: int = 100, after_id: Optional[int] = None):
+    return _to_dicts(paginate(db.query(*_columns(DBLesson)), DBLesson.id, skip, limit, after_id))
+
+@handle_exceptions(ERROR_RETRIEVE_LESSONS)
+def retrieve_lessons_by_ids(db: Session, ids: List[int]):
+    return _by_ids(db, DBLesson, ids)
 
 @handle_exceptions(ERROR_LESSONS_FOR_COURSE)
-def retrieve_lessons_for_course(db: Session, course_id: int, skip: int = 0, limit: int = 100):
-    return db.query(DBLesson).filter(DBLesson.course_id == course_id).offset(skip).limit(limit).all()
+def retrieve_lessons_for_course(db: Session, course_id: int, skip: int = 0, limit: int = 100, after_id: Optional[int] = None):
+    query = db.query(*_columns(DBLesson)).filter(DBLesson.course_id == course_id)
+    return _to_dicts(paginate(query, DBLesson.id, skip, limit, after_id))
 
 @handle_exceptions(ERROR_ADD_ENROLLMENT)
 def add_enrollment(db: Session, enrollment: EnrollmentCreate):
-    db_enrollment = DBEnrollment(**enrollment.dict())
-    db.add(db_enrollment)
+    """Enroll the student unless already enrolled; returns the enrollment row
+    and whether this call created it."""
+    values = enrollment.dict()
+    db_enrollment = db.execute(text(INSERT_ENROLLMENT), values).first()
+    if db_enrollment is None:
+        db.rollback()
+        query = db.query(*_columns(DBEnrollment)).filter_by(**values)
+        return query.first(), False
+
+    course_teachers = _course_teachers(db, [enrollment.course_id])
+    _apply_stats(db, stats.enrollments_changed([values], course_teachers, 1))
     db.commit()
-    db.refresh(db_enrollment)
-    
-    logger.info(f"Added enrollment for student {enrollment.student_id} in course {enrollment.course_id}")
-    
-    return db_enrollment
+
+    logger.info("Added enrollment for student {} in course {}", enrollment.student_id, enrollment.course_id)
+
+    return db_enrollment, True
+
+def _insert_enrollments(db: Session, pairs):
+    # Multi-row INSERT ... ON CONFLICT DO NOTHING RETURNING; pairs already
+    # enrolled are missing from the result.
+    inserted = {}
+    for start in range(0, len(pairs), BULK_INSERT_CHUNK):
+        chunk = pairs[start:start + BULK_INSERT_CHUNK]
+        values = ", ".join(f"(:student_id_{i}, :course_id_{i})" for i in range(len(chunk)))
+        params = {}
+        for i, (student_id, course_id) in enumerate(chunk):
+            params[f"student_id_{i}"] = student_id
+            params[f"course_id_{i}"] = course_id
+        statement = (
+            f"INSERT INTO enrollment (student_id, course_id) VALUES {values} "
+            "ON CONFLICT (student_id, course_id) DO NOTHING RETURNING id, student_id, course_id"
+        )
+        for row in db.execute(text(statement), params):
+            inserted[(row.student_id, row.course_id)] = row.id
+    return inserted
+
+@handle_exceptions(ERROR_ADD_ENROLLMENTS_BULK)
+def add_enrollments_bulk(db: Session, enrollments: List[EnrollmentCreate]):
+    def stats_changes(created):
+        course_teachers = _course_teachers(db, [row["course_id"] for row in created])
+        return stats.enrollments_changed(created, course_teachers, 1)
+
+    rows = [item.dict() for item in enrollments]
+    errors = _missing_references(db, DBEnrollment, rows)
+
+    # A pair repeated in the batch is only inserted once; a pair already
+    # enrolled is skipped by ON CONFLICT, so the unique index never aborts
+    # the whole batch.
+    first_seen = {}
+    for index, row in enumerate(rows):
+        if index in errors:
+            continue
+        pair = (row["student_id"], row["course_id"])
+        if pair in first_seen:
+            errors[index] = [{
+                "loc": ["course_id"],
+                "msg": f"enrollment of student {pair[0]} in course {pair[1]} is repeated in this request",
+                "type": "value_error.duplicate",
+            }]
+        else:
+            first_seen[pair] = index
+
+    inserted = _insert_enrollments(db, list(first_seen))
+    created = []
+    for pair, index in first_seen.items():
+        if pair in inserted:
+            created.append({**rows[index], "id": inserted[pair]})
+        else:
+            errors[index] = [{
+                "loc": ["course_id"],
+                "msg": f"student {pair[0]} is already enrolled in course {pair[1]}",
+                "type": "value_error.already_enrolled",
+            }]
+    if created:
+        _apply_stats(db, stats_changes(created))
+    db.commit()
+
+    logger.info("Added {} enrollments in bulk, rejected {}", len(created), len(errors))
+    return created, errors
 
 @handle_exceptions(ERROR_REMOVE_ENROLLMENT)
 def remove_enrollment(db: Session, student_id: int, course_id: int):
-    db_enrollment = db.query(DBEnrollment).filter_by(student_id=student_id, course_id=course_id).first()
-    db.delete(db_enrollment)
+    """Returns (message, removed row), or None when there was no such
+    enrollment to remove."""
+    values = {"student_id": student_id, "course_id": course_id}
+    removed = db.execute(text(DELETE_ENROLLMENT), values).first()
+    if removed is None:
+        db.rollback()
+        return None
+
+    course_teachers = _course_teachers(db, [course_id])
+    _apply_stats(db, stats.enrollments_changed([values], course_teachers, -1))
     db.commit()
-    
-    logger.info(f"Removed enrollment for student ID: {student_id} in course ID: {course_id}")
-    
-    return {"message": "Enrollment removed successfully"}
+
+    logger.info("Removed enrollment for student ID: {} in course ID: {}", student_id, course_id)
+
+    return {"message": "Enrollment removed successfully"}, dict(removed._mapping)
 
 @handle_exceptions(ERROR_RETRIEVE_ENROLLMENTS)
-def retrieve_enrollments(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(DBEnrollment).offset(skip).limit(limit).all()
+def retrieve_enrollments(db: Session, skip: int = 0, limit: int = 100, after_id: Optional[int] = None):
+    return _to_dicts(paginate(db.query(*_columns(DBEnrollment)), DBEnrollment.id, skip, limit, after_id))
 
 @handle_exceptions(ERROR_RETRIEVE_STUDENT_ENROLLMENTS)
-def retrieve_student_enrollments(db: Session, student_id: int, skip: int = 0, limit: int = 100):
-    return db.query(DBEnrollment).filter(DBEnrollment.student_id == student_id).offset(skip).limit(limit).all()
+def retrieve_student_enrollments(db: Session, student_id: int, skip: int = 0, limit: int = 100, after_id: Optional[int] = None):
+    query = db.query(*_columns(DBEnrollment)).filter(DBEnrollment.student_id == student_id)
+    return _to_dicts(paginate(query, DBEnrollment.id, skip, limit, after_id))
+
+@handle_exceptions(ERROR_RETRIEVE_COURSE_STATS)
+def retrieve_course_stats(db: Session, course_id: int):
+    return db.query(DBCourseStats).filter(DBCourseStats.course_id == course_id).first()
+
+@handle_exceptions(ERROR_RETRIEVE_TEACHER_STATS)
+def retrieve_teacher_stats(db: Session, teacher_id: int):
+    return db.query(DBTeacherStats).filter(DBTeacherStats.teacher_id == teacher_id).first()
+
+@handle_exceptions(ERROR_SEARCH)
+def search_records(db: Session, kind: str, query: str, limit: int = 20):
+    return search.search(db, kind, query, limit)
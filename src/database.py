@@ -1,26 +1,203 @@
-from sqlalchemy import create_engine
+import itertools
+import threading
+import time
+from sqlalchemy import create_engine, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+from sqlalchemy import exc
 from databases import Database
 from dotenv import load_dotenv
 import os
 
 load_dotenv()
 
-def setup_database(DATABASE_URL=""):
+# Each worker process opens up to DB_POOL_SIZE + DB_MAX_OVERFLOW connections
+# for the sync routes, plus DB_ASYNC_POOL_SIZE for the async ones; size them
+# so every worker together stays below Postgres' max_connections.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "30000"))
+DB_ASYNC_POOL_SIZE = int(os.getenv("DB_ASYNC_POOL_SIZE", "10"))
+
+# Comma-separated read replica URLs; reads fall back to the primary when none
+# is configured or healthy.
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+REPLICA_HEALTH_CHECK_INTERVAL = float(os.getenv("REPLICA_HEALTH_CHECK_INTERVAL", "5"))
+# Seconds a new connection to a replica may take before the replica counts
+# as down, so an unreachable one cannot hold a request for the OS TCP timeout.
+REPLICA_CONNECT_TIMEOUT = int(os.getenv("REPLICA_CONNECT_TIMEOUT", "2"))
+# After a write, the same client reads from the primary for this many seconds
+# so it sees its own write despite replication lag (0 disables).
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", "0"))
+
+Base = declarative_base()
+
+_setups = {}
+_setup_lock = threading.Lock()
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records how long callers wait to check a connection out."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def connect(self):
+        start = time.perf_counter()
+        timed_out = False
+        try:
+            return super().connect()
+        except exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.timeouts += timed_out
+                self.wait_seconds_total += waited
+                self.wait_seconds_max = max(self.wait_seconds_max, waited)
+
+class ReplicaRouter:
+    """Hands out sessions on the primary, or round-robin on healthy replicas
+    for read-only work. A replica is probed with SELECT 1 at most once per
+    health check interval and skipped while the probe fails."""
+
+    def __init__(self, primary, replicas=(), health_check_interval=REPLICA_HEALTH_CHECK_INTERVAL):
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.health_check_interval = health_check_interval
+        self._turns = itertools.count()
+        self._health = {}
+        self._health_lock = threading.Lock()
+
+    def _probe(self, replica):
+        # Any SQLAlchemy error counts as down, a pool checkout timeout on a
+        # saturated replica included.
+        try:
+            with replica.kw["bind"].connect() as connection:
+                connection.execute(text("SELECT 1"))
+            return True
+        except exc.SQLAlchemyError:
+            return False
+
+    def _is_healthy(self, replica):
+        now = time.monotonic()
+        with self._health_lock:
+            healthy, checked_at = self._health.get(replica, (True, None))
+            due = checked_at is None or now - checked_at >= self.health_check_interval
+            if due:
+                # Claim the check; other requests keep the last verdict
+                # meanwhile instead of probing too.
+                self._health[replica] = (healthy, now)
+        if due:
+            healthy = self._probe(replica)
+            with self._health_lock:
+                self._health[replica] = (healthy, now)
+        return healthy
+
+    def session(self, read_only=False):
+        if read_only:
+            for _ in range(len(self.replicas)):
+                replica = self.replicas[next(self._turns) % len(self.replicas)]
+                if self._is_healthy(replica):
+                    return replica()
+        return self.primary()
+
+def database_url():
+    # An explicit DATABASE_URL (e.g. a SQLite file for benchmarks) wins over
+    # the POSTGRES_* settings.
+    if os.getenv("DATABASE_URL"):
+        return os.getenv("DATABASE_URL")
+
     postgres_user = os.getenv('POSTGRES_USER')
     postgres_password = os.getenv('POSTGRES_PASSWORD')
     postgres_db = os.getenv('POSTGRES_DB')
     postgres_host = os.getenv('POSTGRES_HOST')
     postgres_port = os.getenv('POSTGRES_PORT')
 
+    return f"postgresql://{postgres_user}:{postgres_password}@{postgres_host}:{postgres_port}/{postgres_db}"
+
+def _create_engine(DATABASE_URL, connect_timeout=None):
+    if DATABASE_URL.startswith("sqlite"):
+        # Sync routes check a session out on one threadpool thread and may
+        # use it on another.
+        return create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+
+    connect_args = {"options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"}
+    if connect_timeout is not None:
+        connect_args["connect_timeout"] = connect_timeout
+
+    return create_engine(
+        DATABASE_URL,
+        poolclass=InstrumentedQueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+        connect_args=connect_args,
+    )
+
+def _create_database(DATABASE_URL):
+    if DATABASE_URL.startswith("sqlite"):
+        return Database(DATABASE_URL)
+
+    return Database(
+        DATABASE_URL,
+        min_size=1,
+        max_size=DB_ASYNC_POOL_SIZE,
+        server_settings={"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)},
+    )
+
+def setup_database(DATABASE_URL="", connect_timeout=None):
+    """Return the process-wide (SessionLocal, database, Base, engine) for a URL.
+
+    Every caller shares one engine and pool per URL instead of opening its own;
+    `connect_timeout` (seconds) applies when that engine is first created.
+    """
     if DATABASE_URL == "":
-        DATABASE_URL = f"postgresql://{postgres_user}:{postgres_password}@{postgres_host}:{postgres_port}/{postgres_db}"
+        DATABASE_URL = database_url()
 
-    engine = create_engine(DATABASE_URL)
-    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    with _setup_lock:
+        if DATABASE_URL not in _setups:
+            engine = _create_engine(DATABASE_URL, connect_timeout)
+            SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+            _setups[DATABASE_URL] = (SessionLocal, _create_database(DATABASE_URL), Base, engine)
+        return _setups[DATABASE_URL]
 
-    database = Database(DATABASE_URL)
-    Base = declarative_base()
+def dispose_engines(close=True):
+    """Drop every engine's pooled connections; each pool reconnects on next
+    use. A forked worker passes close=False: the connections it inherited
+    still belong to the parent, so they are forgotten rather than closed."""
+    with _setup_lock:
+        for _, _, _, engine in _setups.values():
+            engine.dispose(close=close)
 
-    return SessionLocal, database, Base, engine
+def pool_status(engine):
+    pool = engine.pool
+    if not isinstance(pool, QueuePool):
+        return {"status": pool.status()}
+    status = {
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+        "max_overflow": DB_MAX_OVERFLOW,
+    }
+    if isinstance(pool, InstrumentedQueuePool):
+        status.update({
+            "checkouts": pool.checkouts,
+            "timeouts": pool.timeouts,
+            "wait_seconds_total": pool.wait_seconds_total,
+            "wait_seconds_max": pool.wait_seconds_max,
+        })
+    return status
@@ -7,6 +7,7 @@ ERROR_MODIFY_COURSE = "Error updating course"
 ERROR_REMOVE_COURSE = "Error deleting course"
 
 ERROR_ADD_STUDENT = "Error adding student"
+ERROR_ADD_STUDENTS_BULK = "Error adding students in bulk"
 ERROR_RETRIEVE_STUDENTS = "Error retrieving students"
 
 ERROR_ADD_TEACHER = "Error adding teacher"
@@ -18,6 +19,14 @@ ERROR_RETRIEVE_LESSONS = "Error retrieving lessons"
 ERROR_LESSONS_FOR_COURSE = "Error retrieving lessons for course"
 
 ERROR_ADD_ENROLLMENT = "Error adding enrollment"
+ERROR_ADD_ENROLLMENTS_BULK = "Error adding enrollments in bulk"
 ERROR_REMOVE_ENROLLMENT = "Error removing enrollment"
 ERROR_RETRIEVE_ENROLLMENTS = "Error retrieving enrollments"
 ERROR_RETRIEVE_STUDENT_ENROLLMENTS = "Error retrieving student enrollments"
+
+ERROR_RETRIEVE_COURSE_STATS = "Error retrieving course statistics"
+ERROR_RETRIEVE_TEACHER_STATS = "Error retrieving teacher statistics"
+ERROR_SEARCH = "Error searching"
+
+ERROR_RATE_LIMITED = "Rate limit exceeded"
+ERROR_IDEMPOTENCY_KEY_REUSED = "Idempotency-Key was already used for a different request"
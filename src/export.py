@@ -0,0 +1,48 @@
+import csv
+import io
+import json
+from sqlalchemy import select
+from src.models import Course, Teacher, Lesson, Student, Enrollment
+
+EXPORT_BATCH_SIZE = 1000
+
+EXPORT_TABLES = {
+    "courses": Course.__table__,
+    "teachers": Teacher.__table__,
+    "lessons": Lesson.__table__,
+    "students": Student.__table__,
+    "enrollments": Enrollment.__table__,
+}
+
+MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+def _batches(engine, table, batch_size):
+    # stream_results makes psycopg2 use a server-side cursor, so only one
+    # batch of plain row tuples is held in memory at a time.
+    with engine.connect() as connection:
+        connection = connection.execution_options(stream_results=True, max_row_buffer=batch_size)
+        result = connection.execute(select(table).order_by(table.c.id))
+        yield from result.partitions(batch_size)
+
+def ndjson_chunks(engine, table, batch_size=EXPORT_BATCH_SIZE):
+    for batch in _batches(engine, table, batch_size):
+        yield "".join(json.dumps(dict(row._mapping), separators=(",", ":")) + "\n" for row in batch)
+
+def csv_chunks(engine, table, batch_size=EXPORT_BATCH_SIZE):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(table.columns.keys())
+    yield buffer.getvalue()
+    for batch in _batches(engine, table, batch_size):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(batch)
+        yield buffer.getvalue()
+
+EXPORT_ENCODERS = {
+    "ndjson": ndjson_chunks,
+    "csv": csv_chunks,
+}
@@ -0,0 +1,47 @@
+"""Gunicorn settings for production serving:
+
+    gunicorn -c src/gunicorn_conf.py src.main:app
+
+The app is imported once in the master and forked into SERVER_WORKERS
+uvicorn workers (one per CPU by default). Each worker recycles itself after
+about SERVER_MAX_REQUESTS requests. On SIGTERM, workers stop accepting
+connections and get SERVER_GRACEFUL_TIMEOUT seconds to finish in-flight
+requests and run the app's shutdown hooks.
+"""
+import multiprocessing
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+bind = os.getenv("SERVER_BIND", "0.0.0.0:8000")
+workers = int(os.getenv("SERVER_WORKERS", "0")) or multiprocessing.cpu_count()
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# Import src.main (FastAPI, pydantic, the routes) once instead of per worker.
+# Importing it opens no engines or sockets, so nothing is shared by accident.
+preload_app = True
+
+# Recycling bounds slow leaks; the jitter keeps workers from restarting together.
+max_requests = int(os.getenv("SERVER_MAX_REQUESTS", "10000"))
+max_requests_jitter = int(os.getenv("SERVER_MAX_REQUESTS_JITTER", "1000"))
+
+graceful_timeout = int(os.getenv("SERVER_GRACEFUL_TIMEOUT", "30"))
+timeout = int(os.getenv("SERVER_TIMEOUT", "60"))
+keepalive = int(os.getenv("SERVER_KEEPALIVE", "5"))
+
+def when_ready(server):
+    from src.cache import CACHE_REDIS_URL
+
+    if server.cfg.workers > 1 and not CACHE_REDIS_URL:
+        server.log.warning("CACHE_REDIS_URL is not set: conditional GETs (ETag/304) are off with %s workers", server.cfg.workers)
+
+def post_fork(server, worker):
+    # Should anything in the master have opened a connection, the worker must
+    # not use it: give every engine a fresh pool in this process.
+    from src import http_cache
+    from src.database import dispose_engines
+
+    dispose_engines(close=False)
+    # Write counters are per process unless they live in Redis.
+    http_cache.multiple_workers = server.cfg.workers > 1
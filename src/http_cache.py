@@ -0,0 +1,85 @@
+import os
+from dotenv import load_dotenv
+from starlette.concurrency import run_in_threadpool
+from src import cache
+from src.routing import RouteMatcher, request_header
+
+load_dotenv()
+
+# How long browsers and CDNs may reuse a response before revalidating it with
+# If-None-Match; writes are not pushed to them, so keep it short.
+HTTP_CACHE_MAX_AGE = int(os.getenv("HTTP_CACHE_MAX_AGE", "5"))
+
+# Read routes answering conditional GETs, with the tables whose writes change
+# their output (nested collections included).
+CONDITIONAL_ROUTES = {
+    ("GET", "/courses/"): ("course",),
+    ("GET", "/courses/{course_id}"): ("course",),
+    ("GET", "/courses/{course_id}/lessons/"): ("lesson",),
+    ("GET", "/courses/{course_id}/stats"): ("course", "lesson", "enrollment"),
+    ("GET", "/lessons/"): ("lesson",),
+    ("GET", "/students/"): ("student", "enrollment"),
+    ("GET", "/students/{student_id}/enrollments/"): ("enrollment",),
+    ("GET", "/teachers/"): ("teacher", "course"),
+    ("GET", "/teachers/{teacher_id}/stats"): ("teacher", "course", "enrollment"),
+    ("GET", "/enrollments/"): ("enrollment",),
+    ("GET", "/search"): ("course", "lesson", "teacher", "student"),
+    ("GET", "/search/{kind}"): ("course", "lesson", "teacher", "student"),
+}
+
+# Set in each worker by src/gunicorn_conf.py when the server runs several.
+# Without a shared cache backend a worker's write counters only count its own
+# writes, so it could answer 304 for data another worker has changed.
+multiple_workers = False
+
+def conditional_gets_enabled():
+    return cache.backend is not None or not multiple_workers
+
+def make_etag(epoch, table_versions):
+    # Weak: the same representation may be sent with different encodings.
+    return f'W/"{epoch}-{".".join(str(version) for version in table_versions)}"'
+
+def etag_matches(if_none_match, etag):
+    if if_none_match is None:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return "*" in candidates or any(candidate.removeprefix("W/") == etag.removeprefix("W/") for candidate in candidates)
+
+class ConditionalGetMiddleware:
+    """Tags read responses with an ETag built from per-table write counters
+    and answers a matching If-None-Match with 304 before the route (and the
+    database) is reached."""
+
+    def __init__(self, app, routes=None, max_age=HTTP_CACHE_MAX_AGE):
+        self.app = app
+        self.routes = CONDITIONAL_ROUTES if routes is None else routes
+        self.matcher = RouteMatcher(self.routes)
+        self.cache_control = f"public, max-age={max_age}".encode()
+
+    async def _etag(self, tables):
+        # A shared backend means a Redis round trip; keep it off the event loop.
+        if cache.backend is not None:
+            return make_etag(*await run_in_threadpool(cache.versions, tables))
+        return make_etag(*cache.versions(tables))
+
+    async def __call__(self, scope, receive, send):
+        route = self.matcher.match(scope) if scope["type"] == "http" else None
+        if route is None or not conditional_gets_enabled():
+            await self.app(scope, receive, send)
+            return
+
+        # Read before the route runs: a write landing meanwhile leaves this
+        # ETag behind the data, which only costs the client a refetch later.
+        etag = await self._etag(self.routes[route])
+        headers = [(b"etag", etag.encode()), (b"cache-control", self.cache_control)]
+        if etag_matches(request_header(scope, b"if-none-match"), etag):
+            await send({"type": "http.response.start", "status": 304, "headers": headers})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        async def send_with_etag(message):
+            if message["type"] == "http.response.start" and message["status"] == 200:
+                message = {**message, "headers": [*message.get("headers", []), *headers]}
+            await send(message)
+
+        await self.app(scope, receive, send_with_etag)
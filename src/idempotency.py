@@ -0,0 +1,65 @@
+import json
+import os
+import threading
+from cachetools import TTLCache
+from dotenv import load_dotenv
+from fastapi import HTTPException
+from src import cache
+from src.errors import ERROR_IDEMPOTENCY_KEY_REUSED
+
+load_dotenv()
+
+# How long a response is replayed for a retried Idempotency-Key.
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", "86400"))
+IDEMPOTENCY_MAX_KEYS = 100000
+
+HEADER = "idempotency-key"
+
+class IdempotencyStore:
+    """The first response to each (route, Idempotency-Key), so a client
+    retrying a request it never saw the answer to gets that answer instead
+    of a second write. Kept in Redis when the shared cache is configured, so
+    the retry may land on any worker; in process otherwise."""
+
+    prefix = "focusedai:idempotency:"
+
+    def __init__(self, maxsize=IDEMPOTENCY_MAX_KEYS, ttl=IDEMPOTENCY_TTL):
+        self.ttl = ttl
+        self.local = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.lock = threading.Lock()
+
+    def _name(self, route, key):
+        return f"{self.prefix}{route}:{key}"
+
+    def _load(self, name):
+        if cache.backend is not None:
+            blob = cache.backend.client.get(name)
+            return json.loads(blob) if blob is not None else None
+        with self.lock:
+            return self.local.get(name)
+
+    def replay(self, route, key, fingerprint):
+        """The stored response body for `key`, or None if it is new. Reusing
+        a key for a different request is a client error."""
+        stored = self._load(self._name(route, key))
+        if stored is None:
+            return None
+        if stored["fingerprint"] != fingerprint:
+            raise HTTPException(status_code=422, detail=ERROR_IDEMPOTENCY_KEY_REUSED)
+        return stored["body"]
+
+    def remember(self, route, key, fingerprint, body):
+        name = self._name(route, key)
+        stored = {"fingerprint": fingerprint, "body": body}
+        # The first response stored wins, should two retries race.
+        if cache.backend is not None:
+            cache.backend.client.set(name, json.dumps(stored), ex=self.ttl, nx=True)
+            return
+        with self.lock:
+            self.local.setdefault(name, stored)
+
+def idempotency_key(request):
+    # Routes also get called directly (without a request) in tests.
+    return request.headers.get(HEADER) if request is not None else None
+
+store = IdempotencyStore()
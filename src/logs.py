@@ -0,0 +1,167 @@
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+import traceback
+from dotenv import load_dotenv
+from loguru import logger
+
+load_dotenv()
+
+APP_ENV = os.getenv("APP_ENV", "development")
+PRODUCTION = APP_ENV == "production"
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FILE = os.getenv("LOG_FILE", "monitoring/app.log")
+LOG_ROTATION_BYTES = int(os.getenv("LOG_ROTATION_BYTES", str(500 * 1024 * 1024)))
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "256"))
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", "0.5"))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# Fraction of INFO (and DEBUG) events kept; warnings and errors are never sampled.
+LOG_INFO_SAMPLE_RATE = float(os.getenv("LOG_INFO_SAMPLE_RATE", "1.0"))
+
+_STOP = object()
+
+file_sink = None
+
+def record_to_json(record):
+    entry = {
+        "time": record["time"].isoformat(),
+        "level": record["level"].name,
+        "message": record["message"],
+        "logger": record["name"],
+        "function": record["function"],
+        "line": record["line"],
+        "process": record["process"].id,
+        "thread": record["thread"].name,
+    }
+    if record["extra"]:
+        entry["extra"] = record["extra"]
+    if record["exception"]:
+        type_, value, tb = record["exception"]
+        entry["exception"] = "".join(traceback.format_exception(type_, value, tb))
+    return json.dumps(entry, default=str)
+
+class BatchingFileSink:
+    """Loguru sink that only enqueues records on the calling thread.
+
+    A background thread serializes them to JSON lines and appends them to
+    `path` in batches, rotating the file once it reaches `rotation_bytes`.
+    When the queue is full, records are dropped and counted instead of
+    blocking the request.
+    """
+
+    def __init__(
+        self,
+        path,
+        batch_size=LOG_BATCH_SIZE,
+        flush_interval=LOG_FLUSH_INTERVAL,
+        queue_size=LOG_QUEUE_SIZE,
+        rotation_bytes=LOG_ROTATION_BYTES,
+    ):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.rotation_bytes = rotation_bytes
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def write(self, message):
+        try:
+            self.queue.put_nowait(message.record)
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self):
+        if self._thread.is_alive():
+            self.queue.put(_STOP)
+            self._thread.join(timeout=5)
+
+    def _next_batch(self):
+        try:
+            item = self.queue.get(timeout=self.flush_interval)
+        except queue.Empty:
+            return [], False
+        batch = []
+        while item is not _STOP:
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                return batch, False
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                return batch, False
+        return batch, True
+
+    def _rotate(self, file):
+        # Worker processes share the file; if another one already rotated it,
+        # just follow it to the new file.
+        try:
+            rotated_elsewhere = not os.path.samestat(os.fstat(file.fileno()), os.stat(self.path))
+        except FileNotFoundError:
+            rotated_elsewhere = True
+        file.close()
+        if not rotated_elsewhere:
+            os.replace(self.path, f"{self.path}.{time.strftime('%Y%m%d-%H%M%S')}.{os.getpid()}")
+        return open(self.path, "a", encoding="utf-8")
+
+    def _run(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        file = open(self.path, "a", encoding="utf-8")
+        stopping = False
+        while not stopping:
+            batch, stopping = self._next_batch()
+            if not batch:
+                continue
+            file.write("".join(record_to_json(record) + "\n" for record in batch))
+            file.flush()
+            if file.tell() >= self.rotation_bytes:
+                file = self._rotate(file)
+        file.close()
+
+def sample_info(record):
+    return record["level"].no > logger.level("INFO").no or random.random() < LOG_INFO_SAMPLE_RATE
+
+def configure_logging():
+    """Replace loguru's default handler (synchronous, with diagnose on) with a
+    queued stderr handler and the batched JSON file sink."""
+    global file_sink
+    if file_sink is not None:
+        return file_sink
+
+    logger.remove()
+    logger.add(
+        sys.stderr,
+        level=LOG_LEVEL,
+        filter=sample_info,
+        enqueue=True,
+        backtrace=not PRODUCTION,
+        diagnose=not PRODUCTION,
+    )
+    file_sink = BatchingFileSink(LOG_FILE)
+    # A dynamic format keeps loguru from rendering the message and traceback
+    # text on the request thread; the sink serializes the raw record instead.
+    logger.add(
+        file_sink,
+        level=LOG_LEVEL,
+        filter=sample_info,
+        format=lambda record: "{message}",
+        backtrace=False,
+        diagnose=False,
+    )
+    return file_sink
+
+def shutdown_logging():
+    """Flush and close the sinks added by configure_logging."""
+    global file_sink
+    if file_sink is None:
+        return
+    logger.remove()
+    logger.add(sys.stderr, level=LOG_LEVEL)
+    file_sink = None
@@ -1,150 +1,367 @@
-from fastapi import Depends, FastAPI
-from cachetools.keys import hashkey
+import os
+import time
+from typing import Any, Dict, List, Optional
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
 from src.models import *
 from src.crud import *
 from src.schemas import *
-from src.database import setup_database
+from src.database import (
+    DATABASE_REPLICA_URLS,
+    REPLICA_CONNECT_TIMEOUT,
+    READ_YOUR_WRITES_SECONDS,
+    ReplicaRouter,
+    dispose_engines,
+    pool_status,
+    setup_database,
+)
 from src.cache import *
+from src.serializers import join_rows, parse_fields, parse_ids, serialize_row, serialize_rows, json_response
+from src.pagination import decode_cursor, page_headers
+from src.export import EXPORT_ENCODERS, EXPORT_TABLES, MEDIA_TYPES
+from src.search import SEARCH_FIELDS
+from src.metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, MetricsMiddleware, render_metrics
+from src.ratelimit import RateLimitMiddleware
+from src.http_cache import ConditionalGetMiddleware
+from src.idempotency import idempotency_key, store as idempotency_store
+from src.compression import CompressionMiddleware
+from src.async_routes import router as async_router
+from src.logs import configure_logging, shutdown_logging
+
+ASYNC_ROUTES = os.getenv("ASYNC_ROUTES", "false").lower() == "true"
+BULK_MAX_ROWS = int(os.getenv("BULK_MAX_ROWS", "10000"))
 
 app = FastAPI()
+# The middleware added last runs first: metrics also see rate-limited and
+# 304 responses, and a 304 still spends a rate limit token.
+app.add_middleware(ConditionalGetMiddleware)
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(RateLimitMiddleware)
+app.add_middleware(MetricsMiddleware)
+
+# Importing this module only defines the app: engines are created on first
+# use, and the log sinks and shared cache are set up when the server starts.
+# The schema is created by `python -m src.migrations`, never on import.
+@app.on_event("startup")
+def start_services():
+    configure_logging()
+    configure_shared_cache()
+
+@app.on_event("shutdown")
+def stop_services():
+    dispose_engines()
+    shutdown_logging()
+
+if ASYNC_ROUTES:
+    # Registered before the sync routes below so they win on identical paths.
+    app.include_router(async_router)
+
+    @app.on_event("startup")
+    async def connect_database():
+        await setup_database()[1].connect()
+
+    @app.on_event("shutdown")
+    async def disconnect_database():
+        await setup_database()[1].disconnect()
+
+db_router = None
+
+def get_db_router():
+    global db_router
+    if db_router is None:
+        db_router = ReplicaRouter(setup_database()[0], [setup_database(url, REPLICA_CONNECT_TIMEOUT)[0] for url in DATABASE_REPLICA_URLS])
+    return db_router
 
-SessionLocal, database, Base, _ = setup_database()
+READ_METHODS = ("GET", "HEAD")
+PRIMARY_COOKIE = "db_primary_until"
 
-def get_db():
-    db = SessionLocal()
+def pinned_to_primary(request: Request):
+    try:
+        return float(request.cookies.get(PRIMARY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+def replicas_caught_up():
+    # Until replicas have had READ_YOUR_WRITES_SECONDS to apply the latest
+    # write (by any worker), a read from one could be cached, and sent with
+    # the post-write ETag, as the data from before it: such reads use the
+    # primary instead.
+    return seconds_since_invalidation() >= READ_YOUR_WRITES_SECONDS
+
+def get_db(request: Request, response: Response):
+    # Reads may go to a replica; writes, and a client's reads shortly after
+    # its own write when READ_YOUR_WRITES_SECONDS is set, use the primary.
+    read_only = request.method in READ_METHODS
+    router = get_db_router()
+    if router.replicas and READ_YOUR_WRITES_SECONDS:
+        if read_only:
+            read_only = not pinned_to_primary(request) and replicas_caught_up()
+        else:
+            primary_until = time.time() + READ_YOUR_WRITES_SECONDS
+            response.set_cookie(PRIMARY_COOKIE, str(primary_until), max_age=int(READ_YOUR_WRITES_SECONDS) + 1)
+
+    db = router.session(read_only=read_only)
     try:
         yield db
     finally:
         db.close()
 
+def validate_bulk(schema, rows):
+    """Validate each row of a bulk request on its own, returning the valid
+    (index, item) pairs and per-row errors for the rest."""
+    if len(rows) > BULK_MAX_ROWS:
+        raise HTTPException(status_code=413, detail=f"At most {BULK_MAX_ROWS} rows per request")
+    valid, errors = [], []
+    for index, row in enumerate(rows):
+        try:
+            valid.append((index, schema.parse_obj(row)))
+        except ValidationError as e:
+            errors.append({"index": index, "errors": e.errors()})
+    return valid, errors
+
+def bulk_result(schema, valid, created, errors, rejected):
+    # `rejected` is keyed by position among the valid rows; report request indexes.
+    errors += [{"index": valid[position][0], "errors": row_errors} for position, row_errors in rejected.items()]
+    return {
+        "created": jsonable_encoder([schema.validate(row) for row in created]),
+        "errors": sorted(errors, key=lambda error: error["index"]),
+    }
+
+def cached_page(cache_key, db, fetch):
+    """Serve `fetch(db)` -> (page, dependencies) through the response cache."""
+    # A stale-while-revalidate refresh outlives the request, so it reads
+    # through a session of its own instead of the request's.
+    def refresh():
+        refresh_db = get_db_router().session(read_only=replicas_caught_up())
+        try:
+            return fetch(refresh_db)
+        finally:
+            refresh_db.close()
+
+    return cached(cache_key, lambda: fetch(db), refresh)
+
+def batch_rows(table, schema, ids, fetch, fields=None):
+    """Serve `?ids=` through the per-entity cache, fetching the misses with
+    one `fetch(missing_ids)` query. Rows come back in request order, with
+    null for ids that have no row."""
+    ids = parse_ids(ids)
+    bodies = cached_rows(table, ids, fetch, lambda row: serialize_row(schema, row, fields), fields)
+    return json_response(join_rows(bodies, ids))
+
 @app.post("/courses/", response_model=Course)
 def create_course(course: CourseCreate, db: Session = Depends(get_db)):
     new_course = add_course(db=db, course=course)
-    cache_key = hashkey("courses")
-    delete_cache(cache_key)
+    invalidate_write("course", "insert", new_course)
     return new_course
 
 @app.put("/courses/{course_id}", response_model=Course)
 def update_course(course_id: int, course_data: CourseCreate, db: Session = Depends(get_db)):
     updated_course = modify_course(db=db, course_id=course_id, course_data=course_data)
-    cache_key = hashkey("courses")
-    delete_cache(cache_key)
+    if updated_course is None:
+        raise HTTPException(status_code=404, detail="Course not found")
+    invalidate_write("course", "update", updated_course)
     return updated_course
 
 @app.get("/courses/", response_model=list[Course])
-def get_courses(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    cache_key = hashkey("courses")
-    cached_result = get_cache(cache_key)
-    if cached_result:
-        return cached_result
-    
-    courses = retrieve_courses(db=db, skip=skip, limit=limit)
+def get_courses(skip: int = 0, limit: int = 100, cursor: Optional[str] = None, ids: Optional[str] = None, db: Session = Depends(get_db)):
+    if ids is not None:
+        return batch_rows("course", Course, ids, lambda missing: retrieve_courses_by_ids(db=db, ids=missing))
+    after_id = decode_cursor(cursor)
 
-    set_cache(cache_key, courses)
+    def fetch(db):
+        courses = retrieve_courses(db=db, skip=skip, limit=limit, after_id=after_id)
+        page = CachedResponse(serialize_rows(Course, courses), page_headers(courses, limit))
+        return page, page_dependencies("course", courses, limit, keyset=after_id is not None)
 
-    return courses
+    cache_key = make_cache_key("courses", skip=skip, limit=limit, after=after_id)
+    return json_response(*cached_page(cache_key, db, fetch))
 
 @app.get("/courses/{course_id}", response_model=Course)
 def get_course(course_id: int, db: Session = Depends(get_db)):
     return retrieve_course_by_id(db=db, course_id=course_id)
 
+@app.get("/courses/{course_id}/stats", response_model=CourseStats)
+def get_course_stats(course_id: int, db: Session = Depends(get_db)):
+    course_stats = retrieve_course_stats(db=db, course_id=course_id)
+    if course_stats is None:
+        raise HTTPException(status_code=404, detail="Course not found")
+    return course_stats
+
 @app.delete("/courses/{course_id}", status_code=204)
 def delete_course(course_id: int, db: Session = Depends(get_db)):
-    deleted_course = remove_course(db=db, course_id=course_id)
-    cache_key = hashkey("courses")
-    delete_cache(cache_key)
+    deleted_course, orphans = remove_course(db=db, course_id=course_id)
+    invalidate_write("course", "delete", {"id": course_id})
+    # Its lessons and enrollments lost their course_id.
+    for table, rows in orphans.items():
+        invalidate_writes(table, "update", rows)
     return deleted_course
 
 @app.post("/lessons/", response_model=Lesson)
 def create_lesson(lesson: LessonCreate, db: Session = Depends(get_db)):
     new_lesson = add_lesson(db=db, lesson=lesson)
-    cache_key = hashkey("lessons")
-    delete_cache(cache_key)
+    invalidate_write("lesson", "insert", new_lesson)
     return new_lesson
 
 @app.get("/lessons/", response_model=list[Lesson])
-def get_lessons(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    cache_key = hashkey("lessons")
-    cached_result = get_cache(cache_key)
-    if cached_result:
-        return cached_result
-    
-    lessons = retrieve_lessons(db=db, skip=skip, limit=limit)
+def get_lessons(skip: int = 0, limit: int = 100, cursor: Optional[str] = None, ids: Optional[str] = None, db: Session = Depends(get_db)):
+    if ids is not None:
+        return batch_rows("lesson", Lesson, ids, lambda missing: retrieve_lessons_by_ids(db=db, ids=missing))
+    after_id = decode_cursor(cursor)
 
-    set_cache(cache_key, lessons)
+    def fetch(db):
+        lessons = retrieve_lessons(db=db, skip=skip, limit=limit, after_id=after_id)
+        page = CachedResponse(serialize_rows(Lesson, lessons), page_headers(lessons, limit))
+        return page, page_dependencies("lesson", lessons, limit, keyset=after_id is not None)
 
-    return lessons
+    cache_key = make_cache_key("lessons", skip=skip, limit=limit, after=after_id)
+    return json_response(*cached_page(cache_key, db, fetch))
 
 @app.get("/courses/{course_id}/lessons/", response_model=list[Lesson])
-def get_lessons_for_course(course_id: int, skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    return retrieve_lessons_for_course(db=db, course_id=course_id, skip=skip, limit=limit)
+def get_lessons_for_course(course_id: int, skip: int = 0, limit: int = 100, cursor: Optional[str] = None, db: Session = Depends(get_db)):
+    after_id = decode_cursor(cursor)
+    lessons = retrieve_lessons_for_course(db=db, course_id=course_id, skip=skip, limit=limit, after_id=after_id)
+    return json_response(serialize_rows(Lesson, lessons), page_headers(lessons, limit))
 
 @app.post("/students/", response_model=Student)
 def create_student(student: StudentCreate, db: Session = Depends(get_db)):
     new_student = add_student(db=db, student=student)
-    cache_key = hashkey("students")
-    delete_cache(cache_key)
+    invalidate_write("student", "insert", new_student)
     return new_student
 
+@app.post("/students/bulk")
+def create_students_bulk(students: List[Dict[str, Any]], db: Session = Depends(get_db)):
+    valid, errors = validate_bulk(StudentCreate, students)
+    created, rejected = add_students_bulk(db=db, students=[item for _, item in valid])
+    invalidate_writes("student", "insert", created)
+    return bulk_result(Student, valid, created, errors, rejected)
+
 @app.get("/students/", response_model=list[Student])
-def get_students(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    cache_key = hashkey("students")
-    cached_result = get_cache(cache_key)
-    if cached_result:
-        return cached_result
+def get_students(skip: int = 0, limit: int = 100, cursor: Optional[str] = None, fields: Optional[str] = None, ids: Optional[str] = None, db: Session = Depends(get_db)):
+    selected = parse_fields(Student, fields)
+    if ids is not None:
+        include_enrollments = selected is None or "enrollments" in selected
+        fetch = lambda missing: retrieve_students_by_ids(db=db, ids=missing, include_enrollments=include_enrollments)
+        return batch_rows("student", Student, ids, fetch, selected)
+    after_id = decode_cursor(cursor)
 
-    students = retrieve_students(db=db, skip=skip, limit=limit)
+    def fetch(db):
+        include_enrollments = selected is None or "enrollments" in selected
+        students = retrieve_students(db=db, skip=skip, limit=limit, include_enrollments=include_enrollments, after_id=after_id)
+        page = CachedResponse(serialize_rows(Student, students, selected), page_headers(students, limit))
+        return page, page_dependencies("student", students, limit, keyset=after_id is not None)
 
-    set_cache(cache_key, students)
-    return students
+    cache_key = make_cache_key("students", skip=skip, limit=limit, after=after_id, fields=selected)
+    return json_response(*cached_page(cache_key, db, fetch))
 
 @app.post("/teachers/", response_model=Teacher)
 def create_teacher(teacher: TeacherCreate, db: Session = Depends(get_db)):
     new_teacher = add_teacher(db=db, teacher=teacher)
-    cache_key = hashkey("teachers")
-    delete_cache(cache_key)
+    invalidate_write("teacher", "insert", new_teacher)
     return new_teacher
 
 @app.get("/teachers/", response_model=list[Teacher])
-def get_teachers(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    cache_key = hashkey("teachers")
-    cached_result = get_cache(cache_key)
-    if cached_result:
-        return cached_result
-
-    teachers = retrieve_teachers(db=db, skip=skip, limit=limit)
-
-    set_cache(cache_key, teachers)
-    return teachers
-
-@app.post("/enrollments/")
-def enroll_student(enrollment: EnrollmentCreate, db: Session = Depends(get_db)):
-    new_enrollment = add_enrollment(db=db, enrollment=enrollment)
-    cache_key = hashkey("enrollments")
-    delete_cache(cache_key)
+def get_teachers(skip: int = 0, limit: int = 100, cursor: Optional[str] = None, fields: Optional[str] = None, ids: Optional[str] = None, db: Session = Depends(get_db)):
+    selected = parse_fields(Teacher, fields)
+    if ids is not None:
+        include_courses = selected is None or "courses" in selected
+        fetch = lambda missing: retrieve_teachers_by_ids(db=db, ids=missing, include_courses=include_courses)
+        return batch_rows("teacher", Teacher, ids, fetch, selected)
+    after_id = decode_cursor(cursor)
+
+    def fetch(db):
+        include_courses = selected is None or "courses" in selected
+        teachers = retrieve_teachers(db=db, skip=skip, limit=limit, include_courses=include_courses, after_id=after_id)
+        page = CachedResponse(serialize_rows(Teacher, teachers, selected), page_headers(teachers, limit))
+        return page, page_dependencies("teacher", teachers, limit, keyset=after_id is not None)
+
+    cache_key = make_cache_key("teachers", skip=skip, limit=limit, after=after_id, fields=selected)
+    return json_response(*cached_page(cache_key, db, fetch))
+
+@app.get("/teachers/{teacher_id}/stats", response_model=TeacherStats)
+def get_teacher_stats(teacher_id: int, db: Session = Depends(get_db)):
+    teacher_stats = retrieve_teacher_stats(db=db, teacher_id=teacher_id)
+    if teacher_stats is None:
+        raise HTTPException(status_code=404, detail="Teacher not found")
+    return teacher_stats
+
+@app.post("/enrollments/", response_model=Enrollment)
+def enroll_student(enrollment: EnrollmentCreate, db: Session = Depends(get_db), request: Request = None):
+    # Enrolling twice is a no-op returning the existing enrollment; a retry
+    # with the same Idempotency-Key also gets the first response back.
+    key = idempotency_key(request)
+    if key is not None:
+        replayed = idempotency_store.replay("POST /enrollments/", key, enrollment.dict())
+        if replayed is not None:
+            return replayed
+
+    new_enrollment, created = add_enrollment(db=db, enrollment=enrollment)
+    if created:
+        invalidate_write("enrollment", "insert", new_enrollment)
+    if key is not None:
+        idempotency_store.remember("POST /enrollments/", key, enrollment.dict(), Enrollment.from_orm(new_enrollment).dict())
     return new_enrollment
 
+@app.post("/enrollments/bulk")
+def enroll_students_bulk(enrollments: List[Dict[str, Any]], db: Session = Depends(get_db)):
+    valid, errors = validate_bulk(EnrollmentCreate, enrollments)
+    created, rejected = add_enrollments_bulk(db=db, enrollments=[item for _, item in valid])
+    invalidate_writes("enrollment", "insert", created)
+    return bulk_result(Enrollment, valid, created, errors, rejected)
+
 @app.delete("/enrollments/{student_id}/{course_id}")
 def disenroll_student(student_id: int, course_id: int, db: Session = Depends(get_db)):
     removed_enrollment = remove_enrollment(db=db, student_id=student_id, course_id=course_id)
-    
-    cache_key = hashkey("enrollments")
-    delete_cache(cache_key)
-    return removed_enrollment
+    if removed_enrollment is None:
+        raise HTTPException(status_code=404, detail="Enrollment not found")
+
+    message, enrollment = removed_enrollment
+    invalidate_write("enrollment", "delete", enrollment)
+    return message
 
 @app.get("/enrollments/", response_model=list[Enrollment])
-def get_enrollments(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    cache_key = hashkey("enrollments")
-    cached_result = get_cache(cache_key)
-    if cached_result:
-        return cached_result
+def get_enrollments(skip: int = 0, limit: int = 100, cursor: Optional[str] = None, db: Session = Depends(get_db)):
+    after_id = decode_cursor(cursor)
 
-    enrollments = retrieve_enrollments(db=db, skip=skip, limit=limit)
+    def fetch(db):
+        enrollments = retrieve_enrollments(db=db, skip=skip, limit=limit, after_id=after_id)
+        page = CachedResponse(serialize_rows(Enrollment, enrollments), page_headers(enrollments, limit))
+        return page, page_dependencies("enrollment", enrollments, limit, keyset=after_id is not None)
 
-    set_cache(cache_key, enrollments)
-    return enrollments
+    cache_key = make_cache_key("enrollments", skip=skip, limit=limit, after=after_id)
+    return json_response(*cached_page(cache_key, db, fetch))
 
 @app.get("/students/{student_id}/enrollments/", response_model=list[Enrollment])
-def get_student_enrollments(student_id: int, skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    enrollments = retrieve_student_enrollments(db=db, student_id=student_id, skip=skip, limit=limit)
-    return enrollments
+def get_student_enrollments(student_id: int, skip: int = 0, limit: int = 100, cursor: Optional[str] = None, db: Session = Depends(get_db)):
+    after_id = decode_cursor(cursor)
+    enrollments = retrieve_student_enrollments(db=db, student_id=student_id, skip=skip, limit=limit, after_id=after_id)
+    return json_response(serialize_rows(Enrollment, enrollments), page_headers(enrollments, limit))
+
+@app.get("/export/{table}.{export_format}")
+def export_table(table: str, export_format: str, db: Session = Depends(get_db)):
+    if table not in EXPORT_TABLES or export_format not in EXPORT_ENCODERS:
+        raise HTTPException(status_code=404, detail="Unknown export")
+    # The stream opens its own connection, so it outlives this request's session.
+    chunks = EXPORT_ENCODERS[export_format](db.get_bind(), EXPORT_TABLES[table])
+    headers = {"Content-Disposition": f'attachment; filename="{table}.{export_format}"'}
+    return StreamingResponse(chunks, media_type=MEDIA_TYPES[export_format], headers=headers)
+
+@app.get("/search", response_model=Dict[str, List[SearchHit]])
+def search_all(q: str = Query(..., min_length=2, max_length=100), limit: int = Query(20, ge=1, le=100), db: Session = Depends(get_db)):
+    # `limit` matches per kind.
+    return {kind: search_records(db=db, kind=kind, query=q, limit=limit) for kind in SEARCH_FIELDS}
+
+@app.get("/search/{kind}", response_model=List[SearchHit])
+def search_kind(kind: str, q: str = Query(..., min_length=2, max_length=100), limit: int = Query(20, ge=1, le=100), db: Session = Depends(get_db)):
+    if kind not in SEARCH_FIELDS:
+        raise HTTPException(status_code=404, detail="Unknown search")
+    return search_records(db=db, kind=kind, query=q, limit=limit)
+
+@app.get("/metrics/pool")
+def get_pool_metrics():
+    return pool_status(setup_database()[3])
+
+@app.get("/metrics")
+def get_metrics():
+    return Response(render_metrics(setup_database()[3]), media_type=METRICS_CONTENT_TYPE)
@@ -0,0 +1,218 @@
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from functools import wraps
+from databases.core import Connection
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.routing import Match
+from src import logs
+from src.cache import cache_stats
+from src.database import pool_status
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# SQL statements run while handling the current request: [count, seconds].
+request_queries = ContextVar("request_queries", default=None)
+
+class Histogram:
+    """Prometheus histogram keyed by a tuple of label values."""
+
+    def __init__(self, name, help, label_names, buckets):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.buckets = buckets
+        self.series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {labels: (list(counts), total, count) for labels, (counts, total, count) in self.series.items()}
+        for labels, (counts, total, count) in sorted(series.items()):
+            label_text = _labels(zip(self.label_names, labels))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_labels([*zip(self.label_names, labels), ('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_bucket{_labels([*zip(self.label_names, labels), ('le', '+Inf')])} {count}")
+            lines.append(f"{self.name}_sum{label_text} {total}")
+            lines.append(f"{self.name}_count{label_text} {count}")
+        return lines
+
+request_duration = Histogram(
+    "http_request_duration_seconds",
+    "Time spent handling a request, by route template.",
+    ("method", "route", "status"),
+    LATENCY_BUCKETS,
+)
+request_db_queries = Histogram(
+    "http_request_db_queries",
+    "SQL statements executed per request.",
+    ("method", "route"),
+    QUERY_COUNT_BUCKETS,
+)
+request_db_duration = Histogram(
+    "http_request_db_duration_seconds",
+    "Time spent in SQL statements per request.",
+    ("method", "route"),
+    LATENCY_BUCKETS,
+)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(pairs):
+    text = ",".join(f'{name}="{_escape(value)}"' for name, value in pairs)
+    return f"{{{text}}}" if text else ""
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_query(conn, cursor, statement, parameters, context, executemany):
+    if request_queries.get() is not None:
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _end_query(conn, cursor, statement, parameters, context, executemany):
+    queries = request_queries.get()
+    if queries is not None and conn.info.get("query_start"):
+        queries[0] += 1
+        queries[1] += time.perf_counter() - conn.info["query_start"].pop()
+
+def _count_queries(method, statements=lambda query, values=None, **kwargs: 1):
+    # The async routes query through `databases`, which bypasses the engine
+    # events above; every Database call ends up in one of these.
+    @wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        queries = request_queries.get()
+        if queries is None:
+            return await method(self, *args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return await method(self, *args, **kwargs)
+        finally:
+            queries[0] += statements(*args, **kwargs)
+            queries[1] += time.perf_counter() - start
+    return wrapper
+
+for _name in ("execute", "fetch_all", "fetch_one", "fetch_val"):
+    setattr(Connection, _name, _count_queries(getattr(Connection, _name)))
+Connection.execute_many = _count_queries(Connection.execute_many, lambda query, values: len(values))
+
+_route_paths = {}
+
+def _match_route(scope):
+    partial = None
+    for route in scope["app"].router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+        if match == Match.PARTIAL and partial is None:
+            partial = route.path
+    return partial or "unmatched"
+
+def route_template(scope):
+    # Label by the route's path template, not the raw path, so ids in URLs
+    # don't create a new series per request.
+    endpoint = scope.get("endpoint")
+    if endpoint is None:
+        # Answered before routing ran (a 304 from ConditionalGet, a 429 from
+        # RateLimit): match the path against the routes ourselves.
+        return _match_route(scope)
+    if endpoint not in _route_paths:
+        paths = [route.path for route in scope["app"].router.routes if getattr(route, "endpoint", None) is endpoint]
+        _route_paths[endpoint] = paths[0] if paths else "unmatched"
+    return _route_paths[endpoint]
+
+class MetricsMiddleware:
+    """ASGI middleware recording latency and SQL work for every HTTP request."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        queries = [0, 0.0]
+        token = request_queries.set(queries)
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            request_queries.reset(token)
+            route = route_template(scope)
+            request_duration.observe((scope["method"], route, status), elapsed)
+            request_db_queries.observe((scope["method"], route), queries[0])
+            request_db_duration.observe((scope["method"], route), queries[1])
+
+def _metric(name, kind, help, samples):
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    lines.extend(f"{name}{_labels(labels)} {value}" for labels, value in samples)
+    return lines
+
+def render_metrics(engine):
+    """Every metric in the Prometheus text exposition format."""
+    lines = []
+    for histogram in (request_duration, request_db_queries, request_db_duration):
+        lines.extend(histogram.render())
+
+    stats = sorted(cache_stats.items())
+    lines.extend(_metric(
+        "cache_lookups_total", "counter", "Response cache lookups by result.",
+        [([("endpoint", endpoint), ("result", result)], counts[result]) for endpoint, counts in stats for result in ("hit", "miss")],
+    ))
+    lines.extend(_metric(
+        "cache_shared_hits_total", "counter", "Lookups answered by the shared backend after a local miss.",
+        [([("endpoint", endpoint)], counts["shared_hit"]) for endpoint, counts in stats],
+    ))
+    lines.extend(_metric(
+        "cache_coalesced_total", "counter", "Cache misses that waited for another request's fetch of the same key.",
+        [([("endpoint", endpoint)], counts["coalesced"]) for endpoint, counts in stats],
+    ))
+    lines.extend(_metric(
+        "cache_stale_served_total", "counter", "Expired entries served while a background refresh ran.",
+        [([("endpoint", endpoint)], counts["stale"]) for endpoint, counts in stats],
+    ))
+    lines.extend(_metric(
+        "cache_evictions_total", "counter", "Cache entries dropped by expiry, the size bound or write invalidation.",
+        [([("endpoint", endpoint), ("reason", reason)], counts[reason]) for endpoint, counts in stats for reason in ("expired", "evicted", "invalidated")],
+    ))
+
+    pool = pool_status(engine)
+    for name in ("size", "checked_out", "overflow"):
+        if name in pool:
+            lines.extend(_metric(f"db_pool_{name}", "gauge", f"Connection pool {name.replace('_', ' ')}.", [((), pool[name])]))
+    for name in ("checkouts", "timeouts", "wait_seconds"):
+        field = "wait_seconds_total" if name == "wait_seconds" else name
+        if field in pool:
+            lines.extend(_metric(f"db_pool_{name}_total", "counter", f"Connection pool {name.replace('_', ' ')}.", [((), pool[field])]))
+
+    if logs.file_sink is not None:
+        lines.extend(_metric("log_records_dropped_total", "counter", "Log records dropped because the queue was full.", [((), logs.file_sink.dropped)]))
+    return "\n".join(lines) + "\n"
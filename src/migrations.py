@@ -0,0 +1,127 @@
+"""Versioned schema migrations.
+
+Run `python -m src.migrations` before starting the app. A fresh database gets
+the current schema from the models and is stamped with the latest version; a
+database created before migrations existed starts at version 0 and has every
+revision applied in order. Revisions are raw SQL so they stay fixed even when
+the models change later.
+"""
+from sqlalchemy import inspect, text
+from loguru import logger
+from src.database import setup_database
+from src.models import Base
+
+VERSION_TABLE = "schema_version"
+
+DUPLICATE_ENROLLMENTS = "FROM enrollment WHERE id NOT IN (SELECT MIN(id) FROM enrollment GROUP BY student_id, course_id)"
+
+def _revision_1(connection):
+    # Keep the oldest row of each duplicated (student, course) pair so the
+    # unique index can be built; the rows removed are logged for the record.
+    duplicates = connection.execute(text(f"SELECT id, student_id, course_id {DUPLICATE_ENROLLMENTS} ORDER BY id")).all()
+    if duplicates:
+        logger.warning(
+            "Deleting {} duplicate enrollments (id, student_id, course_id): {}",
+            len(duplicates), [tuple(row) for row in duplicates],
+        )
+        connection.execute(text(f"DELETE {DUPLICATE_ENROLLMENTS}"))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_course_teacher_id ON course (teacher_id)"))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_lesson_course_id_id ON lesson (course_id, id)"))
+    connection.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_enrollment_student_id_course_id ON enrollment (student_id, course_id)"
+    ))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_enrollment_student_id_id ON enrollment (student_id, id)"))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_enrollment_course_id ON enrollment (course_id)"))
+
+def _revision_2(connection):
+    connection.execute(text(
+        "CREATE TABLE course_stats (course_id INTEGER PRIMARY KEY, "
+        "enrollment_count INTEGER NOT NULL DEFAULT 0, lesson_count INTEGER NOT NULL DEFAULT 0)"
+    ))
+    connection.execute(text(
+        "CREATE TABLE teacher_stats (teacher_id INTEGER PRIMARY KEY, course_count INTEGER NOT NULL DEFAULT 0, "
+        "enrollment_count INTEGER NOT NULL DEFAULT 0, student_count INTEGER NOT NULL DEFAULT 0)"
+    ))
+    connection.execute(text(
+        "CREATE TABLE teacher_student (teacher_id INTEGER NOT NULL, student_id INTEGER NOT NULL, "
+        "enrollment_count INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (teacher_id, student_id))"
+    ))
+    # Backfill from the existing rows.
+    connection.execute(text(
+        "INSERT INTO course_stats (course_id, enrollment_count, lesson_count) "
+        "SELECT c.id, (SELECT COUNT(*) FROM enrollment e WHERE e.course_id = c.id), "
+        "(SELECT COUNT(*) FROM lesson l WHERE l.course_id = c.id) FROM course c"
+    ))
+    connection.execute(text(
+        "INSERT INTO teacher_student (teacher_id, student_id, enrollment_count) "
+        "SELECT c.teacher_id, e.student_id, COUNT(*) FROM enrollment e JOIN course c ON c.id = e.course_id "
+        "WHERE c.teacher_id IS NOT NULL GROUP BY c.teacher_id, e.student_id"
+    ))
+    connection.execute(text(
+        "INSERT INTO teacher_stats (teacher_id, course_count, enrollment_count, student_count) "
+        "SELECT t.id, (SELECT COUNT(*) FROM course c WHERE c.teacher_id = t.id), "
+        "(SELECT COALESCE(SUM(ts.enrollment_count), 0) FROM teacher_student ts WHERE ts.teacher_id = t.id), "
+        "(SELECT COUNT(*) FROM teacher_student ts WHERE ts.teacher_id = t.id) FROM teacher t"
+    ))
+
+def _revision_3(connection):
+    # SQLite searches an in-process index instead.
+    if connection.dialect.name != "postgresql":
+        return
+    trigram = connection.execute(text("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")).first() is not None
+    if trigram:
+        connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    for table, column in (("course", "name"), ("lesson", "title"), ("teacher", "name"), ("student", "username")):
+        connection.execute(text(
+            f"CREATE INDEX IF NOT EXISTS ix_{table}_{column}_search ON {table} "
+            f"USING gin (to_tsvector('simple', coalesce({column}, '')))"
+        ))
+        if trigram:
+            connection.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{table}_{column}_trgm ON {table} USING gin ({column} gin_trgm_ops)"))
+
+# (version, description, upgrade function), in order.
+REVISIONS = [
+    (1, "Index hot filter columns and make enrollments unique per student and course", _revision_1),
+    (2, "Add counter tables for course and teacher statistics", _revision_2),
+    (3, "Index course, lesson, teacher and student names for search", _revision_3),
+]
+
+HEAD = REVISIONS[-1][0]
+
+def current_version(connection):
+    if not inspect(connection).has_table(VERSION_TABLE):
+        return None
+    return connection.execute(text(f"SELECT version FROM {VERSION_TABLE}")).scalar()
+
+def upgrade(bind=None):
+    """Bring the schema behind `bind` (the app's engine by default) up to
+    HEAD; returns the final version."""
+    if bind is None:
+        bind = setup_database()[3]
+    with bind.begin() as connection:
+        if connection.dialect.name == "postgresql":
+            # Serialize workers or containers that start at the same time.
+            connection.execute(text("SELECT pg_advisory_xact_lock(hashtext('focusedai_migrations'))"))
+
+        version = current_version(connection)
+        if version is None:
+            connection.execute(text(f"CREATE TABLE {VERSION_TABLE} (version INTEGER NOT NULL)"))
+            if inspect(connection).has_table("course"):
+                version = 0
+            else:
+                Base.metadata.create_all(connection)
+                version = HEAD
+            connection.execute(text(f"INSERT INTO {VERSION_TABLE} (version) VALUES (:version)"), {"version": version})
+
+        for revision, description, apply in REVISIONS:
+            if revision <= version:
+                continue
+            logger.info("Applying schema revision {}: {}", revision, description)
+            apply(connection)
+            connection.execute(text(f"UPDATE {VERSION_TABLE} SET version = :version"), {"version": revision})
+            version = revision
+
+    return version
+
+if __name__ == "__main__":
+    print(f"Schema at version {upgrade()}")
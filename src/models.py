@@ -1,12 +1,18 @@
-from sqlalchemy import Column, ForeignKey, Integer, String
+from sqlalchemy import Column, ForeignKey, Index, Integer, String, event
 from sqlalchemy.orm import relationship
-from src.database import setup_database
+from src.database import Base, setup_database
 
-
-SessionLocal, database, Base, engine = setup_database()
+def __getattr__(name):
+    # SessionLocal, database and engine are looked up on first use, so
+    # importing the models opens no engine.
+    if name in ("SessionLocal", "database", "engine"):
+        SessionLocal, database, _, engine = setup_database()
+        return {"SessionLocal": SessionLocal, "database": database, "engine": engine}[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 class Course(Base):
     __tablename__ = "course"
+    __table_args__ = (Index("ix_course_teacher_id", "teacher_id"),)
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String)
     teacher_id = Column(Integer, ForeignKey("teacher.id"))
@@ -22,6 +28,7 @@ class Teacher(Base):
 
 class Lesson(Base):
     __tablename__ = "lesson"
+    __table_args__ = (Index("ix_lesson_course_id_id", "course_id", "id"),)
     id = Column(Integer, primary_key=True, index=True)
     title = Column(String)
     course_id = Column(Integer, ForeignKey("course.id"))
@@ -35,10 +42,43 @@ class Student(Base):
 
 class Enrollment(Base):
     __tablename__ = "enrollment"
+    __table_args__ = (
+        Index("uq_enrollment_student_id_course_id", "student_id", "course_id", unique=True),
+        Index("ix_enrollment_student_id_id", "student_id", "id"),
+        Index("ix_enrollment_course_id", "course_id"),
+    )
     id = Column(Integer, primary_key=True, index=True)
     student_id = Column(Integer, ForeignKey("student.id"))
     course_id = Column(Integer, ForeignKey("course.id"))
     student = relationship("Student", back_populates="enrollments")
     course = relationship("Course", back_populates="enrollments")
 
-Base.metadata.create_all(engine)
\ No newline at end of file
+# Running totals kept by src/stats.py; no foreign keys, so a course's row can
+# go in the same transaction that deletes the course.
+class CourseStats(Base):
+    __tablename__ = "course_stats"
+    course_id = Column(Integer, primary_key=True, autoincrement=False)
+    enrollment_count = Column(Integer, nullable=False, default=0)
+    lesson_count = Column(Integer, nullable=False, default=0)
+
+class TeacherStats(Base):
+    __tablename__ = "teacher_stats"
+    teacher_id = Column(Integer, primary_key=True, autoincrement=False)
+    course_count = Column(Integer, nullable=False, default=0)
+    enrollment_count = Column(Integer, nullable=False, default=0)
+    student_count = Column(Integer, nullable=False, default=0)
+
+class TeacherStudent(Base):
+    __tablename__ = "teacher_student"
+    teacher_id = Column(Integer, primary_key=True, autoincrement=False)
+    student_id = Column(Integer, primary_key=True, autoincrement=False)
+    enrollment_count = Column(Integer, nullable=False, default=0)
+
+@event.listens_for(Base.metadata, "after_create")
+def create_search_indexes(target, connection, **kw):
+    # GIN indexes can't be declared portably; other databases search an
+    # in-process index (see src/search.py).
+    if connection.dialect.name == "postgresql":
+        from src.search import create_indexes
+
+        create_indexes(connection)
@@ -0,0 +1,32 @@
+import base64
+import binascii
+import json
+from collections.abc import Mapping
+from fastapi import HTTPException
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+def encode_cursor(after_id):
+    return base64.urlsafe_b64encode(json.dumps({"after": after_id}).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor):
+    """Return the id a `?cursor=` value resumes after, or None in offset mode."""
+    if cursor is None:
+        return None
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        after_id = json.loads(base64.urlsafe_b64decode(padded))["after"]
+    except (binascii.Error, ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    # bool is an int subclass: {"after": true} must not resume after id 1.
+    if type(after_id) is not int:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return after_id
+
+def page_headers(rows, limit):
+    # A short page is the last one; a full page may have more rows after it.
+    if not rows or len(rows) < limit:
+        return {}
+    last = rows[-1]
+    last_id = last["id"] if isinstance(last, Mapping) else last.id
+    return {NEXT_CURSOR_HEADER: encode_cursor(last_id)}
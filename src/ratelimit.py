@@ -0,0 +1,177 @@
+import json
+import math
+import os
+import time
+from cachetools import TTLCache
+from dotenv import load_dotenv
+from loguru import logger
+from src.errors import ERROR_RATE_LIMITED
+from src.routing import RouteMatcher
+
+load_dotenv()
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL", "")
+# Behind a trusted proxy, identify clients by this header (e.g. X-Forwarded-For)
+# instead of the connecting address.
+RATE_LIMIT_CLIENT_HEADER = os.getenv("RATE_LIMIT_CLIENT_HEADER", "").lower()
+# Proxies in front of the app that append to that header. Entries left of the
+# last one they added come from the client and can be forged, so the client
+# is the entry this many hops from the right.
+RATE_LIMIT_TRUSTED_PROXIES = int(os.getenv("RATE_LIMIT_TRUSTED_PROXIES", "1"))
+
+# (requests per second, burst) for each client; routes not listed in
+# ROUTE_LIMITS share one read or one write bucket per client.
+READ_LIMIT = (float(os.getenv("RATE_LIMIT_READ_RATE", "50")), int(os.getenv("RATE_LIMIT_READ_BURST", "100")))
+WRITE_LIMIT = (float(os.getenv("RATE_LIMIT_WRITE_RATE", "10")), int(os.getenv("RATE_LIMIT_WRITE_BURST", "20")))
+
+# Routes with a bucket of their own, keyed by (method, path template); None
+# exempts the route.
+ROUTE_LIMITS = {
+    ("POST", "/enrollments/"): (5, 10),
+    ("POST", "/students/bulk"): (0.2, 2),
+    ("POST", "/enrollments/bulk"): (0.2, 2),
+    ("GET", "/export/{table}.{export_format}"): (0.1, 2),
+    ("GET", "/metrics"): None,
+    ("GET", "/metrics/pool"): None,
+}
+
+READ_METHODS = ("GET", "HEAD", "OPTIONS")
+
+# Bucket state kept in process; a bucket idle long enough to refill is
+# indistinguishable from a new one, so expiring it loses nothing.
+IN_PROCESS_MAX_BUCKETS = 100000
+IN_PROCESS_BUCKET_TTL = 600
+
+class InProcessBackend:
+    """Token buckets for one worker process. Only touched from the event
+    loop, so no locking is needed."""
+
+    def __init__(self, maxsize=IN_PROCESS_MAX_BUCKETS, ttl=IN_PROCESS_BUCKET_TTL, clock=time.monotonic):
+        self.buckets = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.clock = clock
+
+    async def acquire(self, key, rate, burst):
+        """Take one token; returns 0 if allowed, otherwise the seconds until
+        a token is available."""
+        now = self.clock()
+        tokens, updated = self.buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / rate
+        self.buckets[key] = (tokens, now)
+        return wait
+
+class RedisBackend:
+    """Token buckets in Redis, shared by every worker and container. The
+    refill-and-take runs as one Lua script on Redis' clock, so concurrent
+    workers cannot both spend the last token."""
+
+    prefix = "focusedai:ratelimit:"
+
+    script = """
+    local rate = tonumber(ARGV[1])
+    local burst = tonumber(ARGV[2])
+    local clock = redis.call('TIME')
+    local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+    local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+    local tokens = tonumber(state[1]) or burst
+    local updated = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+    local wait = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+    else
+        wait = (1 - tokens) / rate
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+    redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+    return tostring(wait)
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self._acquire = client.register_script(self.script)
+
+    @classmethod
+    def from_url(cls, url):
+        import redis.asyncio
+
+        return cls(redis.asyncio.Redis.from_url(url))
+
+    async def acquire(self, key, rate, burst):
+        name = f"{self.prefix}{json.dumps(key)}"
+        return float(await self._acquire(keys=[name], args=[rate, burst]))
+
+def default_backend():
+    if RATE_LIMIT_REDIS_URL:
+        return RedisBackend.from_url(RATE_LIMIT_REDIS_URL)
+    return InProcessBackend()
+
+class RateLimitMiddleware:
+    """ASGI middleware answering 429 with Retry-After once a client's token
+    bucket for the route is empty."""
+
+    def __init__(self, app, backend=None, route_limits=None, read_limit=READ_LIMIT, write_limit=WRITE_LIMIT, enabled=None):
+        self.app = app
+        self.backend = backend if backend is not None else default_backend()
+        self.route_limits = ROUTE_LIMITS if route_limits is None else route_limits
+        self.class_limits = {"read": read_limit, "write": write_limit}
+        self.enabled = RATE_LIMIT_ENABLED if enabled is None else enabled
+        self.routes = RouteMatcher(self.route_limits)
+
+    def _bucket(self, scope):
+        route = self.routes.match(scope)
+        if route is not None:
+            return route[1], self.route_limits[route]
+        bucket = "read" if scope["method"] in READ_METHODS else "write"
+        return bucket, self.class_limits[bucket]
+
+    def _client(self, scope):
+        if RATE_LIMIT_CLIENT_HEADER and RATE_LIMIT_TRUSTED_PROXIES > 0:
+            # Repeated headers count as one comma-separated list, in order.
+            entries = [
+                entry.strip()
+                for name, value in scope["headers"]
+                if name.decode("latin-1") == RATE_LIMIT_CLIENT_HEADER
+                for entry in value.decode("latin-1").split(",")
+            ]
+            if len(entries) >= RATE_LIMIT_TRUSTED_PROXIES and entries[-RATE_LIMIT_TRUSTED_PROXIES]:
+                return entries[-RATE_LIMIT_TRUSTED_PROXIES]
+        client = scope.get("client")
+        return client[0] if client else "unknown"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        bucket, limit = self._bucket(scope)
+        if limit is not None:
+            rate, burst = limit
+            try:
+                wait = await self.backend.acquire((self._client(scope), bucket), rate, burst)
+            except Exception as e:
+                # Fail open: an unreachable limiter must not take the API down.
+                logger.warning("Rate limiter unavailable: {}", e)
+                wait = 0
+            if wait > 0:
+                await self._reject(send, wait)
+                return
+        await self.app(scope, receive, send)
+
+    async def _reject(self, send, wait):
+        body = json.dumps({"detail": ERROR_RATE_LIMITED}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": 429,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(math.ceil(wait)).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,35 @@
+class RouteMatcher:
+    """Finds which of a fixed set of (method, path template) keys a request
+    is for, before routing has run.
+
+    Only the routes behind those keys are checked, so middleware that cares
+    about a handful of routes pays a few regex matches per request rather
+    than a pass over the whole routing table.
+    """
+
+    def __init__(self, keys):
+        self.keys = set(keys)
+        self._patterns = None
+
+    def _route_patterns(self, router):
+        if self._patterns is None:
+            self._patterns = {}
+            for route in router.routes:
+                for method in getattr(route, "methods", None) or ():
+                    if (method, route.path) in self.keys:
+                        self._patterns.setdefault(method, []).append((route.path_regex, route.path))
+        return self._patterns
+
+    def match(self, scope):
+        method = scope["method"]
+        for regex, path in self._route_patterns(scope["app"].router).get(method, ()):
+            if regex.match(scope["path"]):
+                return method, path
+        return None
+
+def request_header(scope, name):
+    """First value of a request header (`name` as lowercase bytes), or None."""
+    for key, value in scope["headers"]:
+        if key == name:
+            return value.decode("latin-1")
+    return None
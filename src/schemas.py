@@ -66,4 +66,25 @@ class Enrollment(EnrollmentBase):
     class Config:
         orm_mode = True
 
+class CourseStats(BaseModel):
+    course_id: int
+    enrollment_count: int
+    lesson_count: int
+
+    class Config:
+        orm_mode = True
+
+class TeacherStats(BaseModel):
+    teacher_id: int
+    course_count: int
+    enrollment_count: int
+    student_count: int
+
+    class Config:
+        orm_mode = True
+
+class SearchHit(BaseModel):
+    id: int
+    text: str
+
 Student.update_forward_refs()
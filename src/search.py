@@ -0,0 +1,136 @@
+"""Ranked search over course names, lesson titles, teacher names and student
+usernames.
+
+On Postgres the database does the matching: every word of the query must be
+a prefix of a word in the column, through a `simple` tsvector GIN index, and
+where the pg_trgm extension is installed a trigram index also finds near
+misses ("pyhton") and ranks by similarity. Other databases (SQLite) search an
+in-process prefix index over the column instead, rebuilt after writes to its
+table or every SEARCH_INDEX_TTL seconds.
+
+Results starting with the whole query come first, then the best matches.
+"""
+import bisect
+import heapq
+import os
+import re
+import threading
+import time
+from dotenv import load_dotenv
+from sqlalchemy import text
+from src import cache
+
+load_dotenv()
+
+# Bounds how long the in-process index misses writes made around the app
+# (other workers without a shared cache, seeding scripts).
+SEARCH_INDEX_TTL = float(os.getenv("SEARCH_INDEX_TTL", "60"))
+
+# Searchable kinds: (table, column).
+SEARCH_FIELDS = {
+    "courses": ("course", "name"),
+    "lessons": ("lesson", "title"),
+    "teachers": ("teacher", "name"),
+    "students": ("student", "username"),
+}
+
+def _document(column):
+    # Must match the indexed expression exactly for the index to be used.
+    return f"to_tsvector('simple', coalesce({column}, ''))"
+
+PREFIX_SQL = (
+    "SELECT id, {column} AS text FROM {table} "
+    "WHERE {document} @@ to_tsquery('simple', :tsquery) "
+    "ORDER BY starts_with(lower({column}), :lowered) DESC, "
+    "ts_rank({document}, to_tsquery('simple', :tsquery)) DESC, length({column}), id LIMIT :limit"
+)
+TRIGRAM_SQL = (
+    "SELECT id, {column} AS text FROM {table} "
+    "WHERE {document} @@ to_tsquery('simple', :tsquery) OR {column} % :query "
+    "ORDER BY starts_with(lower({column}), :lowered) DESC, similarity({column}, :query) DESC, id LIMIT :limit"
+)
+
+def create_indexes(connection):
+    """The Postgres indexes behind search; trigram ones only where pg_trgm
+    is available."""
+    trigram = connection.execute(text("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")).first() is not None
+    if trigram:
+        connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    for table, column in SEARCH_FIELDS.values():
+        connection.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{table}_{column}_search ON {table} USING gin ({_document(column)})"))
+        if trigram:
+            connection.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{table}_{column}_trgm ON {table} USING gin ({column} gin_trgm_ops)"))
+
+def terms(value):
+    # The words to_tsvector's parser would mostly find: runs of letters and digits.
+    return re.findall(r"[^\W_]+", (value or "").lower())
+
+def _rank(query, value):
+    lowered = value.lower()
+    return (not lowered.startswith(query), len(lowered))
+
+class PrefixIndex:
+    """(word, id) pairs sorted by word, so the rows with a word starting with
+    a prefix are one bisection away."""
+
+    def __init__(self, rows):
+        self.values = {row_id: value or "" for row_id, value in rows}
+        self.entries = sorted({(term, row_id) for row_id, value in self.values.items() for term in terms(value)})
+        self.words = [term for term, _ in self.entries]
+
+    def _ids(self, prefix):
+        start = bisect.bisect_left(self.words, prefix)
+        end = bisect.bisect_left(self.words, prefix + "\U0010ffff", start)
+        return {row_id for _, row_id in self.entries[start:end]}
+
+    def search(self, query, limit):
+        words = terms(query)
+        if not words:
+            return []
+        matches = [self._ids(word) for word in words]
+        ids = set.intersection(*sorted(matches, key=len))
+        lowered = query.strip().lower()
+        best = heapq.nsmallest(limit, ids, key=lambda row_id: (*_rank(lowered, self.values[row_id]), row_id))
+        return [{"id": row_id, "text": self.values[row_id]} for row_id in best]
+
+_indexes = {}
+_trigram = {}
+_lock = threading.Lock()
+
+def _index(db, table, column):
+    # One index per database and table, current while the table's write
+    # counter (see cache.versions) has not moved.
+    key = (str(db.get_bind().url), table)
+    version = cache.versions((table,))
+    with _lock:
+        built = _indexes.get(key)
+        if built is None or built[0] != version or time.monotonic() - built[1] > SEARCH_INDEX_TTL:
+            rows = db.execute(text(f"SELECT id, {column} FROM {table}")).all()
+            built = (version, time.monotonic(), PrefixIndex(rows))
+            _indexes[key] = built
+    return built[2]
+
+def _has_trigram(db):
+    key = str(db.get_bind().url)
+    if key not in _trigram:
+        _trigram[key] = db.execute(text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")).first() is not None
+    return _trigram[key]
+
+def search(db, kind, query, limit):
+    """Up to `limit` {"id", "text"} matches of `query` among `kind`, best first."""
+    table, column = SEARCH_FIELDS[kind]
+    words = terms(query)
+    if not words:
+        return []
+    if db.get_bind().dialect.name != "postgresql":
+        return _index(db, table, column).search(query, limit)
+
+    sql = TRIGRAM_SQL if _has_trigram(db) else PREFIX_SQL
+    params = {
+        "tsquery": " & ".join(f"{word}:*" for word in words),
+        "query": query,
+        "lowered": query.strip().lower(),
+        "limit": limit,
+    }
+    rows = db.execute(text(sql.format(table=table, column=column, document=_document(column))), params).all()
+    return [{"id": row.id, "text": row.text} for row in rows]
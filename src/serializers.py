@@ -0,0 +1,91 @@
+import json
+import os
+from functools import lru_cache
+from dotenv import load_dotenv
+from fastapi import HTTPException, Response
+from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel
+from src.compression import PrecompressedResponse
+
+try:
+    import orjson
+except ImportError:  # optional: the standard library encoder produces the same bytes, just slower
+    orjson = None
+
+load_dotenv()
+
+# Most ids one batch read (`?ids=1,2,3`) may ask for.
+BATCH_MAX_IDS = int(os.getenv("BATCH_MAX_IDS", "100"))
+
+def parse_fields(schema, fields):
+    """Turn a `?fields=id,name` query value into a sorted tuple of field
+    names, or None when every field was requested."""
+    if fields is None:
+        return None
+    selected = {name.strip() for name in fields.split(",") if name.strip()}
+    unknown = selected - set(schema.__fields__)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+    return tuple(sorted(selected))
+
+def parse_ids(ids):
+    """Turn a `?ids=1,2,3` query value into a list of ids, in request order."""
+    try:
+        values = [int(value) for value in ids.split(",") if value.strip()]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ids must be comma-separated integers")
+    if not values:
+        raise HTTPException(status_code=400, detail="ids must not be empty")
+    if len(values) > BATCH_MAX_IDS:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_IDS} ids per request")
+    return values
+
+def serialize(schema, rows, fields=None):
+    # Same output FastAPI produces for response_model=list[schema].
+    include = set(fields) if fields is not None else None
+    content = jsonable_encoder([schema.validate(row) for row in rows], include=include)
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+def dumps(content):
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+@lru_cache(maxsize=None)
+def _layout(schema):
+    # (field name, nested layout or None) in the schema's field order, which
+    # is the key order pydantic serializes in.
+    layout = []
+    for name, field in schema.__fields__.items():
+        nested = field.type_ if isinstance(field.type_, type) and issubclass(field.type_, BaseModel) else None
+        layout.append((name, _layout(nested) if nested is not None else None))
+    return tuple(layout)
+
+def _shape(layout, row, include=None):
+    return {
+        name: [_shape(nested, child) for child in row.get(name, ())] if nested is not None else row[name]
+        for name, nested in layout
+        if include is None or name in include
+    }
+
+def serialize_rows(schema, rows, fields=None):
+    """Fast path of `serialize` for rows that are already plain mappings of
+    column values (see the list functions in src/crud.py): no per-row
+    pydantic validation or jsonable_encoder pass, same JSON bytes."""
+    layout = _layout(schema)
+    include = set(fields) if fields is not None else None
+    return dumps([_shape(layout, row, include) for row in rows])
+
+def serialize_row(schema, row, fields=None):
+    include = set(fields) if fields is not None else None
+    return dumps(_shape(_layout(schema), row, include))
+
+def join_rows(bodies, ids):
+    # A JSON array of the serialized rows in `ids` order, null for the ids
+    # with no row.
+    return b"[" + b",".join(bodies.get(row_id, b"null") for row_id in ids) + b"]"
+
+def json_response(body, headers=None, encodings=None):
+    if encodings:
+        return PrecompressedResponse(body, encodings, media_type="application/json", headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
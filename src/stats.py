@@ -0,0 +1,128 @@
+"""Counters behind the /stats routes.
+
+course_stats and teacher_stats hold running totals, so reading them is one
+primary key lookup instead of counting enrollments and lessons. The CRUD
+layers move them in the same transaction as the write that changes the
+totals. teacher_student counts each student's enrollments with a teacher, so
+the teacher's distinct student count only moves when that count leaves or
+reaches zero.
+
+Writes are plain SQL with named parameters so the ORM session
+(`Session.execute(text(sql), params)`) and the async `databases` layer
+(`Database.execute_many(sql, params)`) run the same statements.
+"""
+from collections import Counter
+
+ADD_COURSE = "INSERT INTO course_stats (course_id, enrollment_count, lesson_count) VALUES (:course_id, 0, 0)"
+REMOVE_COURSE = "DELETE FROM course_stats WHERE course_id = :course_id"
+COURSE_LESSONS = "UPDATE course_stats SET lesson_count = lesson_count + :delta WHERE course_id = :course_id"
+COURSE_ENROLLMENTS = "UPDATE course_stats SET enrollment_count = enrollment_count + :delta WHERE course_id = :course_id"
+
+ADD_TEACHER = (
+    "INSERT INTO teacher_stats (teacher_id, course_count, enrollment_count, student_count) "
+    "VALUES (:teacher_id, 0, 0, 0)"
+)
+TEACHER_COURSES = "UPDATE teacher_stats SET course_count = course_count + :delta WHERE teacher_id = :teacher_id"
+TEACHER_ENROLLMENTS = "UPDATE teacher_stats SET enrollment_count = enrollment_count + :delta WHERE teacher_id = :teacher_id"
+
+ADD_TEACHER_STUDENT = (
+    "INSERT INTO teacher_student (teacher_id, student_id, enrollment_count) "
+    "VALUES (:teacher_id, :student_id, 0) ON CONFLICT DO NOTHING"
+)
+TEACHER_STUDENT_ENROLLMENTS = (
+    "UPDATE teacher_student SET enrollment_count = enrollment_count + :delta "
+    "WHERE teacher_id = :teacher_id AND student_id = :student_id"
+)
+# Run after TEACHER_STUDENT_ENROLLMENTS, whose row lock is held until commit,
+# so only one transaction sees the pair's count at :delta (first enrollment)
+# or at 0 (last one gone).
+STUDENT_GAINED = (
+    "UPDATE teacher_stats SET student_count = student_count + 1 WHERE teacher_id = :teacher_id AND "
+    "(SELECT enrollment_count FROM teacher_student WHERE teacher_id = :teacher_id AND student_id = :student_id) = :delta"
+)
+STUDENT_LOST = (
+    "UPDATE teacher_stats SET student_count = student_count - 1 WHERE teacher_id = :teacher_id AND "
+    "(SELECT enrollment_count FROM teacher_student WHERE teacher_id = :teacher_id AND student_id = :student_id) = 0"
+)
+
+# Recount every total from the tables themselves, for data loaded around the
+# CRUD layers (see benchmarks/seed.py).
+REBUILD = [
+    "DELETE FROM course_stats",
+    "DELETE FROM teacher_stats",
+    "DELETE FROM teacher_student",
+    "INSERT INTO course_stats (course_id, enrollment_count, lesson_count) "
+    "SELECT c.id, (SELECT COUNT(*) FROM enrollment e WHERE e.course_id = c.id), "
+    "(SELECT COUNT(*) FROM lesson l WHERE l.course_id = c.id) FROM course c",
+    "INSERT INTO teacher_student (teacher_id, student_id, enrollment_count) "
+    "SELECT c.teacher_id, e.student_id, COUNT(*) FROM enrollment e JOIN course c ON c.id = e.course_id "
+    "WHERE c.teacher_id IS NOT NULL GROUP BY c.teacher_id, e.student_id",
+    "INSERT INTO teacher_stats (teacher_id, course_count, enrollment_count, student_count) "
+    "SELECT t.id, (SELECT COUNT(*) FROM course c WHERE c.teacher_id = t.id), "
+    "(SELECT COALESCE(SUM(ts.enrollment_count), 0) FROM teacher_student ts WHERE ts.teacher_id = t.id), "
+    "(SELECT COUNT(*) FROM teacher_student ts WHERE ts.teacher_id = t.id) FROM teacher t",
+]
+
+def course_added(course_id, teacher_id):
+    return [(ADD_COURSE, [{"course_id": course_id}]), (TEACHER_COURSES, [{"teacher_id": teacher_id, "delta": 1}])]
+
+def teacher_added(teacher_id):
+    return [(ADD_TEACHER, [{"teacher_id": teacher_id}])]
+
+def lesson_added(course_id):
+    return [(COURSE_LESSONS, [{"course_id": course_id, "delta": 1}])]
+
+def _teacher_enrollments(pairs, delta):
+    # `pairs` counts enrollments per (teacher_id, student_id).
+    per_teacher = Counter()
+    for (teacher_id, _), count in pairs.items():
+        per_teacher[teacher_id] += count
+    if not per_teacher:
+        return []
+
+    student_params = [
+        {"teacher_id": teacher_id, "student_id": student_id, "delta": delta * count}
+        for (teacher_id, student_id), count in sorted(pairs.items())
+    ]
+    pair_params = [{"teacher_id": params["teacher_id"], "student_id": params["student_id"]} for params in student_params]
+    changes = [(TEACHER_ENROLLMENTS, [{"teacher_id": teacher_id, "delta": delta * count} for teacher_id, count in sorted(per_teacher.items())])]
+    if delta > 0:
+        changes.append((ADD_TEACHER_STUDENT, pair_params))
+        changes.append((TEACHER_STUDENT_ENROLLMENTS, student_params))
+        changes.append((STUDENT_GAINED, student_params))
+    else:
+        changes.append((TEACHER_STUDENT_ENROLLMENTS, student_params))
+        changes.append((STUDENT_LOST, pair_params))
+    return changes
+
+def enrollments_changed(enrollments, course_teachers, delta):
+    """Counter changes for `enrollments` (mappings with student_id and
+    course_id) being added (delta 1) or removed (delta -1). `course_teachers`
+    maps their course ids to teacher ids; enrollments in courses that no
+    longer exist only leave the course totals alone."""
+    per_course = Counter(enrollment["course_id"] for enrollment in enrollments)
+    pairs = Counter(
+        (course_teachers[enrollment["course_id"]], enrollment["student_id"])
+        for enrollment in enrollments
+        if course_teachers.get(enrollment["course_id"]) is not None
+    )
+    changes = []
+    if per_course:
+        changes.append((COURSE_ENROLLMENTS, [{"course_id": course_id, "delta": delta * count} for course_id, count in sorted(per_course.items())]))
+    return changes + _teacher_enrollments(pairs, delta)
+
+def _course_teacher_changes(student_ids, teacher_id, delta):
+    if teacher_id is None:
+        return []
+    changes = [(TEACHER_COURSES, [{"teacher_id": teacher_id, "delta": delta}])]
+    return changes + _teacher_enrollments(Counter((teacher_id, student_id) for student_id in student_ids), delta)
+
+def course_moved(student_ids, old_teacher_id, new_teacher_id):
+    """Counter changes for a course, with the given enrolled students, going
+    from one teacher to another."""
+    if old_teacher_id == new_teacher_id:
+        return []
+    return _course_teacher_changes(student_ids, old_teacher_id, -1) + _course_teacher_changes(student_ids, new_teacher_id, 1)
+
+def course_removed(course_id, student_ids, teacher_id):
+    return [(REMOVE_COURSE, [{"course_id": course_id}])] + _course_teacher_changes(student_ids, teacher_id, -1)
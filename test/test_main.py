@@ -1,4 +1,6 @@
 from fastapi.testclient import TestClient
+import base64
+import json
 import sys
 
 import pytest
@@ -6,9 +8,11 @@ sys.path.append("./src")
 from src.main import *
 from src.crud import *
 from src.models import *
+from src.migrations import upgrade
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
+upgrade()
 client = TestClient(app)
 
 @pytest.fixture(scope="session")
@@ -78,13 +82,91 @@ def test_delete_course(db):
     new_course = add_course(db=db, course=course_data)
     
     response = get_courses(db=db)
-    before_delete_course = len(response)
+    before_delete_course = len(json.loads(response.body))
     
     response = delete_course(db=db, course_id=new_course.id)
     assert response == f"Course with ID {new_course.id} has been deleted"
     
     response = get_courses(db=db)
-    assert before_delete_course == len(response) + 1
+    assert before_delete_course == len(json.loads(response.body)) + 1
+
+def test_get_courses_cache_is_keyed_on_pagination(db):
+    teacher = Teacher(name="Test Teacher Name")
+    db.add(teacher)
+    db.commit()
+
+    create_course(CourseCreate(name="First Page Course", teacher_id=teacher.id), db)
+    create_course(CourseCreate(name="Second Page Course", teacher_id=teacher.id), db)
+
+    first_page = get_courses(skip=0, limit=1, db=db)
+    second_page = get_courses(skip=1, limit=1, db=db)
+    assert first_page.body != second_page.body
+
+    # A hit is served from the stored bytes without touching the session.
+    assert get_courses(skip=1, limit=1, db=None).body == second_page.body
+
+def test_course_write_invalidates_only_dependent_entries(db):
+    teacher = Teacher(name="Test Teacher Name")
+    db.add(teacher)
+    db.commit()
+    create_course(CourseCreate(name="Test Course", teacher_id=teacher.id), db)
+    create_course(CourseCreate(name="Test Course", teacher_id=teacher.id), db)
+
+    get_courses(skip=0, limit=1, db=db)
+    teachers = json.loads(get_teachers(skip=0, limit=1000, db=db).body)
+    assert any(t["id"] == teacher.id for t in teachers)
+
+    create_course(CourseCreate(name="Another Course", teacher_id=teacher.id), db)
+
+    # The full first course page cannot contain the new row and stays cached,
+    # while the teacher listing nests the teacher's courses and is evicted.
+    assert get_cache(make_cache_key("courses", skip=0, limit=1)) is not None
+    assert get_cache(make_cache_key("teachers", skip=0, limit=1000)) is None
+
+def test_enrollment_write_invalidates_student_listing(db):
+    teacher = Teacher(name="Test Teacher Name")
+    db.add(teacher)
+    student = Student(username="Test Student Username")
+    db.add(student)
+    db.commit()
+    course = Course(name="Test Course Name", teacher_id=teacher.id)
+    db.add(course)
+    db.commit()
+
+    get_students(skip=0, limit=1000, db=db)
+    assert get_cache(make_cache_key("students", skip=0, limit=1000)) is not None
+
+    enroll_student(EnrollmentCreate(student_id=student.id, course_id=course.id), db)
+    assert get_cache(make_cache_key("students", skip=0, limit=1000)) is None
+
+def test_get_lessons_for_course_keyset_pagination(db):
+    teacher = Teacher(name="Test Teacher Name")
+    db.add(teacher)
+    db.commit()
+    course = Course(name="Test Course Name", teacher_id=teacher.id)
+    db.add(course)
+    db.commit()
+    for index in range(5):
+        create_lesson(LessonCreate(title=f"Lesson {index}", course_id=course.id), db)
+
+    titles = []
+    cursor = None
+    while True:
+        response = get_lessons_for_course(course_id=course.id, limit=2, cursor=cursor, db=db)
+        titles += [lesson["title"] for lesson in json.loads(response.body)]
+        cursor = response.headers.get("x-next-cursor")
+        if cursor is None:
+            break
+
+    assert titles == [f"Lesson {index}" for index in range(5)]
+
+    response = client.get(f"/courses/{course.id}/lessons/", params={"cursor": "not-a-cursor"})
+    assert response.status_code == 400
+
+    for value in (True, False):
+        forged = base64.urlsafe_b64encode(json.dumps({"after": value}).encode()).decode().rstrip("=")
+        response = client.get(f"/courses/{course.id}/lessons/", params={"cursor": forged})
+        assert response.status_code == 400
 
 def test_create_student(db):
     student_data = StudentCreate(username="Test Student")
@@ -110,6 +192,32 @@ def test_get_teachers(db):
     response = client.get("/teachers/")
     assert response.status_code == 200
 
+def test_get_teachers_loads_courses_without_n_plus_one(db):
+    from sqlalchemy import event
+
+    for index in range(3):
+        teacher = Teacher(name=f"Eager Teacher {index}")
+        db.add(teacher)
+        db.commit()
+        db.add(Course(name=f"Eager Course {index}", teacher_id=teacher.id))
+    db.commit()
+    db.expire_all()
+
+    statements = []
+    record = lambda *args: statements.append(args[2])
+    event.listen(db.get_bind(), "before_cursor_execute", record)
+    try:
+        teachers = json.loads(get_teachers(skip=0, limit=500, db=db).body)
+        assert len(statements) == 2
+        assert all("courses" in teacher for teacher in teachers)
+
+        statements.clear()
+        teachers = json.loads(get_teachers(skip=0, limit=500, fields="id,name", db=db).body)
+        assert len(statements) == 1
+        assert all(set(teacher) == {"id", "name"} for teacher in teachers)
+    finally:
+        event.remove(db.get_bind(), "before_cursor_execute", record)
+
 def test_create_lesson(db):
     teacher = Teacher(name="Test Teacher Name")
     db.add(teacher)
@@ -170,6 +278,49 @@ def test_create_enrollment(db):
     assert response.student_id == student.id
     assert response.course_id == course.id  
 
+def test_enroll_students_bulk(db):
+    teacher = Teacher(name="Test Teacher Name")
+    db.add(teacher)
+    db.commit()
+    course = Course(name="Test Course Name", teacher_id=teacher.id)
+    db.add(course)
+    db.commit()
+
+    students = create_students_bulk([{"username": "Bulk Student 1"}, {"name": "missing username"}, {"username": "Bulk Student 2"}], db)
+    assert [student["username"] for student in students["created"]] == ["Bulk Student 1", "Bulk Student 2"]
+    assert [error["index"] for error in students["errors"]] == [1]
+
+    rows = [{"student_id": student["id"], "course_id": course.id} for student in students["created"]]
+    rows.insert(1, {"student_id": 10 ** 9, "course_id": course.id})
+    response = enroll_students_bulk(rows, db)
+
+    assert [(e["student_id"], e["course_id"]) for e in response["created"]] == [(r["student_id"], r["course_id"]) for r in rows if r["student_id"] != 10 ** 9]
+    assert response["errors"] == [{
+        "index": 1,
+        "errors": [{"loc": ["student_id"], "msg": f"student {10 ** 9} does not exist", "type": "value_error.missing_reference"}],
+    }]
+
+def test_enroll_students_bulk_skips_repeated_and_existing_pairs(db):
+    teacher = client.post("/teachers/", json={"name": "Bulk Pair Teacher"}).json()
+    course = client.post("/courses/", json={"name": "Bulk Pair Course", "teacher_id": teacher["id"]}).json()
+    students = [client.post("/students/", json={"username": f"Bulk Pair Student {i}"}).json()["id"] for i in range(3)]
+    client.post("/enrollments/", json={"student_id": students[0], "course_id": course["id"]})
+
+    response = client.post("/enrollments/bulk", json=[
+        {"student_id": students[0], "course_id": course["id"]},
+        {"student_id": students[1], "course_id": course["id"]},
+        {"student_id": students[1], "course_id": course["id"]},
+        {"student_id": students[2], "course_id": course["id"]},
+    ])
+    assert response.status_code == 200
+    body = response.json()
+    assert [e["student_id"] for e in body["created"]] == [students[1], students[2]]
+    assert [(error["index"], error["errors"][0]["type"]) for error in body["errors"]] == [
+        (0, "value_error.already_enrolled"),
+        (2, "value_error.duplicate"),
+    ]
+    assert client.get(f"/courses/{course['id']}/stats").json()["enrollment_count"] == 3
+
 def test_get_enrollments(db):
     teacher = Teacher(name="Test Teacher Name")
     db.add(teacher)
@@ -202,12 +353,12 @@ def test_delete_enrollment(db):
     enroll_student(enrollment, db)
     
     response = get_student_enrollments(student_id=student.id, db=db)
-    before_disenroll = len(response)
+    before_disenroll = len(json.loads(response.body))
     
     disenroll_student(student.id, course.id, db)
     response = get_student_enrollments(student_id=student.id, db=db)
     
-    assert len(response) == before_disenroll - 1
+    assert len(json.loads(response.body)) == before_disenroll - 1
     
 def test_get_enrollment_for_student(db):
     teacher = Teacher(name="Test Teacher Name")
@@ -223,6 +374,1019 @@ def test_get_enrollment_for_student(db):
     enrollment = EnrollmentCreate(course_id=course.id, student_id=student.id)
     enroll_student(enrollment, db)
 
-    response = get_student_enrollments(student_id=student.id, db=db)
-    assert response[-1].student_id == student.id
-    assert response[-1].course_id == course.id
+    response = json.loads(get_student_enrollments(student_id=student.id, db=db).body)
+    assert response[-1]["student_id"] == student.id
+    assert response[-1]["course_id"] == course.id
+
+def test_async_crud_round_trip(db):
+    import asyncio
+    from databases import Database
+    import src.async_crud as async_crud
+
+    async def scenario():
+        database = Database("sqlite:///./test.db")
+        await database.connect()
+        try:
+            teacher = await async_crud.add_teacher(database, TeacherCreate(name="Async Teacher"))
+            course = await async_crud.add_course(database, CourseCreate(name="Async Course", teacher_id=teacher["id"]))
+            updated = await async_crud.modify_course(database, course["id"], CourseCreate(name="Async Course 2", teacher_id=teacher["id"]))
+            teachers = await async_crud.retrieve_teachers(database, limit=1000)
+            student = await async_crud.add_student(database, StudentCreate(username="Async Stats Student"))
+            await async_crud.add_enrollment(database, EnrollmentCreate(student_id=student["id"], course_id=course["id"]))
+            enrolled = await database.fetch_one(f"SELECT * FROM teacher_stats WHERE teacher_id = {teacher['id']}")
+            await async_crud.remove_course(database, course["id"])
+            removed = await database.fetch_one(f"SELECT * FROM teacher_stats WHERE teacher_id = {teacher['id']}")
+            missing = await async_crud.retrieve_course_by_id(database, course["id"])
+            return teacher, updated, teachers, missing, dict(enrolled._mapping), dict(removed._mapping)
+        finally:
+            await database.disconnect()
+
+    loop = asyncio.new_event_loop()
+    try:
+        teacher, updated, teachers, missing, enrolled, removed = loop.run_until_complete(scenario())
+    finally:
+        loop.close()
+    assert updated["name"] == "Async Course 2"
+    listed = next(t for t in teachers if t["id"] == teacher["id"])
+    assert [c["name"] for c in listed["courses"]] == ["Async Course 2"]
+    assert missing is None
+    assert (enrolled["course_count"], enrolled["enrollment_count"], enrolled["student_count"]) == (1, 1, 1)
+    assert (removed["course_count"], removed["enrollment_count"], removed["student_count"]) == (0, 0, 0)
+
+def test_async_routes(db):
+    from databases import Database
+    from fastapi import FastAPI
+    from src.async_routes import router, get_database
+
+    database = Database("sqlite:///./test.db")
+    async_app = FastAPI()
+    async_app.include_router(router)
+    async_app.dependency_overrides[get_database] = lambda: database
+    async_app.add_event_handler("startup", database.connect)
+    async_app.add_event_handler("shutdown", database.disconnect)
+
+    with TestClient(async_app) as async_client:
+        student = async_client.post("/students/", json={"username": "Async Student"}).json()
+        assert student["enrollments"] == []
+
+        response = async_client.get(f"/students/{student['id']}/enrollments/")
+        assert response.status_code == 200
+        assert response.json() == []
+
+        teacher = async_client.post("/teachers/", json={"name": "Async Teacher"}).json()
+        course = async_client.post("/courses/", json={"name": "Async Course", "teacher_id": teacher["id"]}).json()
+        payload = {"student_id": student["id"], "course_id": course["id"]}
+        first = async_client.post("/enrollments/", json=payload).json()
+        assert async_client.post("/enrollments/", json=payload).json() == first
+        assert async_client.delete(f"/enrollments/{student['id']}/{course['id']}").status_code == 200
+        assert async_client.delete(f"/enrollments/{student['id']}/{course['id']}").status_code == 404
+
+        assert async_client.get("/courses/", params={"ids": f"1000000000,{course['id']}"}).json() == [None, course]
+        assert async_client.get("/teachers/", params={"ids": str(teacher["id"])}).json()[0]["courses"] == [course]
+
+class FakeRedis:
+    """In-memory stand-in for the subset of redis.Redis used by RedisBackend."""
+
+    def __init__(self):
+        self.values = {}
+        self.sets = {}
+        self.subscribers = {}
+
+    def get(self, name):
+        return self.values.get(name)
+
+    def set(self, name, value, ex=None, nx=False):
+        if not (nx and name in self.values):
+            self.values[name] = value.encode() if isinstance(value, str) else value
+
+    def mget(self, names):
+        return [self.values.get(name) for name in names]
+
+    def incr(self, name):
+        self.values[name] = str(int(self.values.get(name, 0)) + 1).encode()
+        return int(self.values[name])
+
+    def sadd(self, name, member):
+        self.sets.setdefault(name, set()).add(member.encode())
+
+    def smembers(self, name):
+        return set(self.sets.get(name, ()))
+
+    def expire(self, name, seconds):
+        pass
+
+    def delete(self, *names):
+        for name in names:
+            name = name.decode() if isinstance(name, bytes) else name
+            self.values.pop(name, None)
+            self.sets.pop(name, None)
+
+    def publish(self, channel, message):
+        for handler in self.subscribers.get(channel, ()):
+            handler({"data": message.encode()})
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        return FakePubSub(self)
+
+class FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.calls.append((name, args, kwargs))
+
+    def execute(self):
+        return [getattr(self.client, name)(*args, **kwargs) for name, args, kwargs in self.calls]
+
+class FakePubSub:
+    def __init__(self, client):
+        self.client = client
+
+    def subscribe(self, **handlers):
+        for channel, handler in handlers.items():
+            self.client.subscribers.setdefault(channel, []).append(handler)
+
+    def run_in_thread(self, sleep_time=0, daemon=False):
+        return None
+
+def test_shared_cache_backend_with_l1():
+    import src.cache as cache
+
+    client = FakeRedis()
+    cache.configure_cache(cache.RedisBackend(client))
+    try:
+        key = make_cache_key("teachers", skip=0, limit=10)
+        set_cache(key, CachedResponse(b"[]", {}), {("teacher", 1)})
+        assert cache.caches["teachers"].ttl == cache.L1_CACHE_SETTINGS["ttl"]
+
+        # A worker with a cold L1 reads the entry from the shared store.
+        cache.caches.clear()
+        assert get_cache(key) == CachedResponse(b"[]", {})
+        assert key in cache.caches["teachers"]
+
+        # Another worker's write evicts the shared entry and, through the
+        # broadcast, this worker's L1 copy.
+        other_worker = cache.RedisBackend(client)
+        other_worker.invalidate({("teacher", 1)})
+        assert key not in cache.caches["teachers"]
+        assert get_cache(key) is None
+
+        # Table versions (for ETags) are shared too.
+        assert cache.versions(("teacher", "course"))[1] == [1, 0]
+        assert cache.versions(("teacher",))[0] == other_worker.versions(("teacher",))[0]
+    finally:
+        cache.configure_cache(None)
+
+def test_export_enrollments(db):
+    from src.export import csv_chunks, ndjson_chunks, EXPORT_TABLES
+
+    teacher = Teacher(name="Test Teacher Name")
+    student = Student(username="Test Student Username")
+    db.add_all([teacher, student])
+    db.commit()
+    course = Course(name="Test Course Name", teacher_id=teacher.id)
+    db.add(course)
+    db.commit()
+    enroll_student(EnrollmentCreate(student_id=student.id, course_id=course.id), db)
+
+    table = EXPORT_TABLES["enrollments"]
+    rows = [json.loads(line) for line in "".join(ndjson_chunks(db.get_bind(), table, batch_size=2)).splitlines()]
+    assert {"student_id": student.id, "course_id": course.id} in [{k: r[k] for k in ("student_id", "course_id")} for r in rows]
+
+    lines = "".join(csv_chunks(db.get_bind(), table, batch_size=2)).splitlines()
+    assert lines[0] == "id,student_id,course_id"
+    assert len(lines) == len(rows) + 1
+
+    response = client.get("/export/enrollments.csv")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/csv")
+    assert client.get("/export/passwords.csv").status_code == 404
+
+def test_migrations_upgrade_legacy_schema(tmp_path):
+    from loguru import logger
+    from sqlalchemy import inspect, text
+    from src.migrations import HEAD, current_version
+
+    legacy = create_engine(f"sqlite:///{tmp_path}/legacy.db")
+    with legacy.begin() as connection:
+        connection.execute(text("CREATE TABLE teacher (id INTEGER PRIMARY KEY, name VARCHAR)"))
+        connection.execute(text("CREATE TABLE course (id INTEGER PRIMARY KEY, name VARCHAR, teacher_id INTEGER)"))
+        connection.execute(text("INSERT INTO teacher (name) VALUES ('Legacy Teacher')"))
+        connection.execute(text("INSERT INTO course (name, teacher_id) VALUES ('Legacy 1', 1), ('Legacy 2', 1)"))
+        connection.execute(text("CREATE TABLE lesson (id INTEGER PRIMARY KEY, title VARCHAR, course_id INTEGER)"))
+        connection.execute(text("CREATE TABLE enrollment (id INTEGER PRIMARY KEY, student_id INTEGER, course_id INTEGER)"))
+        connection.execute(text("INSERT INTO enrollment (student_id, course_id) VALUES (1, 1), (1, 1), (1, 2)"))
+
+    messages = []
+    handler_id = logger.add(messages.append, level="WARNING", format="{message}")
+    try:
+        assert upgrade(legacy) == HEAD
+    finally:
+        logger.remove(handler_id)
+    # The duplicate removed to build the unique index is on record.
+    assert messages == ["Deleting 1 duplicate enrollments (id, student_id, course_id): [(2, 1, 1)]\n"]
+    with legacy.connect() as connection:
+        assert current_version(connection) == HEAD
+        assert connection.execute(text("SELECT id FROM enrollment ORDER BY id")).scalars().all() == [1, 3]
+        # Counters are backfilled from the surviving rows.
+        assert connection.execute(text("SELECT enrollment_count FROM course_stats ORDER BY course_id")).scalars().all() == [1, 1]
+        assert connection.execute(text("SELECT course_count, enrollment_count, student_count FROM teacher_stats")).all() == [(2, 2, 1)]
+    indexes = {index["name"]: index for index in inspect(legacy).get_indexes("enrollment")}
+    assert indexes["uq_enrollment_student_id_course_id"]["unique"]
+
+    # Upgrading an up-to-date schema is a no-op.
+    assert upgrade(legacy) == HEAD
+
+def test_migrations_create_fresh_schema(tmp_path):
+    from sqlalchemy import inspect
+    from src.migrations import HEAD
+
+    fresh = create_engine(f"sqlite:///{tmp_path}/fresh.db")
+    assert upgrade(fresh) == HEAD
+    assert {"course", "teacher", "lesson", "student", "enrollment"} <= set(inspect(fresh).get_table_names())
+
+def test_setup_database_shares_one_engine():
+    import src.models
+
+    assert setup_database()[3] is src.models.engine
+
+    client.get("/courses/")
+    metrics = client.get("/metrics/pool").json()
+    assert metrics["checkouts"] >= 1
+    assert metrics["checked_out"] <= metrics["size"] + metrics["max_overflow"]
+
+def test_reads_are_routed_to_replicas(tmp_path, monkeypatch):
+    import src.cache
+    import src.main
+
+    threadsafe = {"check_same_thread": False}
+    engines = {
+        name: create_engine(f"sqlite:///{tmp_path}/{name}.db", connect_args=threadsafe)
+        for name in ("primary", "replica")
+    }
+    sessions = {name: sessionmaker(autocommit=False, autoflush=False, bind=e) for name, e in engines.items()}
+    for bound in engines.values():
+        Base.metadata.create_all(bind=bound)
+    with sessions["replica"]() as replica:
+        replica.add(Teacher(name="Replica Teacher"))
+        replica.commit()
+
+    broken = sessionmaker(bind=create_engine(f"sqlite:///{tmp_path}/missing/replica.db"))
+    monkeypatch.setattr(src.main, "db_router", ReplicaRouter(sessions["primary"], [broken, sessions["replica"]]))
+    monkeypatch.setattr(src.main, "READ_YOUR_WRITES_SECONDS", 30)
+    monkeypatch.setattr(src.cache, "last_invalidation", float("-inf"))
+    replica_client = TestClient(app)
+
+    # The unreachable replica fails its health check and is skipped.
+    names = [t["name"] for t in replica_client.get("/teachers/", params={"limit": 1001}).json()]
+    assert names == ["Replica Teacher"]
+
+    response = replica_client.post("/teachers/", json={"name": "Primary Teacher"})
+    assert "db_primary_until" in response.cookies
+
+    # Right after a write every read uses the primary, so no replica that
+    # has yet to apply it can fill the cache under the new ETag.
+    names = [t["name"] for t in TestClient(app).get("/teachers/", params={"limit": 1003}).json()]
+    assert names == ["Primary Teacher"]
+
+    # Once replicas have caught up, only the writing client stays pinned.
+    monkeypatch.setattr(src.cache, "last_invalidation", float("-inf"))
+    names = [t["name"] for t in replica_client.get("/teachers/", params={"limit": 1002}).json()]
+    assert names == ["Primary Teacher"]
+    names = [t["name"] for t in TestClient(app).get("/teachers/", params={"limit": 1004}).json()]
+    assert names == ["Replica Teacher"]
+
+def test_saturated_replica_fails_over(tmp_path):
+    from sqlalchemy.pool import QueuePool
+
+    saturated = create_engine(f"sqlite:///{tmp_path}/saturated.db", poolclass=QueuePool, pool_size=1, max_overflow=0, pool_timeout=0.1)
+    healthy = create_engine(f"sqlite:///{tmp_path}/healthy.db")
+    replicas = [sessionmaker(bind=saturated), sessionmaker(bind=healthy)]
+    router = ReplicaRouter(sessionmaker(bind=create_engine(f"sqlite:///{tmp_path}/primary.db")), replicas)
+
+    held = saturated.connect()
+    try:
+        # The pool checkout times out, which marks the replica down.
+        assert router.session(read_only=True).bind is healthy
+        assert router.session(read_only=True).bind is healthy
+    finally:
+        held.close()
+
+def test_batching_log_sink_writes_json_lines(tmp_path, monkeypatch):
+    import src.logs
+    from loguru import logger
+    from src.logs import BatchingFileSink, sample_info
+
+    path = tmp_path / "app.log"
+    sink = BatchingFileSink(str(path), batch_size=2, flush_interval=0.01)
+    handler_id = logger.add(sink, filter=sample_info, format=lambda record: "{message}")
+    monkeypatch.setattr(src.logs, "LOG_INFO_SAMPLE_RATE", 0.0)
+    logger.info("sampled out")
+    logger.warning("Added {} rows", 3)
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        logger.exception("failed")
+    # Removing the handler stops the sink, which drains its queue first.
+    logger.remove(handler_id)
+
+    entries = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [e["message"] for e in entries] == ["Added 3 rows", "failed"]
+    assert entries[0]["level"] == "WARNING"
+    assert "ValueError: boom" in entries[1]["exception"]
+    assert sink.dropped == 0
+
+def test_metrics_endpoint(db):
+    client.get("/courses/", params={"limit": 2001})
+    client.get("/courses/", params={"limit": 2001})
+    client.get("/teachers/", params={"limit": 2002})
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    text = response.text
+    assert 'http_request_duration_seconds_count{method="GET",route="/courses/",status="200"}' in text
+    assert 'http_request_duration_seconds_bucket{method="GET",route="/courses/",status="200",le="+Inf"}' in text
+    assert 'cache_lookups_total{endpoint="courses",result="hit"}' in text
+    assert 'cache_lookups_total{endpoint="courses",result="miss"}' in text
+
+    # Listing teachers with their courses takes a bounded number of queries.
+    samples = dict(line.rsplit(" ", 1) for line in text.splitlines() if not line.startswith("#"))
+    assert float(samples['http_request_db_queries_sum{method="GET",route="/teachers/"}']) >= 1
+
+def test_metrics_count_async_route_queries(db):
+    from databases import Database
+    from fastapi import FastAPI
+    from src import metrics
+    from src.async_routes import router, get_database
+
+    database = Database("sqlite:///./test.db")
+    async_app = FastAPI()
+    async_app.include_router(router)
+    async_app.add_middleware(MetricsMiddleware)
+    async_app.dependency_overrides[get_database] = lambda: database
+    async_app.add_event_handler("startup", database.connect)
+    async_app.add_event_handler("shutdown", database.disconnect)
+
+    labels = ("GET", "/courses/{course_id}")
+    def recorded():
+        _, total, count = metrics.request_db_queries.series.get(labels, (None, 0, 0))
+        return total, count
+
+    before = recorded()
+    with TestClient(async_app) as async_client:
+        assert async_client.get("/courses/1000000000").status_code == 200
+    total, count = recorded()
+    # One request, one SELECT through `databases`.
+    assert (total - before[0], count - before[1]) == (1, 1)
+
+def test_metrics_label_responses_answered_before_routing(db):
+    from src.metrics import request_duration
+
+    etag = client.get("/lessons/").headers["etag"]
+    assert client.get("/lessons/", headers={"If-None-Match": etag}).status_code == 304
+    assert ("GET", "/lessons/", 304) in request_duration.series
+    client.get("/no-such-route")
+    assert ("GET", "unmatched", 404) in request_duration.series
+
+def test_benchmark_summary_and_regression_check():
+    from benchmarks.run import compare, percentile, summarize
+
+    latencies = [i / 1000 for i in range(1, 101)]
+    assert percentile(latencies, 50) == 0.05
+    assert percentile(latencies, 99) == 0.099
+
+    baseline = {"results": {"cache_on": {"GET /courses/": summarize(latencies, 0, 1.0)}}}
+    assert compare(baseline, baseline, 0.2) == []
+
+    slower = {"results": {"cache_on": {"GET /courses/": summarize([t * 2 for t in latencies], 0, 2.0)}}}
+    regressions = compare(slower, baseline, 0.2)
+    assert len(regressions) == 2
+    assert all(regression.startswith("cache_on GET /courses/") for regression in regressions)
+
+def test_rate_limit_token_buckets():
+    import asyncio
+    from fastapi import FastAPI as LimitedApp
+    from src.ratelimit import InProcessBackend, RateLimitMiddleware
+
+    now = [0.0]
+    backend = InProcessBackend(clock=lambda: now[0])
+    loop = asyncio.new_event_loop()
+    assert [loop.run_until_complete(backend.acquire(("a", "read"), 1, 2)) for _ in range(3)] == [0, 0, 1.0]
+    now[0] += 0.5
+    assert loop.run_until_complete(backend.acquire(("a", "read"), 1, 2)) == 0.5
+    assert loop.run_until_complete(backend.acquire(("b", "read"), 1, 2)) == 0
+    loop.close()
+
+    limited = LimitedApp()
+    limited.add_middleware(
+        RateLimitMiddleware,
+        backend=InProcessBackend(),
+        route_limits={("POST", "/enrollments/"): (0.5, 1), ("GET", "/metrics"): None},
+        read_limit=(0.5, 2),
+        write_limit=(0.5, 1),
+        enabled=True,
+    )
+    limited.get("/courses/")(lambda: [])
+    limited.post("/courses/")(lambda: {})
+    limited.post("/enrollments/")(lambda: {})
+    limited.get("/metrics")(lambda: "")
+    limited_client = TestClient(limited)
+
+    assert [limited_client.get("/courses/").status_code for _ in range(3)] == [200, 200, 429]
+    # Writes and the enrollment route have buckets of their own.
+    assert limited_client.post("/courses/").status_code == 200
+    assert limited_client.post("/enrollments/").status_code == 200
+    response = limited_client.post("/enrollments/")
+    assert response.status_code == 429
+    assert response.headers["retry-after"] == "2"
+    assert all(limited_client.get("/metrics").status_code == 200 for _ in range(5))
+
+def test_cache_misses_share_one_fill():
+    import asyncio
+    import threading
+    import src.cache as cache
+
+    key = make_cache_key("single-flight")
+    fills = []
+    release = threading.Event()
+
+    def fill():
+        fills.append(1)
+        release.wait(5)
+        return CachedResponse(b"[1]", {}), {("course", 1)}
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cached(key, fill))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    while cache.cache_stats["single-flight"]["coalesced"] < 7:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(fills) == 1
+    assert results == [CachedResponse(b"[1]", {})] * 8
+    assert get_cache(key) == CachedResponse(b"[1]", {})
+
+    async def async_fill():
+        fills.append(1)
+        await asyncio.sleep(0.01)
+        return CachedResponse(b"[2]", {}), set()
+
+    async def concurrent_requests():
+        async_key = make_cache_key("single-flight", page=2)
+        return await asyncio.gather(*[async_cached(async_key, async_fill) for _ in range(5)])
+
+    loop = asyncio.new_event_loop()
+    gathered = loop.run_until_complete(concurrent_requests())
+    loop.close()
+    assert len(fills) == 2
+    assert gathered == [CachedResponse(b"[2]", {})] * 5
+
+def test_stale_entry_is_served_while_refreshing():
+    import threading
+    import src.cache as cache
+
+    key = make_cache_key("stale-while-revalidate")
+    set_cache(key, CachedResponse(b"[old]", {}))
+    # Past its freshness, but still inside the stale window.
+    cache.caches["stale-while-revalidate"][key] = cache.Entry(CachedResponse(b"[old]", {}), 0)
+    assert get_cache(key) is None
+
+    refreshed = threading.Event()
+
+    def refresh():
+        refreshed.set()
+        return CachedResponse(b"[new]", {}), set()
+
+    def fill():
+        raise AssertionError("a stale hit must not fetch in the request")
+
+    assert cached(key, fill, refresh) == CachedResponse(b"[old]", {})
+    assert refreshed.wait(5)
+    deadline = time.monotonic() + 5
+    while get_cache(key) is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert get_cache(key) == CachedResponse(b"[new]", {})
+
+def test_fast_serialization_matches_pydantic_output(db):
+    from src import schemas
+    from src.serializers import serialize, serialize_rows
+
+    teacher = Teacher(name="Serialized Teacher ü")
+    db.add(teacher)
+    db.commit()
+    db.add(Course(name="Serialized Course", teacher_id=teacher.id))
+    db.commit()
+    db.expire_all()
+
+    orm_teachers = db.query(Teacher).order_by(Teacher.id).all()
+    rows = retrieve_teachers(db, limit=len(orm_teachers))
+    assert serialize_rows(schemas.Teacher, rows) == serialize(schemas.Teacher, orm_teachers)
+    assert serialize_rows(schemas.Teacher, rows, ("id", "name")) == serialize(schemas.Teacher, orm_teachers, ("id", "name"))
+
+def test_conditional_get_with_etags(db):
+    response = client.get("/courses/")
+    etag = response.headers["etag"]
+    assert response.headers["cache-control"] == "public, max-age=5"
+
+    not_modified = client.get("/courses/", headers={"If-None-Match": etag})
+    assert not_modified.status_code == 304
+    assert not_modified.content == b""
+    assert not_modified.headers["etag"] == etag
+
+    # Lessons have their own counter, so a course write leaves their ETag alone.
+    lessons_etag = client.get("/lessons/").headers["etag"]
+    teachers_etag = client.get("/teachers/").headers["etag"]
+    teacher = client.post("/teachers/", json={"name": "ETag Teacher"}).json()
+    client.post("/courses/", json={"name": "ETag Course", "teacher_id": teacher["id"]})
+
+    response = client.get("/courses/", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    assert client.get("/lessons/", headers={"If-None-Match": lessons_etag}).status_code == 304
+    # Teachers nest their courses, so their ETag moved too.
+    assert client.get("/teachers/", headers={"If-None-Match": teachers_etag}).status_code == 200
+
+def test_response_compression(db, monkeypatch):
+    from starlette.responses import StreamingResponse as StarletteStreamingResponse
+    from src import compression
+
+    assert compression.negotiate("gzip, deflate") == "gzip"
+    assert compression.negotiate("gzip;q=0, identity") is None
+    assert compression.negotiate("*", ("gzip",)) == "gzip"
+
+    create_students_bulk([{"username": f"Compressed Student {i:03}"} for i in range(40)], db)
+    plain = client.get("/students/?limit=40", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in plain.headers
+    assert len(plain.content) >= compression.COMPRESSION_MIN_SIZE
+
+    response = client.get("/students/?limit=40", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["vary"] == "Accept-Encoding"
+    assert int(response.headers["content-length"]) < len(plain.content)
+    assert response.content == plain.content
+
+    # Cache hits send the encoding stored with the entry instead of compressing again.
+    def compress(body, encoding):
+        raise AssertionError("compressed a cached page again")
+
+    monkeypatch.setattr(compression, "compress", compress)
+    assert client.get("/students/?limit=40", headers={"Accept-Encoding": "gzip"}).content == plain.content
+
+    small = client.get("/students/?limit=1", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in small.headers
+    monkeypatch.undo()
+
+    async def chunks():
+        for i in range(3):
+            yield f"line {i}\n".encode()
+
+    streamed = TestClient(compression.CompressionMiddleware(lambda scope, receive, send: StarletteStreamingResponse(chunks(), media_type="text/csv")(scope, receive, send)))
+    response = streamed.get("/", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert "content-length" not in response.headers
+    assert response.content == b"line 0\nline 1\nline 2\n"
+
+def test_course_and_teacher_stats(db):
+    from sqlalchemy import text
+    from src.stats import REBUILD
+
+    teacher = client.post("/teachers/", json={"name": "Stats Teacher"}).json()
+    other = client.post("/teachers/", json={"name": "Other Stats Teacher"}).json()
+    first = client.post("/courses/", json={"name": "Stats 1", "teacher_id": teacher["id"]}).json()
+    second = client.post("/courses/", json={"name": "Stats 2", "teacher_id": teacher["id"]}).json()
+    students = [client.post("/students/", json={"username": f"Stats Student {i}"}).json()["id"] for i in range(3)]
+    client.post("/lessons/", json={"title": "Stats Lesson", "course_id": first["id"]})
+    client.post("/enrollments/", json={"student_id": students[0], "course_id": first["id"]})
+    client.post("/enrollments/bulk", json=[
+        {"student_id": students[0], "course_id": second["id"]},
+        {"student_id": students[1], "course_id": first["id"]},
+        {"student_id": students[2], "course_id": second["id"]},
+    ])
+
+    assert client.get(f"/courses/{first['id']}/stats").json() == {"course_id": first["id"], "enrollment_count": 2, "lesson_count": 1}
+    # students[0] takes both courses but counts once.
+    assert client.get(f"/teachers/{teacher['id']}/stats").json() == {
+        "teacher_id": teacher["id"], "course_count": 2, "enrollment_count": 4, "student_count": 3,
+    }
+
+    client.delete(f"/enrollments/{students[0]}/{first['id']}")
+    client.put(f"/courses/{second['id']}", json={"name": "Stats 2", "teacher_id": other["id"]})
+    assert client.get(f"/teachers/{teacher['id']}/stats").json()["student_count"] == 1
+    assert client.get(f"/teachers/{other['id']}/stats").json() == {
+        "teacher_id": other["id"], "course_count": 1, "enrollment_count": 2, "student_count": 2,
+    }
+
+    # The app's own database, which the fixture's session may not point at.
+    session = setup_database()[0]()
+    delete_course(db=session, course_id=second["id"])
+    assert client.get(f"/courses/{second['id']}/stats").status_code == 404
+    assert client.get(f"/teachers/{other['id']}/stats").json()["student_count"] == 0
+    assert client.get("/teachers/1000000000/stats").status_code == 404
+
+    # The running totals agree with a recount from the tables.
+    def snapshot():
+        return [session.execute(text(f"SELECT * FROM {table} ORDER BY 1")).all() for table in ("course_stats", "teacher_stats")]
+
+    try:
+        maintained = snapshot()
+        for statement in REBUILD:
+            session.execute(text(statement))
+        assert snapshot() == maintained
+    finally:
+        session.rollback()
+        session.close()
+
+def test_importing_the_app_opens_no_engine():
+    import subprocess
+
+    code = (
+        "import src.main, src.database, src.logs, src.cache;"
+        "assert not src.database._setups, 'engine created on import';"
+        "assert src.logs.file_sink is None and src.cache.backend is None"
+    )
+    subprocess.run([sys.executable, "-c", code], check=True)
+
+def test_gunicorn_workers_get_fresh_pools(tmp_path, monkeypatch):
+    import runpy
+    from types import SimpleNamespace
+    from src import http_cache
+
+    settings = runpy.run_path("src/gunicorn_conf.py")
+    assert settings["preload_app"] and settings["workers"] >= 1
+    assert settings["worker_class"] == "uvicorn.workers.UvicornWorker"
+
+    engine = setup_database(f"sqlite:///{tmp_path}/fork.db")[3]
+    with engine.connect():
+        pass
+    inherited = engine.pool
+    monkeypatch.setattr(http_cache, "multiple_workers", False)
+    settings["post_fork"](SimpleNamespace(cfg=SimpleNamespace(workers=4)), None)
+    assert engine.pool is not inherited
+
+    # Per-process write counters can't back ETags shared by several workers.
+    assert http_cache.multiple_workers
+    response = client.get("/courses/")
+    assert response.status_code == 200 and "etag" not in response.headers
+    monkeypatch.setattr(http_cache.cache, "backend", object())
+    assert http_cache.conditional_gets_enabled()
+
+def test_concurrent_enrollment_writes(db, monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    from src import ratelimit
+
+    # Every racer is its own client, so the race is not cut short by 429s.
+    monkeypatch.setattr(ratelimit, "RATE_LIMIT_CLIENT_HEADER", "x-racer")
+
+    teacher = client.post("/teachers/", json={"name": "Race Teacher"}).json()
+    course = client.post("/courses/", json={"name": "Race Course", "teacher_id": teacher["id"]}).json()
+    student = client.post("/students/", json={"username": "Race Student"}).json()
+    payload = {"student_id": student["id"], "course_id": course["id"]}
+
+    def race(request):
+        # One client per thread, as separate connections would be.
+        racers = [TestClient(app) for _ in range(16)]
+        for i, racer in enumerate(racers):
+            racer.headers["X-Racer"] = str(i)
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            return list(pool.map(request, racers))
+
+    created = race(lambda racer: racer.post("/enrollments/", json=payload))
+    assert {response.status_code for response in created} == {200}
+    assert len({response.json()["id"] for response in created}) == 1
+    assert client.get(f"/courses/{course['id']}/stats").json()["enrollment_count"] == 1
+    assert client.get(f"/teachers/{teacher['id']}/stats").json()["student_count"] == 1
+
+    removed = race(lambda racer: racer.delete(f"/enrollments/{student['id']}/{course['id']}"))
+    assert sorted(response.status_code for response in removed) == [200] + [404] * 15
+    assert client.get(f"/courses/{course['id']}/stats").json()["enrollment_count"] == 0
+    assert client.get(f"/teachers/{teacher['id']}/stats").json() == {
+        "teacher_id": teacher["id"], "course_count": 1, "enrollment_count": 0, "student_count": 0,
+    }
+
+def test_enrollment_idempotency_key(db):
+    import uuid
+
+    teacher = client.post("/teachers/", json={"name": "Retry Teacher"}).json()
+    course = client.post("/courses/", json={"name": "Retry Course", "teacher_id": teacher["id"]}).json()
+    students = [client.post("/students/", json={"username": f"Retry Student {i}"}).json()["id"] for i in range(2)]
+    headers = {"Idempotency-Key": str(uuid.uuid4())}
+
+    first = client.post("/enrollments/", json={"student_id": students[0], "course_id": course["id"]}, headers=headers)
+    client.delete(f"/enrollments/{students[0]}/{course['id']}")
+    # The retry gets the original answer and does not enroll the student again.
+    retried = client.post("/enrollments/", json={"student_id": students[0], "course_id": course["id"]}, headers=headers)
+    assert retried.status_code == 200 and retried.json() == first.json()
+    assert client.get(f"/courses/{course['id']}/stats").json()["enrollment_count"] == 0
+
+    reused = client.post("/enrollments/", json={"student_id": students[1], "course_id": course["id"]}, headers=headers)
+    assert reused.status_code == 422
+
+def test_search(db):
+    import uuid
+
+    # The app database outlives test runs; a fresh word keeps earlier rows out.
+    word = "s" + uuid.uuid4().hex[:8]
+    teacher = client.post("/teachers/", json={"name": f"{word} Teacher"}).json()
+    basics = client.post("/courses/", json={"name": f"{word} Python Basics", "teacher_id": teacher["id"]}).json()
+    advanced = client.post("/courses/", json={"name": f"Advanced {word} Python", "teacher_id": teacher["id"]}).json()
+    cooking = client.post("/courses/", json={"name": f"{word} Cooking", "teacher_id": teacher["id"]}).json()
+    student = client.post("/students/", json={"username": f"{word}ada"}).json()
+
+    response = client.get("/search/courses", params={"q": f"{word} pyth"})
+    assert response.status_code == 200
+    # Names starting with the query rank first.
+    assert response.json() == [{"id": basics["id"], "text": basics["name"]}, {"id": advanced["id"], "text": advanced["name"]}]
+    assert {hit["id"] for hit in client.get("/search/courses", params={"q": word}).json()} == {basics["id"], advanced["id"], cooking["id"]}
+    assert len(client.get("/search/courses", params={"q": word, "limit": 1}).json()) == 1
+
+    everything = client.get("/search", params={"q": word}).json()
+    assert everything["students"] == [{"id": student["id"], "text": student["username"]}]
+    assert everything["teachers"] == [{"id": teacher["id"], "text": teacher["name"]}]
+    assert everything["lessons"] == []
+
+    assert client.get("/search/enrollments", params={"q": word}).status_code == 404
+    assert client.get("/search/courses", params={"q": "s"}).status_code == 422
+
+def test_search_in_process_index(db):
+    from src import search
+
+    teacher = Teacher(name="Index Teacher")
+    db.add(teacher)
+    db.commit()
+    db.add_all([Course(name=name, teacher_id=teacher.id) for name in ("Zebra Biology", "Biology of Zebras", "Zoology")])
+    db.commit()
+
+    assert [hit["text"] for hit in search.search(db, "courses", "zebra bio", 10)] == ["Zebra Biology", "Biology of Zebras"]
+    assert search.search(db, "courses", "!!", 10) == []
+
+    # A write through the app moves the table's counter and the index is rebuilt.
+    course = Course(name="Zebra Art", teacher_id=teacher.id)
+    db.add(course)
+    db.commit()
+    invalidate_write("course", "insert", course)
+    assert [hit["text"] for hit in search.search(db, "courses", "zebra", 2)] == ["Zebra Art", "Zebra Biology"]
+
+def test_batch_reads_by_ids(db):
+    from sqlalchemy import event
+    from src import cache
+
+    teacher = client.post("/teachers/", json={"name": "Batch Teacher"}).json()
+    first = client.post("/courses/", json={"name": "Batch 1", "teacher_id": teacher["id"]}).json()
+    second = client.post("/courses/", json={"name": "Batch 2", "teacher_id": teacher["id"]}).json()
+    student = client.post("/students/", json={"username": "Batch Student"}).json()
+    client.post("/enrollments/", json={"student_id": student["id"], "course_id": first["id"]})
+
+    # Request order, repeats kept, null for an id with no row.
+    ids = f"{second['id']},1000000000,{first['id']},{second['id']}"
+    assert client.get(f"/courses?ids={ids}").json() == [second, None, first, second]
+
+    statements = []
+    count = lambda *args: statements.append(args[2])
+    engine = setup_database()[3]
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        hits = cache.cache_stats["student"]["hit"]
+        body = client.get("/students/", params={"ids": str(student["id"])}).json()
+        # One IN query for the students and one for their enrollments.
+        assert len(statements) == 2
+        assert body[0]["enrollments"][0]["course_id"] == first["id"]
+        assert client.get("/students/", params={"ids": str(student["id"])}).json() == body
+        assert len(statements) == 2 and cache.cache_stats["student"]["hit"] == hits + 1
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+
+    # Writes evict the entries, nested collections included.
+    client.put(f"/courses/{first['id']}", json={"name": "Batch 1 Renamed", "teacher_id": teacher["id"]})
+    assert client.get("/teachers/", params={"ids": str(teacher["id"])}).json()[0]["courses"][0]["name"] == "Batch 1 Renamed"
+    third = client.post("/courses/", json={"name": "Batch 3", "teacher_id": teacher["id"]}).json()
+    assert [course["id"] for course in client.get("/teachers/", params={"ids": str(teacher["id"])}).json()[0]["courses"]] == [first["id"], second["id"], third["id"]]
+    assert client.get("/teachers/", params={"ids": str(teacher["id"]), "fields": "id,name"}).json() == [{"id": teacher["id"], "name": "Batch Teacher"}]
+
+    lesson = client.post("/lessons/", json={"title": "Batch Lesson", "course_id": first["id"]}).json()
+    assert client.get("/lessons/", params={"ids": f"{lesson['id']}"}).json() == [lesson]
+
+    assert client.get("/courses/", params={"ids": "1,two"}).status_code == 400
+    assert client.get("/courses/", params={"ids": ","}).status_code == 400
+    assert client.get("/courses/", params={"ids": ",".join(["1"] * 101)}).status_code == 400
+
+def test_deleting_a_course_evicts_its_lessons_and_enrollments(db):
+    teacher = client.post("/teachers/", json={"name": "Orphan Teacher"}).json()
+    course = client.post("/courses/", json={"name": "Orphan Course", "teacher_id": teacher["id"]}).json()
+    lesson = client.post("/lessons/", json={"title": "Orphan Lesson", "course_id": course["id"]}).json()
+    student = client.post("/students/", json={"username": "Orphan Student"}).json()
+    client.post("/enrollments/", json={"student_id": student["id"], "course_id": course["id"]})
+
+    assert client.get("/lessons/", params={"ids": str(lesson["id"])}).json()[0]["course_id"] == course["id"]
+    assert client.get("/students/", params={"ids": str(student["id"])}).json()[0]["enrollments"][0]["course_id"] == course["id"]
+    etag = client.get(f"/courses/{course['id']}/lessons/").headers["etag"]
+
+    session = setup_database()[0]()
+    try:
+        delete_course(db=session, course_id=course["id"])
+    finally:
+        session.close()
+
+    assert client.get("/lessons/", params={"ids": str(lesson["id"])}).json()[0]["course_id"] is None
+    assert client.get("/students/", params={"ids": str(student["id"])}).json()[0]["enrollments"][0]["course_id"] is None
+    assert client.get(f"/courses/{course['id']}/lessons/", headers={"If-None-Match": etag}).status_code == 200
+
+def test_cache_bookkeeping_under_concurrent_writers(monkeypatch):
+    import threading
+    import src.cache as cache
+
+    monkeypatch.setitem(cache.CACHE_SETTINGS, "contended", {"ttl": 60, "maxsize": 16})
+    cache.caches.pop("contended", None)
+    errors = []
+
+    def store(worker):
+        try:
+            for i in range(500):
+                set_cache(make_cache_key("contended", worker=worker, i=i), CachedResponse(b"[]", {}), {("course", i % 7)})
+        except Exception as e:
+            errors.append(e)
+
+    def evict():
+        try:
+            for i in range(500):
+                invalidate(("course", i % 7))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=store, args=(worker,)) for worker in range(4)] + [threading.Thread(target=evict)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    # Evicted entries take their dependency records with them.
+    contended = [key for key in cache.key_dependencies if key[0] == "contended"]
+    assert len(contended) <= 16
+    assert all(key in cache.caches["contended"] for key in contended)
+
+def test_async_delete_course_detaches_its_children():
+    import asyncio
+    from databases import Database
+    import src.async_crud as async_crud
+    import src.async_routes as async_routes
+    from src.database import database_url
+
+    async def scenario():
+        # The app's Postgres database, where the foreign keys are enforced.
+        database = Database(database_url())
+        await database.connect()
+        try:
+            teacher = await async_crud.add_teacher(database, TeacherCreate(name="Async Orphan Teacher"))
+            course = await async_crud.add_course(database, CourseCreate(name="Async Orphan Course", teacher_id=teacher["id"]))
+            lesson = await async_crud.add_lesson(database, LessonCreate(title="Async Orphan Lesson", course_id=course["id"]))
+            student = await async_crud.add_student(database, StudentCreate(username="Async Orphan Student"))
+            enrollment, _ = await async_crud.add_enrollment(database, EnrollmentCreate(student_id=student["id"], course_id=course["id"]))
+            await async_routes.delete_course(course_id=course["id"], database=database)
+            return (
+                await async_crud.retrieve_course_by_id(database, course["id"]),
+                await database.fetch_val(f"SELECT course_id FROM lesson WHERE id = {lesson['id']}"),
+                await database.fetch_val(f"SELECT course_id FROM enrollment WHERE id = {enrollment['id']}"),
+            )
+        finally:
+            await database.disconnect()
+
+    assert asyncio.run(scenario()) == (None, None, None)
+
+def test_rate_limit_client_from_trusted_proxy_hops(monkeypatch):
+    from src import ratelimit
+
+    middleware = ratelimit.RateLimitMiddleware(None, enabled=True)
+    monkeypatch.setattr(ratelimit, "RATE_LIMIT_CLIENT_HEADER", "x-forwarded-for")
+
+    def client_of(*values, proxies):
+        monkeypatch.setattr(ratelimit, "RATE_LIMIT_TRUSTED_PROXIES", proxies)
+        headers = [(b"x-forwarded-for", value.encode()) for value in values]
+        return middleware._client({"headers": headers, "client": ("10.0.0.9", 5000)})
+
+    # Whatever the client puts on the left is ignored.
+    assert client_of("1.1.1.1, 203.0.113.7", proxies=1) == "203.0.113.7"
+    assert client_of("9.9.9.9", "203.0.113.7, 10.0.0.2", proxies=2) == "203.0.113.7"
+    # Fewer entries than trusted proxies: fall back to the connecting address.
+    assert client_of("203.0.113.7", proxies=2) == "10.0.0.9"
+    assert client_of(proxies=1) == "10.0.0.9"
+
+def test_disenrolling_evicts_cached_keyset_pages(db):
+    from databases import Database
+    from fastapi import FastAPI
+    from src.async_routes import router, get_database
+    from src.pagination import encode_cursor
+
+    database = Database("sqlite:///./test.db")
+    async_app = FastAPI()
+    async_app.include_router(router)
+    async_app.dependency_overrides[get_database] = lambda: database
+    async_app.add_event_handler("startup", database.connect)
+    async_app.add_event_handler("shutdown", database.disconnect)
+
+    def scenario(test_client):
+        teacher = test_client.post("/teachers/", json={"name": "Keyset Teacher"}).json()
+        course = test_client.post("/courses/", json={"name": "Keyset Course", "teacher_id": teacher["id"]}).json()
+        enrollments = []
+        for index in range(2):
+            student = test_client.post("/students/", json={"username": f"Keyset Student {index}"}).json()
+            enrollments.append(test_client.post("/enrollments/", json={"student_id": student["id"], "course_id": course["id"]}).json())
+
+        params = {"cursor": encode_cursor(enrollments[0]["id"] - 1), "limit": 2}
+        assert [row["id"] for row in test_client.get("/enrollments/", params=params).json()] == [row["id"] for row in enrollments]
+
+        removed = enrollments[1]
+        assert test_client.delete(f"/enrollments/{removed['student_id']}/{removed['course_id']}").status_code == 200
+        assert [row["id"] for row in test_client.get("/enrollments/", params=params).json()] == [enrollments[0]["id"]]
+
+    scenario(client)
+    with TestClient(async_app) as async_client:
+        scenario(async_client)
+
+def test_updating_a_missing_course_leaves_stats_alone(db):
+    from databases import Database
+    from fastapi import FastAPI
+    from src.async_routes import router, get_database
+
+    database = Database("sqlite:///./test.db")
+    async_app = FastAPI()
+    async_app.include_router(router)
+    async_app.dependency_overrides[get_database] = lambda: database
+    async_app.add_event_handler("startup", database.connect)
+    async_app.add_event_handler("shutdown", database.disconnect)
+
+    def course_count(teacher_id):
+        return db.execute(text("SELECT course_count FROM teacher_stats WHERE teacher_id = :id"), {"id": teacher_id}).scalar() or 0
+
+    with TestClient(async_app) as async_client:
+        teacher = async_client.post("/teachers/", json={"name": "Missing Course Teacher"}).json()
+        payload = {"name": "Missing Course", "teacher_id": teacher["id"]}
+        assert async_client.put("/courses/999999999", json=payload).status_code == 404
+    assert course_count(teacher["id"]) == 0
+
+    assert client.put("/courses/999999999", json=payload).status_code == 404
+
+def test_batch_reads_make_one_shared_round_trip_each_way():
+    import src.cache as cache
+
+    redis_client = FakeRedis()
+    calls = []
+    for name in ("get", "mget", "pipeline"):
+        method = getattr(redis_client, name)
+        setattr(redis_client, name, lambda *args, method=method, name=name, **kwargs: calls.append(name) or method(*args, **kwargs))
+
+    cache.configure_cache(cache.RedisBackend(redis_client))
+    try:
+        def fetch(missing):
+            return [{"id": row_id, "name": f"Teacher {row_id}", "courses": []} for row_id in missing]
+
+        def serialize(row):
+            return json.dumps(row).encode()
+
+        bodies = cached_rows("teacher", [1, 2, 3], fetch, serialize)
+        assert sorted(bodies) == [1, 2, 3]
+        assert calls == ["mget", "pipeline"]
+
+        # A worker with a cold L1 finds every row in one MGET.
+        calls.clear()
+        cache.caches.clear()
+        assert cached_rows("teacher", [1, 2, 3], lambda missing: [], serialize) == bodies
+        assert calls == ["mget"]
+    finally:
+        cache.configure_cache(None)
+
+def test_async_cache_calls_redis_off_the_event_loop():
+    import asyncio
+    import threading
+    import src.cache as cache
+
+    redis_client = FakeRedis()
+    threads = []
+    for name in ("get", "mget", "pipeline"):
+        method = getattr(redis_client, name)
+        setattr(redis_client, name, lambda *args, method=method, **kwargs: threads.append(threading.current_thread()) or method(*args, **kwargs))
+
+    async def scenario():
+        async def fill():
+            return CachedResponse(b"[]", {}), {("teacher", 1)}
+
+        key = make_cache_key("teachers", skip=0, limit=5)
+        await async_cached(key, fill)
+        cache.caches.clear()
+        await async_cached(key, fill)
+        await async_cached_rows("teacher", [1], lambda missing: asyncio.sleep(0, [{"id": 1, "courses": []}]), lambda row: b"{}")
+        await async_invalidate_write("teacher", "update", {"id": 1})
+
+    cache.configure_cache(cache.RedisBackend(redis_client))
+    try:
+        asyncio.run(scenario())
+    finally:
+        cache.configure_cache(None)
+    assert threads and threading.main_thread() not in threads